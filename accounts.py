@@ -0,0 +1,77 @@
+"""
+Broker account sessions for the ingester.
+
+ts_login_worker keeps one JSON entry per account in the ZERODHA_TOKENS_FOR_MINUTE_DATA hash and
+publishes the account name on ZERODHA_ACCOUNT_READY whenever an entry is (re)validated or written.
+Connections are planned over the accounts that have logged in and look credentials up each time they
+connect, so a relogin is picked up on the next reconnect. An account that logs in late is announced
+by next_ready and takes the tokens the others had no room for.
+"""
+import asyncio
+import json
+import threading
+import time
+
+ACCOUNTS_KEY = "ZERODHA_TOKENS_FOR_MINUTE_DATA"
+ACCOUNT_READY_CHANNEL = "ZERODHA_ACCOUNT_READY"
+
+
+class AccountDirectory:
+    def __init__(self, client, names):
+        self.client = client
+        self.names = list(names)
+        self.accounts = {}
+        self.ready = {}
+        # Names of accounts that log in after start(), first login only
+        self.arrivals = asyncio.Queue()
+        self.loop = None
+
+    def _store(self, name, raw):
+        if raw is None:
+            return
+        if name not in self.accounts and self.loop is not None:
+            self.arrivals.put_nowait(name)
+        self.accounts[name] = json.loads(raw)
+        event = self.ready.get(name)
+        if event is not None:
+            event.set()
+
+    def load(self):
+        """Read every known account's session, returns the names that have one."""
+        for name, raw in zip(self.names, self.client.hmget(ACCOUNTS_KEY, self.names)):
+            self._store(name, raw)
+        return [name for name in self.names if name in self.accounts]
+
+    def start(self):
+        """Follow ready announcements on a background thread. Call from the event loop."""
+        self.loop = asyncio.get_running_loop()
+        threading.Thread(target=self._listen, name="account-ready", daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(ACCOUNT_READY_CHANNEL)
+                # Whatever was announced before (or while) the subscription was down
+                for name, raw in zip(self.names, self.client.hmget(ACCOUNTS_KEY, self.names)):
+                    self.loop.call_soon_threadsafe(self._store, name, raw)
+                for message in pubsub.listen():
+                    name = message["data"].decode()
+                    if name in self.names:
+                        self.loop.call_soon_threadsafe(self._store, name, self.client.hget(ACCOUNTS_KEY, name))
+                        print(f"Account {name} is ready")
+            except Exception as e:
+                print(f"Error following account logins: {e}")
+                time.sleep(5)
+
+    async def next_ready(self):
+        """Wait for the next account to log in for the first time since start()."""
+        return await self.arrivals.get()
+
+    async def credentials(self, name):
+        """(api_key, access_token) of an account, waiting until it has logged in."""
+        while name not in self.accounts:
+            event = self.ready.setdefault(name, asyncio.Event())
+            await event.wait()
+        account = self.accounts[name]
+        return account["api_key"], account["access_token"]
@@ -0,0 +1,62 @@
+"""
+Size and speed of the packed candle format against the legacy per-candle JSON.
+
+    python -m benchmarks.bench_candle_codec [--candles 200000]
+"""
+import argparse
+import json
+import random
+import time
+from datetime import datetime
+
+from storage.candle_codec import decode_candle, decode_candles, encode_candle, minute_field
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--candles", type=int, default=200000)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    rows = []
+    for i in range(args.candles):
+        o = rng.randint(1000, 5000000) / 100
+        h, l, c = o + rng.randint(0, 500) / 100, o - rng.randint(0, 500) / 100, o + rng.randint(-500, 500) / 100
+        rows.append((28661100 + i % 375, o, h, l, c, round((h + l) / 2, 2), rng.randint(0, 10 ** 8), rng.randint(0, 10 ** 7)))
+
+    start = time.perf_counter()
+    legacy = []
+    for minute, o, h, l, c, atp, volume, oi in rows:
+        field = datetime.fromtimestamp(minute * 60).strftime("%H:%M")
+        candle = {"open": o, "high": h, "low": l, "close": c, "atp": atp, "volume": volume, "oi": oi}
+        legacy.append((field, json.dumps(candle)))
+    json_encode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    packed = [(minute_field(row[0]), encode_candle(*row)) for row in rows]
+    bin_encode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    [json.loads(value) for _, value in legacy]
+    json_decode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    [decode_candle(value) for _, value in packed]
+    bin_decode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decode_candles([value for _, value in packed])
+    bin_bulk_decode = time.perf_counter() - start
+
+    json_bytes = sum(len(f) + len(v) for f, v in legacy) / len(rows)
+    bin_bytes = sum(len(f) + len(v) for f, v in packed) / len(rows)
+    n = len(rows)
+    print(f"{n:,} candles")
+    print(f"  bytes/candle (field + value)  json {json_bytes:6.1f}   binary {bin_bytes:6.1f}")
+    print(f"  encode candles/sec            json {n / json_encode:>11,.0f}   binary {n / bin_encode:>11,.0f}")
+    print(f"  decode candles/sec            json {n / json_decode:>11,.0f}   binary {n / bin_decode:>11,.0f}"
+          f"   binary bulk {n / bin_bulk_decode:>11,.0f}")
+
+
+if __name__ == "__main__":
+    main()
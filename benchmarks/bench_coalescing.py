@@ -0,0 +1,78 @@
+"""
+Message rate on TICK:CHANGES with and without coalescing, replaying frames in (scaled) real time.
+Also checks that applying the coalesced batch messages in order gives consumers the same latest
+values as the per-change messages.
+
+    python -m benchmarks.bench_coalescing [--frames 1000] [--frame-interval 0.002] [--windows 50,100,250]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks.fakes import FakeRedis
+from benchmarks.frames import synthetic_frames, zipf_weights
+from helpers.zerodha_helpers import decode_binary_ticks
+from utils.publisher import CoalescingPublisher, MarketDataUpdater
+
+
+async def replay(batches, symbols, interval, window=None, shards=1):
+    redis = FakeRedis()
+    coalescer = None
+    runner = None
+    if window:
+        coalescer = CoalescingPublisher(redis, window=window, shards=shards)
+        runner = asyncio.create_task(coalescer.run())
+    updater = MarketDataUpdater(redis, coalescer=coalescer)
+    start = time.perf_counter()
+    for i, batch in enumerate(batches):
+        updater.update_batch(batch, symbols).execute()
+        delay = start + (i + 1) * interval - time.perf_counter()
+        await asyncio.sleep(max(0.0, delay))
+    if coalescer is not None:
+        runner.cancel()
+        await coalescer.flush()
+    return redis, coalescer, time.perf_counter() - start
+
+
+def latest_values(published):
+    state = {}
+    for _, message in published:
+        message = json.loads(message)
+        if "changes" in message and "symbol" in message:
+            state.setdefault(message["symbol"], {}).update(message["changes"])
+        elif "ts" in message:
+            for symbol, changes in message["changes"].items():
+                state.setdefault(symbol, {}).update(changes)
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=1000)
+    parser.add_argument("--packets", type=int, default=300)
+    parser.add_argument("--frame-interval", type=float, default=0.002)
+    parser.add_argument("--windows", default="50,100,250")
+    parser.add_argument("--shards", type=int, default=4)
+    args = parser.parse_args()
+
+    tokens = list(range(100000, 136000))
+    symbols = {token: f"CT:{token}" for token in tokens}
+    frames = synthetic_frames(args.frames, tokens, args.packets, weights=zipf_weights(len(tokens)))
+    batches = [decode_binary_ticks(frame) for frame in frames]
+
+    redis, _, elapsed = asyncio.run(replay(batches, symbols, args.frame_interval))
+    baseline = latest_values(redis.published)
+    print(f"uncoalesced: {len(redis.published):,} messages ({len(redis.published) / elapsed:,.0f}/sec)")
+
+    for window_ms in [int(w) for w in args.windows.split(",")]:
+        redis, coalescer, elapsed = asyncio.run(
+            replay(batches, symbols, args.frame_interval, window_ms / 1000, args.shards))
+        assert latest_values(redis.published) == baseline
+        print(f"{window_ms:>4} ms window, {args.shards} shards: {len(redis.published):,} messages "
+              f"({len(redis.published) / elapsed:,.0f}/sec), coalescing ratio {coalescer.coalescing_ratio():.2f}, "
+              f"{coalescer.updates_published:,} symbol updates")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Decoder throughput, frame-by-frame, for the pre-columnar parser and decode_binary_ticks.
+
+    python -m benchmarks.bench_decoder [--frames 2000] [--packets 500]
+"""
+import argparse
+import struct
+import time
+
+from benchmarks.frames import PACKET_LENGTHS, synthetic_frames
+from helpers.zerodha_helpers import EXCHANGE_MAP, decode_binary_ticks, parse_binary_ticks
+
+
+def _unpack_int(bin, start, end, byte_format="I"):
+    return struct.unpack(">" + byte_format, bin[start:end])[0]
+
+
+def _split_packets(bin):
+    number_of_packets = _unpack_int(bin, 0, 2, byte_format="H")
+    packets = []
+    j = 2
+    for i in range(number_of_packets):
+        packet_length = _unpack_int(bin, j, j + 2, byte_format="H")
+        packets.append(bin[j + 2: j + 2 + packet_length])
+        j = j + 2 + packet_length
+    return packets
+
+
+def legacy_parse_binary_ticks(bin):
+    # parse_binary_ticks as it was before decode_binary_ticks, kept as the benchmark baseline
+    data = []
+    for packet in _split_packets(bin):
+        token = _unpack_int(packet, 0, 4)
+        segment = token & 0xff
+        if segment == EXCHANGE_MAP["cds"]:
+            divisor = 10000000.0
+        elif segment == EXCHANGE_MAP["bcd"]:
+            divisor = 10000.0
+        else:
+            divisor = 100.0
+        if len(packet) == 8:
+            data.append({"token": token, "ltp": _unpack_int(packet, 4, 8) / divisor})
+        elif len(packet) == 28 or len(packet) == 32:
+            d = {"token": token, "ltp": _unpack_int(packet, 4, 8) / divisor}
+            if len(packet) == 32:
+                d["timestamp"] = _unpack_int(packet, 28, 32)
+            data.append(d)
+        elif len(packet) == 44 or len(packet) == 184:
+            d = {"token": token, "ltp": _unpack_int(packet, 4, 8) / divisor,
+                 "atp": _unpack_int(packet, 12, 16) / divisor, "volume": _unpack_int(packet, 16, 20)}
+            if len(packet) == 184:
+                d["oi"] = _unpack_int(packet, 48, 52)
+                d["timestamp"] = _unpack_int(packet, 60, 64)
+            data.append(d)
+    return data
+
+
+def measure(fn, frames):
+    start = time.perf_counter()
+    ticks = 0
+    for frame in frames:
+        ticks += len(fn(frame))
+    return ticks / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--packets", type=int, default=500)
+    args = parser.parse_args()
+
+    tokens = list(range(100000, 136000))
+    for label, lengths in (("full (184)", (184,)), ("mixed", PACKET_LENGTHS)):
+        frames = synthetic_frames(args.frames, tokens, args.packets, lengths=lengths)
+        for frame in frames[:20]:
+            legacy = sorted(legacy_parse_binary_ticks(frame), key=lambda d: d["token"])
+            assert sorted(parse_binary_ticks(frame), key=lambda d: d["token"]) == legacy
+        print(f"{label}: {args.frames} frames x {args.packets} packets")
+        print(f"  legacy parse_binary_ticks   {measure(legacy_parse_binary_ticks, frames):>12,.0f} ticks/sec")
+        print(f"  parse_binary_ticks (dicts)  {measure(parse_binary_ticks, frames):>12,.0f} ticks/sec")
+        print(f"  decode_binary_ticks         {measure(decode_binary_ticks, frames):>12,.0f} ticks/sec")
+
+
+if __name__ == "__main__":
+    main()
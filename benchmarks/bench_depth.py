@@ -0,0 +1,48 @@
+"""
+Per-frame cost of market depth: decode_binary_ticks with and without depth, and decode plus the candle
+engine update (depth aggregates on against off), on full mode frames that carry 5 levels a side.
+
+    python -m benchmarks.bench_depth [--frames 2000] [--packets 500]
+"""
+import argparse
+import time
+
+from benchmarks.frames import synthetic_frames
+from candle_engine import CandleEngine
+from helpers.zerodha_helpers import decode_binary_ticks
+
+
+def per_frame_us(fn, frames):
+    start = time.perf_counter()
+    for frame in frames:
+        fn(frame)
+    return (time.perf_counter() - start) / len(frames) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--packets", type=int, default=500)
+    args = parser.parse_args()
+
+    tokens = list(range(100000, 136000))
+    mapping = {token: f"CT:{token}" for token in tokens}
+    frames = synthetic_frames(args.frames, tokens, args.packets, depth=True)
+    print(f"{args.frames} full mode frames x {args.packets} packets")
+
+    off = per_frame_us(decode_binary_ticks, frames)
+    on = per_frame_us(lambda frame: decode_binary_ticks(frame, True), frames)
+    print(f"  decode               depth off {off:8.1f} us/frame   depth on {on:8.1f} us/frame   (+{on / off - 1:.0%})")
+
+    plain, with_depth = CandleEngine(mapping), CandleEngine(mapping, depth=True)
+    off = per_frame_us(lambda frame: plain.update(decode_binary_ticks(frame)), frames)
+    on = per_frame_us(lambda frame: with_depth.update(decode_binary_ticks(frame, True)), frames)
+    print(f"  decode + aggregate   depth off {off:8.1f} us/frame   depth on {on:8.1f} us/frame   (+{on / off - 1:.0%})")
+    quoted = sum(1 for buffer in with_depth.buffers.values() for _ in buffer.depth_candles())
+    print(f"  {quoted} token-minutes with depth aggregates, "
+          f"{with_depth.memory_report()['bytes_per_instrument']} bytes/instrument per minute buffer "
+          f"(vs {plain.memory_report()['bytes_per_instrument']})")
+
+
+if __name__ == "__main__":
+    main()
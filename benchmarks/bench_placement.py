@@ -0,0 +1,69 @@
+"""
+Per-connection tick load of the connection plan: fixed slices in Redis order against tick-rate placement,
+and how far live rebalancing gets after the hot set shifts during the session.
+
+    python -m benchmarks.bench_placement [--tokens 36000] [--accounts 12]
+"""
+import argparse
+import random
+import time
+
+from benchmarks.frames import zipf_weights
+from token_placement import place_tokens, plan_moves
+
+
+def spread(loads):
+    # Busiest connection against an even split over every connection (idle ones included)
+    loads = list(loads)
+    mean = sum(loads) / len(loads)
+    return max(loads) / mean if mean else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=36000)
+    parser.add_argument("--accounts", type=int, default=12)
+    parser.add_argument("--per-connection", type=int, default=3000)
+    args = parser.parse_args()
+
+    rng = random.Random(3)
+    tokens = list(range(100000, 100000 + args.tokens))
+    # Liquid instruments cluster together in key order (one underlying's option chain after another)
+    weights = zipf_weights(args.tokens, 0.9)
+    rates = dict(zip(tokens, weights))
+    connections = args.accounts * 3
+
+    # Fixed slices fill connections in order and leave the rest unused
+    sliced = [tokens[i * args.per_connection:(i + 1) * args.per_connection] for i in range(connections)]
+    start = time.perf_counter()
+    placed = place_tokens(tokens, rates, connections, args.per_connection)
+    place_ms = (time.perf_counter() - start) * 1000
+
+    def loads(chunks, rate_map):
+        return [sum(rate_map.get(token, 0.0) for token in chunk) for chunk in chunks]
+
+    print(f"{args.tokens} tokens on {connections} connections")
+    print(f"  sliced  max/mean load {spread(loads(sliced, rates)):.2f} "
+          f"({sum(1 for chunk in sliced if chunk)} connections used)")
+    print(f"  placed  max/mean load {spread(loads(placed, rates)):.2f} ({place_ms:.0f} ms)")
+
+    # The session's hot set differs from yesterday's profile: a random 2% of the tail ticks 30x more
+    shifted = {token: rate * (30 if rank > 100 and rng.random() < 0.02 else 1)
+               for rank, (token, rate) in enumerate(rates.items())}
+    assignment = dict(enumerate(placed))
+    heaviest = max(weights) / (sum(weights) / connections)
+    print(f"  lower bound (one token) {heaviest:.2f}")
+    print(f"  drifted max/mean load {spread(loads(assignment.values(), shifted)):.2f}")
+    start = time.perf_counter()
+    moves = plan_moves(assignment, shifted, args.per_connection)
+    plan_ms = (time.perf_counter() - start) * 1000
+    for token, source, target in moves:
+        assignment[source].remove(token)
+        assignment[target].append(token)
+    assert sorted(token for chunk in assignment.values() for token in chunk) == tokens
+    print(f"  rebalanced max/mean load {spread(loads(assignment.values(), shifted)):.2f} "
+          f"with {len(moves)} moves ({plan_ms:.0f} ms)")
+
+
+if __name__ == "__main__":
+    main()
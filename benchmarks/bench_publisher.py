@@ -0,0 +1,111 @@
+"""
+CPU per 10k ticks for TICKS:* change detection: the previous blake2b-per-field MarketDataUpdater
+called once per symbol with its own pipeline, against the last-value cache with one pipeline per batch.
+
+    python -m benchmarks.bench_publisher [--frames 400] [--packets 500]
+"""
+import argparse
+import json
+import time
+from collections import defaultdict
+from hashlib import blake2b
+
+from benchmarks.fakes import FakeRedis
+from benchmarks.frames import synthetic_frames, zipf_weights
+from helpers.zerodha_helpers import decode_binary_ticks
+from utils.publisher import MarketDataUpdater
+
+
+class LegacyMarketDataUpdater:
+    # MarketDataUpdater before the last-value cache, kept as the benchmark baseline
+    def __init__(self, redis_client, threshold_ratio=0.66, publish_channel="TICK:CHANGES"):
+        self.redis = redis_client
+        self.threshold = int(15 * threshold_ratio)
+        self.hash_cache = defaultdict(dict)
+        self.initialized = set()
+        self.publish_channel = publish_channel
+
+    @staticmethod
+    def hash_field(value):
+        if isinstance(value, (dict, list)):
+            s = json.dumps(value, separators=(",", ":"), sort_keys=True)
+        else:
+            s = str(value)
+        return blake2b(s.encode(), digest_size=4).hexdigest()
+
+    def update_commands(self, pipe, symbol, new_data):
+        key = f"TICKS:{symbol}"
+        prev = self.hash_cache[symbol]
+        new_hashes = {}
+        changed = {}
+        for field, raw_val in new_data.items():
+            h = self.hash_field(raw_val)
+            new_hashes[field] = h
+            if prev.get(field) != h:
+                changed[field] = raw_val if field != "depth" else json.dumps(raw_val, separators=(",", ":"),
+                                                                             sort_keys=True)
+        cnt = len(changed)
+        is_new = symbol not in self.initialized
+        if is_new or cnt >= self.threshold:
+            pipe.hset(key, mapping={f: v if f != "depth" else json.dumps(v, separators=(",", ":"), sort_keys=True)
+                                    for f, v in new_data.items()})
+            self.hash_cache[symbol] = new_hashes.copy()
+            self.initialized.add(symbol)
+            update_type = "full"
+        elif cnt > 0:
+            pipe.hset(key, mapping=changed)
+            for f in changed:
+                prev[f] = new_hashes[f]
+            update_type = "partial"
+        else:
+            return {}, None
+        msg = {"symbol": symbol, "full_replace": update_type == "full"}
+        if update_type == "partial":
+            msg["changes"] = {k: v for k, v in changed.items() if k != "depth"}
+            if not msg["changes"]:
+                msg = {}
+        if msg:
+            pipe.publish(self.publish_channel, json.dumps(msg))
+        return changed, msg
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=400)
+    parser.add_argument("--packets", type=int, default=500)
+    args = parser.parse_args()
+
+    tokens = list(range(100000, 136000))
+    symbols = {token: f"CT:{token}" for token in tokens}
+    frames = synthetic_frames(args.frames, tokens, args.packets, weights=zipf_weights(len(tokens)))
+    batches = [decode_binary_ticks(frame) for frame in frames]
+    ticks = sum(len(batch) for batch in batches)
+
+    legacy_redis = FakeRedis()
+    legacy = LegacyMarketDataUpdater(legacy_redis)
+    start = time.process_time()
+    for batch in batches:
+        for tick in batch.to_dicts():
+            pipe = legacy_redis.pipeline()
+            legacy.update_commands(pipe, symbols[tick["token"]], {k: v for k, v in tick.items() if k != "token"})
+            pipe.execute()
+    legacy_cpu = time.process_time() - start
+
+    redis = FakeRedis()
+    updater = MarketDataUpdater(redis)
+    start = time.process_time()
+    for batch in batches:
+        updater.update_batch(batch, symbols).execute()
+    batch_cpu = time.process_time() - start
+
+    assert legacy_redis.hashes == redis.hashes
+    assert len(legacy_redis.published) == len(redis.published)
+    print(f"{ticks:,} ticks")
+    print(f"  legacy, pipeline per symbol  {legacy_cpu / ticks * 10000 * 1000:8.1f} ms CPU / 10k ticks "
+          f"({legacy_redis.executed:,} pipelines)")
+    print(f"  update_batch                 {batch_cpu / ticks * 10000 * 1000:8.1f} ms CPU / 10k ticks "
+          f"({redis.executed:,} pipelines)")
+
+
+if __name__ == "__main__":
+    main()
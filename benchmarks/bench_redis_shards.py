@@ -0,0 +1,123 @@
+"""
+Candle and tick write throughput through storage.redis_shards.RedisShards against local redis-server
+processes, one per shard, started on free ports (or --urls to use running instances). Also checks that
+every token's candles are read back from the shard shard_index() points readers at.
+
+    python -m benchmarks.bench_redis_shards [--shards 1,2,4] [--tokens 36000] [--minutes 5]
+                                            [--pipeline-size 1000] [--pool-size 32] [--urls redis://...]
+"""
+import argparse
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+import redis
+
+from storage.candle_codec import candle_key, encode_candle, fetch_many, minute_field
+from storage.redis_shards import RedisShards, shard_index
+from utils.metrics import REDIS_PIPELINE_COMMANDS, REDIS_PIPELINE_SECONDS
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_servers(count):
+    """(urls, processes, directory) of count throwaway redis-server processes."""
+    if shutil.which("redis-server") is None:
+        raise SystemExit("redis-server not found on PATH, pass --urls of running instances instead")
+    directory = tempfile.mkdtemp(prefix="bench-redis-")
+    urls, processes = [], []
+    for _ in range(count):
+        port = _free_port()
+        processes.append(subprocess.Popen(
+            ["redis-server", "--port", str(port), "--save", "", "--appendonly", "no", "--dir", directory],
+            stdout=subprocess.DEVNULL))
+        urls.append(f"redis://127.0.0.1:{port}/0")
+    for url in urls:
+        client = redis.from_url(url)
+        for _ in range(100):
+            try:
+                client.ping()
+                break
+            except redis.ConnectionError:
+                time.sleep(0.05)
+        client.close()
+    return urls, processes, directory
+
+
+def run(urls, tokens, minutes, pipeline_size, pool_size):
+    for url in urls:
+        redis.from_url(url).flushdb()
+    shards = RedisShards(urls, pool_size=pool_size, pipeline_size=pipeline_size)
+    names = [f"CT:{token}" for token in tokens]
+    start = time.perf_counter()
+    # One flush per minute on the candle lane, the way the candle writer submits them
+    for minute in range(28000000, 28000000 + minutes):
+        batch = shards.pipeline("candles")
+        for i, name in enumerate(names):
+            price = 100.0 + i % 50
+            batch.hset(candle_key(name), minute_field(minute),
+                       encode_candle(minute, price, price + 1, price - 1, price, price, 1000 + i, 0))
+        batch.execute()
+    elapsed = time.perf_counter() - start
+    shards.close()
+
+    readers = [redis.from_url(url) for url in urls]
+    by_shard = {}
+    for name in names:
+        by_shard.setdefault(shard_index(name, len(urls)), []).append(name)
+    found = 0
+    for shard, shard_names in by_shard.items():
+        found += sum(len(candles) == minutes for candles in fetch_many(readers[shard], shard_names).values())
+    spread = [readers[shard].dbsize() for shard in range(len(urls))]
+    return len(names) * minutes / elapsed, found == len(names), spread
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", default="1,2,4")
+    parser.add_argument("--tokens", type=int, default=36000)
+    parser.add_argument("--minutes", type=int, default=5)
+    parser.add_argument("--pipeline-size", type=int, default=1000)
+    parser.add_argument("--pool-size", type=int, default=32)
+    parser.add_argument("--urls", default="", help="comma separated, replaces the started servers")
+    args = parser.parse_args()
+
+    tokens = list(range(100000, 100000 + args.tokens))
+    if args.urls:
+        counts = [len(args.urls.split(","))]
+    else:
+        counts = [int(n) for n in args.shards.split(",")]
+    base = None
+    for count in counts:
+        processes, directory = [], None
+        if args.urls:
+            urls = args.urls.split(",")
+        else:
+            urls, processes, directory = start_servers(count)
+        try:
+            rate, complete, spread = run(urls, tokens, args.minutes, args.pipeline_size, args.pool_size)
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+            if directory:
+                shutil.rmtree(directory, ignore_errors=True)
+        base = base or rate
+        print(f"{count} shard(s): {rate:>12,.0f} candles/sec  ({rate / base:.2f}x)  "
+              f"keys per shard {spread}  read back {'ok' if complete else 'INCOMPLETE'}")
+    for name, labels, value in REDIS_PIPELINE_SECONDS.samples():
+        if name.endswith("_count"):
+            print(f"  {labels} pipelines: {value}")
+    for name, labels, value in REDIS_PIPELINE_COMMANDS.samples():
+        if name.endswith("_sum"):
+            print(f"  {labels} commands: {value:,.0f}")
+
+
+if __name__ == "__main__":
+    main()
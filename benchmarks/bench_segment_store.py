@@ -0,0 +1,61 @@
+"""
+Write a synthetic trading day into the segment store minute by minute (fsync per minute, as the
+flush does) and time the memory-mapped "all tokens for a minute" and "one token for the day" reads.
+
+    python -m benchmarks.bench_segment_store [--tokens 36000] [--minutes 375]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from storage.segment_store import SegmentStore, segment_day
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=36000)
+    parser.add_argument("--minutes", type=int, default=375)
+    args = parser.parse_args()
+
+    rng = random.Random(3)
+    tokens = [f"CT:{i}" for i in range(args.tokens)]
+    first_minute = 28661115
+    with tempfile.TemporaryDirectory() as root:
+        store = SegmentStore(root)
+        write_times = []
+        for m in range(args.minutes):
+            minute = first_minute + m
+            rows = [(token, minute, 100.0, 101.0, 99.0, 100.5, 100.2, m * 10, i)
+                    for i, token in enumerate(tokens) if rng.random() < 0.8]
+            start = time.perf_counter()
+            store.write(rows)
+            write_times.append(time.perf_counter() - start)
+        store.close()
+
+        day = segment_day(first_minute)
+        size = sum(os.path.getsize(os.path.join(root, day, name)) for name in os.listdir(os.path.join(root, day)))
+        reader = store.reader(day)
+        rows = sum(count for _, _, count in reader.blocks)
+
+        start = time.perf_counter()
+        candles = reader.minute(first_minute + args.minutes // 2)
+        minute_read = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for token in tokens[:100]:
+            history = reader.token(token)
+        token_read = (time.perf_counter() - start) / 100
+        reader.close()
+
+    write_times.sort()
+    print(f"{rows:,} candles, {size / rows:.1f} bytes/candle on disk")
+    print(f"  minute write+fsync  p50 {write_times[len(write_times) // 2] * 1000:.1f} ms  "
+          f"max {write_times[-1] * 1000:.1f} ms")
+    print(f"  all tokens for one minute  {minute_read * 1000:.1f} ms ({len(candles):,} candles)")
+    print(f"  one token for the day      {token_read * 1000:.2f} ms ({len(history)} candles)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Aggregate decode + aggregate throughput with the token universe split across N processes,
+the way ShardCoordinator splits connections. Each process replays its own synthetic frames.
+
+    python -m benchmarks.bench_sharding [--workers 1,2,4] [--frames 1000] [--packets 500]
+"""
+import argparse
+import multiprocessing
+import os
+import time
+
+from benchmarks.frames import synthetic_frames
+
+
+def _replay_shard(worker_id, worker_count, frames_count, packets, output):
+    from candle_engine import CandleEngine
+    from helpers.zerodha_helpers import decode_binary_ticks
+
+    tokens = list(range(100000, 136000))[worker_id::worker_count]
+    frames = synthetic_frames(frames_count // worker_count, tokens, packets, seed=worker_id)
+    engine = CandleEngine({token: token for token in tokens})
+    ticks = 0
+    start = time.perf_counter()
+    for frame in frames:
+        batch = decode_binary_ticks(frame)
+        engine.update(batch)
+        ticks += len(batch)
+        if ticks % 50000 < packets:
+            for buffer in engine.pop_closed(max(batch.timestamp) // 60):
+                engine.release(buffer)
+    output.put((ticks, time.perf_counter() - start))
+
+
+def run(worker_count, frames_count, packets):
+    context = multiprocessing.get_context("spawn")
+    output = context.Queue()
+    processes = [context.Process(target=_replay_shard, args=(i, worker_count, frames_count, packets, output))
+                 for i in range(worker_count)]
+    for process in processes:
+        process.start()
+    results = [output.get() for _ in processes]
+    for process in processes:
+        process.join()
+    ticks = sum(r[0] for r in results)
+    return ticks / max(r[1] for r in results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default=",".join(str(n) for n in (1, 2, 4) if n <= (os.cpu_count() or 1)))
+    parser.add_argument("--frames", type=int, default=1000)
+    parser.add_argument("--packets", type=int, default=500)
+    args = parser.parse_args()
+
+    base = None
+    for worker_count in [int(n) for n in args.workers.split(",")]:
+        rate = run(worker_count, args.frames, args.packets)
+        base = base or rate
+        print(f"{worker_count} workers: {rate:>12,.0f} ticks/sec  ({rate / base:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Latency of reading a token's latest tick from the shared-memory tick ring against a Redis HGET of the
+TICKS:{symbol} hash. The reader runs in its own process while the parent keeps writing frames, so
+sequence-lock retries are part of the measurement. The Redis side is skipped if it is unreachable.
+
+    python -m benchmarks.bench_tick_shm [--reads 100000] [--redis-url redis://localhost:6379/0]
+"""
+import argparse
+import multiprocessing
+import random
+import threading
+import time
+
+from benchmarks.frames import synthetic_frames
+from helpers.zerodha_helpers import decode_binary_ticks
+from utils.tick_shm import TickRingReader, TickRingWriter
+
+REGION = "bench_tick_ring"
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {p: samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1e6 for p in (50, 99, 99.9)}
+
+
+def _read_shm(tokens, reads, output):
+    reader = TickRingReader(REGION)
+    rng = random.Random(1)
+    clock = time.perf_counter
+    samples = []
+    for _ in range(reads):
+        token = rng.choice(tokens)
+        start = clock()
+        reader.latest(token)
+        samples.append(clock() - start)
+    reader.close()
+    output.put(samples)
+
+
+def _read_redis(url, symbols, reads):
+    import redis
+
+    client = redis.from_url(url)
+    client.ping()
+    pipe = client.pipeline(transaction=False)
+    for symbol in symbols:
+        pipe.hset(f"TICKS:{symbol}", mapping={"ltp": 100.0, "volume": 1, "oi": 1})
+    pipe.execute()
+    rng = random.Random(1)
+    clock = time.perf_counter
+    samples = []
+    for _ in range(reads):
+        symbol = rng.choice(symbols)
+        start = clock()
+        client.hget(f"TICKS:{symbol}", "ltp")
+        samples.append(clock() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=36000)
+    parser.add_argument("--reads", type=int, default=100000)
+    parser.add_argument("--redis-url", default="redis://localhost:6379/0")
+    args = parser.parse_args()
+
+    tokens = list(range(100000, 100000 + args.tokens))
+    mapping = {token: f"CT:{token}" for token in tokens}
+    writer = TickRingWriter(REGION, mapping)
+    batches = [decode_binary_ticks(frame) for frame in synthetic_frames(200, tokens, 500)]
+
+    start = time.perf_counter()
+    for batch in batches:
+        writer.write(batch)
+    elapsed = time.perf_counter() - start
+    ticks = sum(len(batch) for batch in batches)
+    print(f"write: {ticks / elapsed / 1e6:.2f}M ticks/s ({elapsed / ticks * 1e9:.0f} ns/tick)")
+
+    stop = threading.Event()
+
+    def keep_writing():
+        while not stop.is_set():
+            for batch in batches:
+                writer.write(batch)
+                if stop.is_set():
+                    break
+                time.sleep(0.001)
+
+    thread = threading.Thread(target=keep_writing, daemon=True)
+    thread.start()
+    context = multiprocessing.get_context("spawn")
+    output = context.Queue()
+    process = context.Process(target=_read_shm, args=(list(mapping.values()), args.reads, output))
+    process.start()
+    samples = output.get()
+    process.join()
+    stop.set()
+    thread.join()
+    writer.close()
+    p = percentiles(samples)
+    print(f"shm latest():  p50 {p[50]:.2f}us  p99 {p[99]:.2f}us  p99.9 {p[99.9]:.2f}us")
+
+    try:
+        samples = _read_redis(args.redis_url, list(mapping.values())[:1000], args.reads)
+    except Exception as e:
+        print(f"redis HGET: skipped ({e})")
+        return
+    p = percentiles(samples)
+    print(f"redis HGET:    p50 {p[50]:.2f}us  p99 {p[99]:.2f}us  p99.9 {p[99.9]:.2f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import threading
+import time
+
+
+class FakeClickHouseClient:
+    """In-process stand-in for a clickhouse_connect client: records inserts, optionally slow or failing."""
+
+    def __init__(self, insert_delay=0.0, fail_until=0.0):
+        self.insert_delay = insert_delay
+        self.fail_until = fail_until
+        self.rows = 0
+        self.batches = []
+        self.commands = []
+        self.lock = threading.Lock()
+
+    def command(self, sql):
+        self.commands.append(sql)
+
+    def insert(self, table, data, column_names, column_oriented=False):
+        if time.monotonic() < self.fail_until:
+            raise ConnectionError("fake ClickHouse unavailable")
+        time.sleep(self.insert_delay)
+        count = len(data[0]) if column_oriented else len(data)
+        with self.lock:
+            self.rows += count
+            self.batches.append(count)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        self.commands.append(("hset", key, field, value, mapping))
+        return self
+
+    def hgetall(self, key):
+        self.commands.append(("hgetall", key))
+        return self
+
+    def publish(self, channel, message):
+        self.commands.append(("publish", channel, message))
+        return self
+
+    def execute(self):
+        results = [self.redis.apply(command) for command in self.commands]
+        self.redis.executed += 1
+        self.redis.commands += len(self.commands)
+        self.commands = []
+        return results
+
+
+class FakeRedis:
+    """Just enough of redis.Redis for the flush and publish paths: hashes, publish and pipelines."""
+
+    def __init__(self):
+        self.hashes = {}
+        self.published = []
+        self.executed = 0
+        self.commands = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def apply(self, command):
+        if command[0] == "hset":
+            _, key, field, value, mapping = command
+            target = self.hashes.setdefault(key, {})
+            if mapping:
+                target.update(mapping)
+            if field is not None:
+                target[field] = value
+            return 1
+        if command[0] == "hgetall":
+            return dict(self.hashes.get(command[1], {}))
+        if command[0] == "publish":
+            self.published.append((command[1], command[2]))
+            return 1
+        raise ValueError(command[0])
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        return self.apply(("hset", key, field, value, mapping))
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hgetall(self, key):
+        return self.apply(("hgetall", key))
+
+    def publish(self, channel, message):
+        return self.apply(("publish", channel, message))
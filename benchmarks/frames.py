@@ -0,0 +1,86 @@
+import random
+import struct
+from itertools import accumulate
+
+# Full packet layouts, the inverse of helpers.zerodha_helpers._PACKET_STRUCTS
+_LTP = struct.Struct(">II")
+_INDEX_QUOTE = struct.Struct(">IIIIIII")
+_INDEX_FULL = struct.Struct(">IIIIIIII")
+_QUOTE = struct.Struct(">IIIIIIIIIII")
+_FULL_HEADER = struct.Struct(">IIIIIIIIIIIIIIII")
+_DEPTH_LEVEL = struct.Struct(">IIHxx")
+
+PACKET_LENGTHS = (8, 28, 32, 44, 184)
+
+
+def encode_packet(length, token, ltp, atp=0, volume=0, oi=0, timestamp=0, depth=None):
+    """
+    Encode one packet. Prices are raw integers (paise for most segments).
+    depth is an optional list of 10 (qty, price, orders) tuples, 5 bids then 5 asks.
+    """
+    if length == 8:
+        return _LTP.pack(token, ltp)
+    if length == 28:
+        return _INDEX_QUOTE.pack(token, ltp, ltp, ltp, ltp, ltp, 0)
+    if length == 32:
+        return _INDEX_FULL.pack(token, ltp, ltp, ltp, ltp, ltp, 0, timestamp)
+    if length == 44:
+        return _QUOTE.pack(token, ltp, 1, atp, volume, 0, 0, ltp, ltp, ltp, ltp)
+    if length == 184:
+        header = _FULL_HEADER.pack(token, ltp, 1, atp, volume, 0, 0, ltp, ltp, ltp, ltp,
+                                   timestamp, oi, oi, oi, timestamp)
+        if depth is None:
+            depth = [(0, 0, 0)] * 10
+        return header + b"".join(_DEPTH_LEVEL.pack(*level) for level in depth)
+    raise ValueError(f"Unknown packet length {length}")
+
+
+def build_frame(packets):
+    parts = [struct.pack(">H", len(packets))]
+    for packet in packets:
+        parts.append(struct.pack(">H", len(packet)))
+        parts.append(packet)
+    return b"".join(parts)
+
+
+def zipf_weights(count, exponent=1.1):
+    """Tick-rate weights where a few instruments (index options, futures) carry most of the flow."""
+    return [1.0 / (rank + 1) ** exponent for rank in range(count)]
+
+
+def synthetic_frames(number_of_frames, tokens, packets_per_frame, lengths=(184,), start_timestamp=1719805500,
+                     seed=7, weights=None, length_weights=None, depth=False):
+    """
+    Build frames with random ticks for the given tokens. lengths are picked per packet (uniformly unless
+    length_weights is given), so lengths=(184,) gives uniform full mode frames and PACKET_LENGTHS gives
+    mixed frames. With weights, tokens are drawn by tick rate instead of uniformly; a token still
+    appears at most once per frame, like the live feed. With depth, full packets carry 5 bid and ask
+    levels a few ticks either side of the price.
+    """
+    rng = random.Random(seed)
+    prices = {token: rng.randint(1000, 5000000) for token in tokens}
+    volumes = dict.fromkeys(tokens, 0)
+    frames = []
+    packets_per_frame = min(packets_per_frame, len(tokens))
+    cum_weights = list(accumulate(weights)) if weights is not None else None
+    for i in range(number_of_frames):
+        timestamp = start_timestamp + i // 4
+        packets = []
+        if weights is None:
+            chosen = rng.sample(tokens, packets_per_frame)
+        else:
+            chosen = list(dict.fromkeys(rng.choices(tokens, cum_weights=cum_weights, k=packets_per_frame * 2)))[:packets_per_frame]
+        for token in chosen:
+            price = max(1, prices[token] + rng.randint(-50, 50))
+            prices[token] = price
+            volumes[token] += rng.randint(1, 500)
+            length = rng.choices(lengths, length_weights)[0] if length_weights else rng.choice(lengths)
+            levels = None
+            if depth:
+                spread = rng.randint(1, 10)
+                levels = ([(rng.randint(1, 5000), max(1, price - spread - 5 * k), rng.randint(1, 50)) for k in range(5)]
+                          + [(rng.randint(1, 5000), price + spread + 5 * k, rng.randint(1, 50)) for k in range(5)])
+            packets.append(encode_packet(length, token, price, price, volumes[token], token % 100000, timestamp,
+                                         levels))
+        frames.append(build_frame(packets))
+    return frames
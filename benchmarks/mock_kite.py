@@ -0,0 +1,356 @@
+"""
+Local stand-in for the Kite ticker WebSocket (wss://ws.kite.trade) to soak the ingester offline.
+
+Speaks the same protocol: a connection needs api_key and access_token query parameters (any value),
+{"a": "subscribe" | "unsubscribe", "v": [tokens]} and {"a": "mode", "v": [mode, [tokens]]} messages set
+what is streamed, and binary frames carry the packets of the subscribed tokens in their mode (ltp 8,
+quote 44, full 184 bytes; 8/28/32 for indices), built with the benchmarks.frames layouts. Tokens
+subscribed without a mode stream in quote mode, a mode message subscribes the tokens it names (the
+ingester only ever sends mode). A quiet connection gets the 1 byte heartbeat every
+second, text messages are JSON ({"type": "order" | "error", "data": ...}), and more than --max-tokens
+subscriptions on one connection is answered with an error message.
+
+Each token ticks at --rate per second (or its rate in a saved tick profile, see --profile) times
+--multiplier, appearing at most once per frame like the live feed. Every --burst-every seconds the
+whole feed runs --burst-multiplier times faster for --burst-seconds. --drop-every drops a random
+connection on that interval, SIGUSR1 drops all of them; both abort the TCP connection, so the client
+sees an abnormal close like a network failure.
+
+    python -m benchmarks.mock_kite [--port 8765] [--processes 1] [--rate 1.0] [--multiplier 1.0]
+                                   [--profile tick_profile.json] [--burst-every 0 --burst-seconds 5
+                                   --burst-multiplier 3] [--drop-every 0] [--text-every 0]
+
+and point the ingester at it with KITE_WS_URL=ws://127.0.0.1:8765.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import signal
+import struct
+import time
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+from benchmarks.frames import encode_packet
+from token_placement import load_profile
+
+INDEX_SEGMENT = 9
+MODE_LENGTHS = {"ltp": (8, 8), "quote": (44, 28), "full": (184, 32)}
+HEARTBEAT = b"\x00"
+_UINT32 = struct.Struct(">I")
+_UINT16 = struct.Struct(">H")
+
+
+class TokenFeed:
+    """One token's packet, updated in place each tick. Offsets include the 2 byte length prefix."""
+    __slots__ = ("packet", "length", "ltp", "volume", "step")
+
+    def __init__(self, token, mode, rng):
+        self.ltp = rng.randint(1000, 5000000)
+        self.volume = 0
+        self.step = rng.randrange(4096)
+        self.set_mode(token, mode)
+
+    def set_mode(self, token, mode):
+        self.length = MODE_LENGTHS[mode][1 if token & 0xff == INDEX_SEGMENT else 0]
+        depth = None
+        if self.length == 184:
+            depth = ([(100, max(1, self.ltp - 5 * (k + 1)), 5) for k in range(5)]
+                     + [(100, self.ltp + 5 * (k + 1), 5) for k in range(5)])
+        self.packet = bytearray(_UINT16.pack(self.length)
+                                + encode_packet(self.length, token, self.ltp, self.ltp, 0, 1000, 0, depth))
+
+    def tick(self, steps, timestamp):
+        self.step = (self.step + 1) & 4095
+        step = steps[self.step]
+        self.ltp = max(1, self.ltp + step)
+        self.volume += abs(step) + 1
+        packet, pack = self.packet, _UINT32.pack_into
+        pack(packet, 6, self.ltp)
+        length = self.length
+        if length == 184:
+            pack(packet, 14, self.ltp)
+            pack(packet, 18, self.volume)
+            pack(packet, 46, timestamp)
+            pack(packet, 62, timestamp)
+        elif length == 44:
+            pack(packet, 14, self.ltp)
+            pack(packet, 18, self.volume)
+        elif length == 32:
+            pack(packet, 30, timestamp)
+        return bytes(packet)
+
+
+class MockConnection:
+    def __init__(self, server, connection):
+        self.server = server
+        self.connection = connection
+        self.feeds = {}
+        self.tokens = []
+        self.cum_rates = []
+        self.carry = 0.0
+        self.rng = random.Random(id(self))
+
+    def _reweight(self):
+        self.tokens = list(self.feeds)
+        total, cum_rates = 0.0, []
+        for token in self.tokens:
+            total += self.server.rate_for(token)
+            cum_rates.append(total)
+        self.cum_rates = cum_rates
+
+    async def handle_message(self, message):
+        if isinstance(message, bytes):
+            # The ingester pings with a binary "ping", Kite ignores client binary messages
+            return
+        try:
+            request = json.loads(message)
+            action, value = request["a"], request["v"]
+        except (ValueError, KeyError, TypeError):
+            await self.send_text("error", "Invalid message")
+            return
+        if action == "subscribe":
+            if not await self.subscribe(value, "quote"):
+                return
+        elif action == "unsubscribe":
+            for token in value:
+                self.feeds.pop(token, None)
+        elif action == "mode":
+            mode, tokens = value
+            if mode not in MODE_LENGTHS:
+                await self.send_text("error", f"Invalid mode {mode}")
+                return
+            if not await self.subscribe(tokens, mode):
+                return
+            for token in tokens:
+                self.feeds[token].set_mode(token, mode)
+        else:
+            await self.send_text("error", f"Unknown action {action}")
+            return
+        self._reweight()
+
+    async def subscribe(self, tokens, mode):
+        added = [token for token in dict.fromkeys(tokens) if token not in self.feeds]
+        if len(self.feeds) + len(added) > self.server.max_tokens:
+            await self.send_text("error", f"Maximum of {self.server.max_tokens} instruments per connection")
+            return False
+        for token in added:
+            self.feeds[token] = TokenFeed(token, mode, self.rng)
+        return True
+
+    async def send_text(self, kind, data):
+        await self.connection.send(json.dumps({"type": kind, "data": data}))
+
+    def frames(self, seconds, multiplier):
+        """Frames of the ticks due in the next seconds, each token at most once per frame."""
+        if not self.tokens:
+            return []
+        expected = self.cum_rates[-1] * seconds * multiplier + self.carry
+        count = int(expected)
+        self.carry = expected - count
+        if not count:
+            return []
+        picks = self.rng.choices(self.tokens, cum_weights=self.cum_rates, k=count)
+        timestamp = int(time.time())
+        steps = self.server.steps
+        max_packets = self.server.max_packets
+        # A token picked n times goes into n consecutive frames
+        rounds = [[]]
+        seen = {}
+        for token in picks:
+            n = seen.get(token, 0)
+            seen[token] = n + 1
+            if n == len(rounds):
+                rounds.append([])
+            rounds[n].append(self.feeds[token].tick(steps, timestamp))
+        frames = []
+        for packets in rounds:
+            for start in range(0, len(packets), max_packets):
+                chunk = packets[start:start + max_packets]
+                frames.append(_UINT16.pack(len(chunk)) + b"".join(chunk))
+        self.server.ticks_sent += count
+        return frames
+
+    async def stream(self):
+        loop = asyncio.get_running_loop()
+        interval = self.server.frame_interval
+        next_at = loop.time()
+        quiet_since = next_at
+        while True:
+            next_at += interval
+            frames = self.frames(interval, self.server.multiplier_now())
+            for frame in frames:
+                await self.connection.send(frame)
+            self.server.frames_sent += len(frames)
+            now = loop.time()
+            if frames:
+                quiet_since = now
+            elif now - quiet_since >= 1.0:
+                await self.connection.send(HEARTBEAT)
+                quiet_since = now
+            behind = now - next_at
+            if behind > 0:
+                self.server.max_behind = max(self.server.max_behind, behind)
+                if behind > 5 * interval:
+                    # Too far behind to catch up, skip the rounds rather than bursting them out
+                    next_at = now
+            await asyncio.sleep(max(0.0, next_at - now))
+
+
+class MockKiteServer:
+    def __init__(self, rate=1.0, multiplier=1.0, rates=None, frame_interval=0.25, max_tokens=3000,
+                 max_packets=500, burst_every=0.0, burst_seconds=5.0, burst_multiplier=3.0, seed=7):
+        self.rate = rate
+        self.multiplier = multiplier
+        self.rates = rates or {}
+        self.frame_interval = frame_interval
+        self.max_tokens = max_tokens
+        self.max_packets = max_packets
+        self.burst_every = burst_every
+        self.burst_seconds = burst_seconds
+        self.burst_multiplier = burst_multiplier
+        rng = random.Random(seed)
+        self.steps = [rng.randint(-50, 50) for _ in range(4096)]
+        self.connections = set()
+        self.ticks_sent = 0
+        self.frames_sent = 0
+        self.max_behind = 0.0
+
+    def rate_for(self, token):
+        return self.rates.get(token, self.rate) * self.multiplier
+
+    def multiplier_now(self):
+        if self.burst_every and time.time() % self.burst_every < self.burst_seconds:
+            return self.burst_multiplier
+        return 1.0
+
+    def process_request(self, connection, request):
+        params = parse_qs(urlsplit(request.path).query)
+        if not params.get("api_key") or not params.get("access_token"):
+            return connection.respond(HTTPStatus.FORBIDDEN, "api_key and access_token are required\n")
+        return None
+
+    async def handler(self, connection):
+        mock = MockConnection(self, connection)
+        self.connections.add(mock)
+        streamer = asyncio.create_task(mock.stream())
+        try:
+            async for message in connection:
+                await mock.handle_message(message)
+        except ConnectionClosed:
+            pass
+        finally:
+            self.connections.discard(mock)
+            streamer.cancel()
+            await asyncio.gather(streamer, return_exceptions=True)
+
+    def drop(self, count=None):
+        """Abort count random connections, all of them by default."""
+        victims = list(self.connections)
+        if count is not None:
+            victims = random.sample(victims, min(count, len(victims)))
+        for mock in victims:
+            mock.connection.transport.abort()
+        return len(victims)
+
+    async def send_texts(self, every):
+        while True:
+            await asyncio.sleep(every)
+            for mock in list(self.connections):
+                try:
+                    await mock.send_text("order", {"order_id": str(random.getrandbits(48)), "status": "COMPLETE"})
+                except ConnectionClosed:
+                    pass
+
+    async def drop_periodically(self, every):
+        while True:
+            await asyncio.sleep(every)
+            if self.drop(1):
+                print(f"[mock {os.getpid()}] dropped a connection")
+
+    async def report(self, every=10.0):
+        last_ticks, last = 0, time.monotonic()
+        while True:
+            await asyncio.sleep(every)
+            now = time.monotonic()
+            rate = (self.ticks_sent - last_ticks) / (now - last)
+            print(f"[mock {os.getpid()}] {len(self.connections)} connections, {rate:,.0f} ticks/sec, "
+                  f"{sum(len(mock.tokens) for mock in self.connections)} tokens, "
+                  f"most behind schedule {self.max_behind * 1000:.0f} ms")
+            last_ticks, last = self.ticks_sent, now
+            self.max_behind = 0.0
+
+    async def serve(self, host, port, drop_every=0.0, text_every=0.0, reuse_port=False):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGUSR1, lambda: print(f"[mock {os.getpid()}] dropped {self.drop()}"))
+        tasks = [asyncio.create_task(self.report())]
+        if drop_every:
+            tasks.append(asyncio.create_task(self.drop_periodically(drop_every)))
+        if text_every:
+            tasks.append(asyncio.create_task(self.send_texts(text_every)))
+        async with serve(self.handler, host, port, process_request=self.process_request, reuse_port=reuse_port,
+                         compression=None, max_size=2 ** 20):
+            print(f"[mock {os.getpid()}] Kite mock on ws://{host}:{port}")
+            await asyncio.gather(*tasks)
+
+
+def _serve_process(args, rates):
+    server = MockKiteServer(rate=args.rate, multiplier=args.multiplier, rates=rates,
+                            frame_interval=args.frame_interval, max_tokens=args.max_tokens,
+                            max_packets=args.max_packets, burst_every=args.burst_every,
+                            burst_seconds=args.burst_seconds, burst_multiplier=args.burst_multiplier,
+                            seed=args.seed + os.getpid())
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.drop_every, args.text_every,
+                                 reuse_port=args.processes > 1))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--processes", type=int, default=1, help="server processes sharing the port")
+    parser.add_argument("--rate", type=float, default=1.0, help="ticks/sec per token without a profile rate")
+    parser.add_argument("--multiplier", type=float, default=1.0, help="scales every token's rate")
+    parser.add_argument("--profile", default="", help="tick profile with per-token rates")
+    parser.add_argument("--frame-interval", type=float, default=0.25)
+    parser.add_argument("--max-tokens", type=int, default=3000)
+    parser.add_argument("--max-packets", type=int, default=500)
+    parser.add_argument("--burst-every", type=float, default=0.0)
+    parser.add_argument("--burst-seconds", type=float, default=5.0)
+    parser.add_argument("--burst-multiplier", type=float, default=3.0)
+    parser.add_argument("--drop-every", type=float, default=0.0)
+    parser.add_argument("--text-every", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rates = load_profile(args.profile) if args.profile else {}
+    if rates:
+        print(f"Tick rates of {len(rates)} tokens from {args.profile}")
+    if args.processes <= 1:
+        _serve_process(args, rates)
+        return
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_serve_process, args=(args, rates)) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    # SIGUSR1 to the parent drops the connections of every server process
+    signal.signal(signal.SIGUSR1, lambda *_: [os.kill(process.pid, signal.SIGUSR1) for process in processes])
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
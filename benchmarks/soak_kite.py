@@ -0,0 +1,151 @@
+"""
+Soak the ingester's receive path against benchmarks.mock_kite: connections x tokens subscribed in full
+mode, ticks decoded and aggregated into candles exactly as in production (frame queue and workers
+included, FRAME_WORKERS), candles and ticks not written anywhere so no Redis is needed. Reports the
+ingested tick rate, the CPU the ingester spent on it and from that the headroom left on its core.
+
+    python -m benchmarks.soak_kite [--connections 36] [--tokens-per-connection 3000] [--rate 1.0]
+                                   [--multiplier 3] [--seconds 60] [--server-processes 1]
+                                   [--frame-workers 0] [--drop-every 0] [--burst-every 0] [--url ws://...]
+
+Without --url the mock is started on a free port with the given rate options. On a small machine the
+mock competes with the ingester for CPU, run it elsewhere (--url) for clean numbers.
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from helpers.zerodha_helpers import EXCHANGE_MAP
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _counter_total(metric):
+    return sum(metric.values.values())
+
+
+def _quantile(histogram, q):
+    """Upper bucket bound below which a q share of all observations fall, over every label set."""
+    counts = [0] * (len(histogram.buckets) + 1)
+    for bucket_counts, _, _ in histogram.values.values():
+        counts = [a + b for a, b in zip(counts, bucket_counts)]
+    total = sum(counts)
+    if not total:
+        return 0.0
+    cumulative = 0
+    for bound, count in zip(histogram.buckets + (float("inf"),), counts):
+        cumulative += count
+        if cumulative >= q * total:
+            return bound
+    return float("inf")
+
+
+def start_mock(args):
+    port = _free_port()
+    command = [sys.executable, "-m", "benchmarks.mock_kite", "--port", str(port),
+               "--processes", str(args.server_processes), "--rate", str(args.rate),
+               "--multiplier", str(args.multiplier), "--drop-every", str(args.drop_every),
+               "--burst-every", str(args.burst_every)]
+    if args.profile:
+        command += ["--profile", args.profile]
+    process = subprocess.Popen(command)
+    for _ in range(200):
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return f"ws://127.0.0.1:{port}", process
+        time.sleep(0.05)
+    process.terminate()
+    raise SystemExit("Kite mock did not start")
+
+
+async def soak(args):
+    # Read when main is imported
+    os.environ["FRAME_WORKERS"] = str(args.frame_workers)
+    import main
+    from accounts import AccountDirectory
+    from utils.metrics import (CONNECTION_RECONNECTS, FRAME_PROCESS_DELAY, FRAME_QUEUE_DEPTH, LOOP_LAG,
+                               LOOP_LAG_LAST, RECEIVE_LAG, TICKS, monitor_event_loop_lag)
+
+    count = args.connections * args.tokens_per_connection
+    tokens = [(i << 8) | EXCHANGE_MAP["nfo"] for i in range(1, count + 1)]
+    mapping = {token: f"CT:{token}" for token in tokens}
+    # Any credentials do for the mock, one account per connection keeps the plan at exactly --connections
+    names = [f"SOAK{i}" for i in range(args.connections)]
+    main.account_directory = AccountDirectory(None, names)
+    main.account_directory.accounts = {name: {"api_key": "soak", "access_token": "soak"} for name in names}
+    plan = main.plan_connections(names, tokens, token_limit_per_connection=args.tokens_per_connection,
+                                 connection_per_account=1)
+
+    main.init_candle_engine(mapping)
+    main.init_frame_workers()
+    tasks = [asyncio.create_task(monitor_event_loop_lag()), asyncio.create_task(main.run_connections(plan))]
+
+    start = time.monotonic()
+    cpu_start = time.process_time()
+    last, last_cpu, last_ticks = start, cpu_start, 0
+    try:
+        while time.monotonic() - start < args.seconds:
+            await asyncio.sleep(args.report_every)
+            now, cpu, ticks = time.monotonic(), time.process_time(), _counter_total(TICKS)
+            print(f"{now - start:6.0f}s  {(ticks - last_ticks) / (now - last):>10,.0f} ticks/sec  "
+                  f"cpu {(cpu - last_cpu) / (now - last):5.0%}  loop lag {LOOP_LAG_LAST.values.get((), 0.0) * 1000:6.1f} ms  "
+                  f"queue {_counter_total(FRAME_QUEUE_DEPTH):>6}")
+            last, last_cpu, last_ticks = now, cpu, ticks
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    elapsed = time.monotonic() - start
+    ticks = _counter_total(TICKS)
+    cpu = (time.process_time() - cpu_start) / elapsed
+    rate = ticks / elapsed
+    print(f"\n{len(plan)} connections x {args.tokens_per_connection} tokens, {elapsed:.0f}s")
+    print(f"ingested        {rate:,.0f} ticks/sec")
+    print(f"ingester cpu    {cpu:.0%} of a core"
+          + (f", headroom ~{1 / cpu:.1f}x ({rate / cpu:,.0f} ticks/sec at a full core)" if cpu else ""))
+    print(f"receive lag p99 <= {_quantile(RECEIVE_LAG, 0.99):.3f}s, "
+          f"event loop lag p99 <= {_quantile(LOOP_LAG, 0.99):.3f}s"
+          + (f", frame delay p99 <= {_quantile(FRAME_PROCESS_DELAY, 0.99):.3f}s" if args.frame_workers else ""))
+    print(f"reconnects      {_counter_total(CONNECTION_RECONNECTS)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=36)
+    parser.add_argument("--tokens-per-connection", type=int, default=3000)
+    parser.add_argument("--rate", type=float, default=1.0, help="ticks/sec per token at 1x")
+    parser.add_argument("--multiplier", type=float, default=3.0)
+    parser.add_argument("--profile", default="", help="tick profile with per-token rates for the mock")
+    parser.add_argument("--seconds", type=float, default=60.0)
+    parser.add_argument("--report-every", type=float, default=5.0)
+    parser.add_argument("--server-processes", type=int, default=1)
+    parser.add_argument("--frame-workers", type=int, default=0)
+    parser.add_argument("--drop-every", type=float, default=0.0)
+    parser.add_argument("--burst-every", type=float, default=0.0)
+    parser.add_argument("--url", default="", help="a running mock, instead of starting one")
+    args = parser.parse_args()
+
+    process = None
+    url = args.url
+    if not url:
+        url, process = start_mock(args)
+    os.environ["KITE_WS_URL"] = url
+    try:
+        asyncio.run(soak(args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
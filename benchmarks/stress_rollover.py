@@ -0,0 +1,106 @@
+"""
+Ingest synthetic frames at full speed across several minute boundaries while the rollover runs
+on the event loop and a deliberately slow writer flushes on its own thread, then check every tick
+landed in exactly one written candle.
+
+    python -m benchmarks.stress_rollover [--frames 4000] [--packets 500] [--write-delay 0.05]
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.frames import synthetic_frames
+from candle_engine import CandleEngine, CandleWriter
+from helpers.zerodha_helpers import decode_binary_ticks, parse_binary_ticks
+
+
+def reference_candles(frames):
+    candles = {}
+    for frame in frames:
+        for tick in parse_binary_ticks(frame):
+            key = (tick["token"], tick["timestamp"] // 60)
+            ltp = tick["ltp"]
+            candle = candles.get(key)
+            if candle is None:
+                candles[key] = [ltp, ltp, ltp, ltp, 1]
+            else:
+                candle[1] = max(candle[1], ltp)
+                candle[2] = min(candle[2], ltp)
+                candle[3] = ltp
+                candle[4] += 1
+    return candles
+
+
+async def ingest(engine, writer, frames):
+    latest_minute = 0
+    done = False
+    rollovers = 0
+
+    async def roll():
+        nonlocal rollovers
+        while not done:
+            closed = engine.pop_closed(latest_minute)
+            if closed:
+                rollovers += 1
+                writer.submit(closed)
+            await asyncio.sleep(0.001)
+
+    roller = asyncio.create_task(roll())
+    for frame in frames:
+        batch = decode_binary_ticks(frame)
+        engine.update(batch)
+        latest_minute = max(latest_minute, max(batch.timestamp) // 60)
+        await asyncio.sleep(0)
+    done = True
+    await roller
+    writer.submit(engine.pop_closed(latest_minute + 1))
+    return rollovers
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=4000)
+    parser.add_argument("--packets", type=int, default=500)
+    parser.add_argument("--write-delay", type=float, default=0.05)
+    args = parser.parse_args()
+
+    tokens = list(range(100000, 136000))
+    # Start 10 seconds before a minute boundary, 4 frames per exchange second
+    frames = synthetic_frames(args.frames, tokens, args.packets, start_timestamp=1719805790)
+    expected = reference_candles(frames)
+
+    engine = CandleEngine({token: token for token in tokens})
+    written = {}
+    duplicates = []
+
+    def write(buffers):
+        time.sleep(args.write_delay)
+        for buffer in buffers:
+            for slot, o, h, l, c, atp, volume, oi in buffer.candles():
+                key = (engine.names[slot], buffer.minute)
+                if key in written:
+                    duplicates.append(key)
+                written[key] = [o, h, l, c, buffer.ticks[slot]]
+
+    writer = CandleWriter(engine, write)
+    start = time.perf_counter()
+    rollovers = asyncio.run(ingest(engine, writer, frames))
+    writer.close()
+    elapsed = time.perf_counter() - start
+
+    total_ticks = sum(candle[4] for candle in expected.values())
+    written_ticks = sum(candle[4] for candle in written.values())
+    minutes = len({minute for _, minute in expected})
+    print(f"{total_ticks:,} ticks over {minutes} minutes in {elapsed:.2f}s "
+          f"({total_ticks / elapsed:,.0f} ticks/sec), {rollovers} rollovers, "
+          f"{len(engine.free)} buffers allocated")
+    print(f"written ticks {written_ticks:,}, candles {len(written):,}/{len(expected):,}, "
+          f"duplicates {len(duplicates)}")
+    assert not duplicates, duplicates[:10]
+    assert written_ticks == total_ticks
+    assert written == expected
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
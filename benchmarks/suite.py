@@ -0,0 +1,192 @@
+"""
+End-to-end hot path benchmark: decode -> aggregate -> flush -> publish on synthetic Kite frames.
+
+Frames mix 8/32/44/184 byte packets (mostly full mode) over 36k tokens with a skewed tick-rate
+distribution and cross several minute boundaries. Flush and publish write to an in-process fake Redis.
+Reports ticks/sec, p50/p99 per-frame latency and peak memory per stage plus flush duration per minute.
+Memory is measured in a second pass under tracemalloc (which would distort the timings): the most any
+single call of the stage allocated above what was live when it started.
+
+    python -m benchmarks.suite                              # print results
+    python -m benchmarks.suite --save-baseline base.json    # store them
+    python -m benchmarks.suite --compare base.json          # exit 1 if a metric regressed
+"""
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+import ohlc_handler
+from benchmarks.fakes import FakeRedis
+from benchmarks.frames import synthetic_frames, zipf_weights
+from helpers.zerodha_helpers import decode_binary_ticks
+from utils.publisher import MarketDataUpdater
+
+STAGES = ("decode", "aggregate", "flush", "publish")
+# Metric name -> True if higher is better
+METRICS = {"ticks_per_sec": True, "p50_ms": False, "p99_ms": False, "max_ms": False, "peak_mb": False}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(latencies, ticks, peak_bytes):
+    total = sum(latencies)
+    return {
+        "ticks_per_sec": ticks / total if total else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": max(latencies, default=0.0) * 1000,
+        "peak_mb": peak_bytes / 2 ** 20,
+    }
+
+
+def build_frames(args):
+    tokens = list(range(100000, 100000 + args.tokens))
+    frames = synthetic_frames(args.frames, tokens, args.packets, lengths=(8, 32, 44, 184),
+                              length_weights=(1, 1, 3, 15), weights=zipf_weights(len(tokens)),
+                              start_timestamp=1719805790)
+    return tokens, frames
+
+
+def run_pass(tokens, frames, traced=False):
+    """Drive every frame through the stages, returns (latencies, peak bytes, ticks, candles) per stage."""
+    fake_redis = FakeRedis()
+    ohlc_handler.REDIS_DATA_STORE = fake_redis
+    symbols = {token: f"CT:{token}" for token in tokens}
+    ohlc_handler.init_candle_engine(symbols, write=lambda buffers: None)
+    engine = ohlc_handler.candle_engine
+    updater = MarketDataUpdater(fake_redis)
+
+    latencies = {stage: [] for stage in STAGES}
+    peaks = dict.fromkeys(STAGES, 0)
+
+    def begin():
+        if not traced:
+            return 0
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    def end(stage, live):
+        if traced:
+            peaks[stage] = max(peaks[stage], tracemalloc.get_traced_memory()[1] - live)
+
+    candles = 0
+    ticks = 0
+    current_minute = None
+    clock = time.perf_counter
+    for frame in frames:
+        live = begin()
+        start = clock()
+        batch = decode_binary_ticks(frame)
+        latencies["decode"].append(clock() - start)
+        end("decode", live)
+        live = begin()
+        start = clock()
+        engine.update(batch)
+        latencies["aggregate"].append(clock() - start)
+        end("aggregate", live)
+        live = begin()
+        start = clock()
+        # As main.publish_ticks, straight from the decoded columns
+        updater.update_batch(batch, symbols).execute()
+        latencies["publish"].append(clock() - start)
+        end("publish", live)
+        ticks += len(batch)
+
+        minute = max(batch.timestamp) // 60
+        if current_minute is not None and minute > current_minute:
+            live = begin()
+            start = clock()
+            buffers = engine.pop_closed(minute)
+            rows = ohlc_handler.candle_rows(buffers)
+            if rows:
+                ohlc_handler.save_rows_to_redis(rows)
+            for buffer in buffers:
+                engine.release(buffer)
+            latencies["flush"].append(clock() - start)
+            end("flush", live)
+            candles += len(rows)
+        current_minute = minute
+    return latencies, peaks, ticks, candles
+
+
+def run(args):
+    tokens, frames = build_frames(args)
+    latencies, _, ticks, candles = run_pass(tokens, frames)
+    tracemalloc.start()
+    try:
+        _, peaks, _, _ = run_pass(tokens, frames, traced=True)
+    finally:
+        tracemalloc.stop()
+
+    results = {stage: summarize(latencies[stage], ticks, peaks[stage]) for stage in STAGES if stage != "flush"}
+    flush = summarize(latencies["flush"], candles, peaks["flush"])
+    flush["candles"] = candles
+    flush["minutes"] = len(latencies["flush"])
+    results["flush"] = flush
+    results["total"] = {"ticks": ticks, "frames": len(frames)}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for stage in STAGES:
+        for metric, higher_is_better in METRICS.items():
+            old = baseline.get(stage, {}).get(metric)
+            new = results.get(stage, {}).get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            if worse > tolerance:
+                regressions.append(f"{stage}.{metric}: {old:,.3f} -> {new:,.3f} ({change:+.1%})")
+    return regressions
+
+
+def print_results(results):
+    print(f"{results['total']['frames']:,} frames, {results['total']['ticks']:,} ticks, "
+          f"{results['flush']['minutes']} minute flushes, {results['flush']['candles']:,} candles")
+    print(f"{'stage':<10}{'ticks/sec':>14}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'peak MB':>10}")
+    for stage in STAGES:
+        r = results[stage]
+        rate = f"{r['ticks_per_sec']:,.0f}" if stage != "flush" else f"{r['ticks_per_sec']:,.0f}*"
+        print(f"{stage:<10}{rate:>14}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['max_ms']:>10.3f}"
+              f"{r['peak_mb']:>10.2f}")
+    print("* flush rate is candles/sec, latencies are per minute flush")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=36000)
+    parser.add_argument("--frames", type=int, default=2400)
+    parser.add_argument("--packets", type=int, default=500)
+    parser.add_argument("--save-baseline")
+    parser.add_argument("--compare")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+
+    results = run(args)
+    print_results(results)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == "__main__":
+    main()
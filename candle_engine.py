@@ -0,0 +1,601 @@
+import threading
+import time
+from array import array
+from queue import Queue
+
+NAN = float("nan")
+INF = float("inf")
+# Entries per row in a TickBatch's MarketDepth arrays, and where the best ask starts
+DEPTH_WIDTH = 10
+BEST_ASK = 5
+
+
+class CandleBuffer:
+    """
+    One minute of 1m candles for every slot, held in preallocated arrays indexed by slot.
+    open/close are NaN until the slot sees a price. touched lists the slots written this minute
+    so closing and recycling the minute only walks instruments that actually ticked. An amendment
+    buffer (late ticks on a finalized minute) is flagged so writers can tell it from a first close.
+    With depth, the minute also accumulates top-of-book spread and imbalance weighted by the seconds
+    each quote was in effect (quoted), and keeps the minute's last quote for minutes without elapsed time.
+    """
+    __slots__ = ("minute", "open", "high", "low", "close", "atp", "volume", "oi", "ticks", "touched", "seen",
+                 "written", "amendment", "spread_time", "imbalance_time", "quoted", "spread_last", "imbalance_last")
+
+    def __init__(self, size, minute=0, depth=False):
+        self.minute = minute
+        self.open = array("d", [NAN]) * size
+        self.high = array("d", [-INF]) * size
+        self.low = array("d", [INF]) * size
+        self.close = array("d", [NAN]) * size
+        self.atp = array("d", [0.0]) * size
+        self.volume = array("q", [0]) * size
+        self.oi = array("q", [0]) * size
+        self.ticks = array("q", [0]) * size
+        self.touched = []
+        self.seen = bytearray(size)
+        # Set by the writer thread once the buffer's candles are stored
+        self.written = False
+        self.amendment = False
+        if depth:
+            self.spread_time = array("d", [0.0]) * size
+            self.imbalance_time = array("d", [0.0]) * size
+            self.quoted = array("d", [0.0]) * size
+            self.spread_last = array("d", [NAN]) * size
+            self.imbalance_last = array("d", [0.0]) * size
+        else:
+            self.spread_time = None
+
+    def grow(self, count):
+        """Add count empty slots at the end, for instruments subscribed while running."""
+        for name, value in (("open", NAN), ("high", -INF), ("low", INF), ("close", NAN), ("atp", 0.0),
+                            ("volume", 0), ("oi", 0), ("ticks", 0)):
+            getattr(self, name).extend([value] * count)
+        self.seen.extend(bytes(count))
+        if self.spread_time is not None:
+            for name, value in (("spread_time", 0.0), ("imbalance_time", 0.0), ("quoted", 0.0),
+                                ("spread_last", NAN), ("imbalance_last", 0.0)):
+                getattr(self, name).extend([value] * count)
+
+    def reset(self):
+        if self.spread_time is not None:
+            for slot in self.touched:
+                self.spread_time[slot] = 0.0
+                self.imbalance_time[slot] = 0.0
+                self.quoted[slot] = 0.0
+                self.spread_last[slot] = NAN
+                self.imbalance_last[slot] = 0.0
+        for slot in self.touched:
+            self.open[slot] = NAN
+            self.high[slot] = -INF
+            self.low[slot] = INF
+            self.close[slot] = NAN
+            self.atp[slot] = 0.0
+            self.volume[slot] = 0
+            self.oi[slot] = 0
+            self.ticks[slot] = 0
+            self.seen[slot] = 0
+        self.touched = []
+        self.written = False
+        self.amendment = False
+
+    def merge_earlier(self, earlier):
+        """
+        Complete this buffer's slots with an earlier buffer of the same minute (an amendment on top of
+        the finalized candle): the earlier open and close are kept, high/low widen, and atp/volume/oi
+        come from whichever saw the higher running volume.
+        """
+        for slot in self.touched:
+            if not earlier.seen[slot]:
+                continue
+            o = earlier.open[slot]
+            if o == o:
+                self.open[slot] = o
+                self.close[slot] = earlier.close[slot]
+                if earlier.high[slot] > self.high[slot]:
+                    self.high[slot] = earlier.high[slot]
+                if earlier.low[slot] < self.low[slot]:
+                    self.low[slot] = earlier.low[slot]
+            if earlier.volume[slot] >= self.volume[slot]:
+                self.atp[slot] = earlier.atp[slot] or self.atp[slot]
+                self.volume[slot] = earlier.volume[slot]
+                self.oi[slot] = earlier.oi[slot] or self.oi[slot]
+            self.ticks[slot] += earlier.ticks[slot]
+
+    def candles(self):
+        """Yield (slot, open, high, low, close, atp, volume, oi) for touched slots that saw a price."""
+        for slot in self.touched:
+            o = self.open[slot]
+            if o != o:
+                continue
+            yield (slot, o, self.high[slot], self.low[slot], self.close[slot],
+                   self.atp[slot], self.volume[slot], self.oi[slot])
+
+    def depth_candles(self):
+        """Yield (slot, time-weighted spread, time-weighted imbalance) for touched slots that were quoted."""
+        if self.spread_time is None:
+            return
+        for slot in self.touched:
+            quoted = self.quoted[slot]
+            if quoted:
+                yield slot, self.spread_time[slot] / quoted, self.imbalance_time[slot] / quoted
+            elif self.spread_last[slot] == self.spread_last[slot]:
+                yield slot, self.spread_last[slot], self.imbalance_last[slot]
+
+    @staticmethod
+    def bytes_per_slot(depth=False):
+        # 8 numeric columns of 8 bytes, the seen flag and a list pointer in touched, 5 more with depth
+        return 8 * 8 + 1 + 8 + (5 * 8 if depth else 0)
+
+
+class CandleEngine:
+    """
+    Dense, slot-indexed candle state. Every subscribed broker token is given a slot at startup (or by
+    add_tokens when subscribed later) and the slot doubles as the broker token -> Cirrus token translation.
+
+    finalize() closes minutes. A tick for a minute that is already finalized is late: within
+    amend_window minutes it goes into an amendment buffer that the next finalize() merges with the
+    finalized candles and hands out again, older late ticks are dropped. Finalized buffers are kept
+    for the amend window and recycled on the loop thread once the writer has marked them written.
+
+    With depth, batches decoded with market depth also feed per-minute spread/imbalance aggregates.
+    The last top of book of every slot is kept across minutes, so a quote is weighted from the time it
+    arrived (or the start of the minute) until the next one; the tail of a minute after its last quote
+    is not counted. Late ticks do not amend depth.
+    """
+
+    def __init__(self, broker_to_cirrus_mapping, amend_window=0, depth=False):
+        self.slots = {}
+        self.names = []
+        for broker_token, cirrus_token in broker_to_cirrus_mapping.items():
+            self.slots[broker_token] = len(self.names)
+            self.names.append(cirrus_token)
+        self.size = len(self.names)
+        self.slots_by_name = {name: slot for slot, name in enumerate(self.names)}
+        self.buffers = {}
+        # Recycled buffers, only touched on the loop thread
+        self.free = []
+        self.amend_window = amend_window
+        self.finalized = None
+        # minute -> finalized buffers of that minute, the original and any amendments, oldest first
+        self.retained = {}
+        self.amendments = {}
+        self.late_amended = 0
+        self.late_dropped = 0
+        self.depth = depth
+        if depth:
+            # Top of book in effect per slot: since when (exchange seconds), spread and imbalance
+            self.quote_at = array("I", [0]) * self.size
+            self.quote_spread = array("d", [0.0]) * self.size
+            self.quote_imbalance = array("d", [0.0]) * self.size
+
+    def add_tokens(self, broker_to_cirrus_mapping):
+        """
+        Give broker tokens subscribed while running a slot each, after the existing ones, and grow every
+        buffer to match. Returns how many were added. Must run on the same thread as update().
+        """
+        added = [(broker_token, cirrus_token) for broker_token, cirrus_token in broker_to_cirrus_mapping.items()
+                 if broker_token not in self.slots]
+        if not added:
+            return 0
+        for broker_token, cirrus_token in added:
+            self.slots[broker_token] = self.slots_by_name[cirrus_token] = len(self.names)
+            self.names.append(cirrus_token)
+        self.size = len(self.names)
+        buffers = {id(buffer): buffer for buffer in [*self.buffers.values(), *self.amendments.values(), *self.free,
+                                                      *(buffer for kept in self.retained.values() for buffer in kept)]}
+        for buffer in buffers.values():
+            buffer.grow(len(added))
+        if self.depth:
+            self.quote_at.extend([0] * len(added))
+            self.quote_spread.extend([0.0] * len(added))
+            self.quote_imbalance.extend([0.0] * len(added))
+        return len(added)
+
+    def rename(self, broker_token, cirrus_token):
+        """Point a broker token's slot at another Cirrus token, from the candles still to be written on."""
+        slot = self.slots.get(broker_token)
+        if slot is None:
+            return
+        self.slots_by_name.pop(self.names[slot], None)
+        self.names[slot] = cirrus_token
+        self.slots_by_name[cirrus_token] = slot
+
+    def buffer_for(self, minute):
+        buffer = self.buffers.get(minute)
+        if buffer is None:
+            buffer = self.free.pop() if self.free else CandleBuffer(self.size, depth=self.depth)
+            buffer.minute = minute
+            self.buffers[minute] = buffer
+        return buffer
+
+    def amendment_for(self, minute):
+        buffer = self.amendments.get(minute)
+        if buffer is None:
+            buffer = self.free.pop() if self.free else CandleBuffer(self.size, depth=self.depth)
+            buffer.minute = minute
+            buffer.amendment = True
+            self.amendments[minute] = buffer
+        return buffer
+
+    def release(self, buffer):
+        retained = self.retained.get(buffer.minute)
+        if retained is not None and buffer in retained:
+            retained.remove(buffer)
+            if not retained:
+                del self.retained[buffer.minute]
+        buffer.reset()
+        self.free.append(buffer)
+
+    @staticmethod
+    def mark_written(buffers):
+        """Called by the writer thread after storing buffers."""
+        for buffer in buffers:
+            buffer.written = True
+
+    def update(self, batch):
+        """Fold a decoded TickBatch into the candles of the minute each tick's exchange timestamp falls in."""
+        slots = self.slots
+        tokens, ltps, atps = batch.token, batch.ltp, batch.atp
+        volumes, ois, timestamps = batch.volume, batch.oi, batch.timestamp
+        finalized = -1 if self.finalized is None else self.finalized
+        amendable = finalized - self.amend_window
+        current_minute = None
+        buffer = None
+        for i in range(len(tokens)):
+            slot = slots.get(tokens[i])
+            if slot is None:
+                continue
+            timestamp = timestamps[i]
+            if not timestamp:
+                continue
+            ltp, atp, volume, oi = ltps[i], atps[i], volumes[i], ois[i]
+            if ltp == 0 and atp == 0 and volume == 0 and oi == 0:
+                continue
+
+            minute = timestamp // 60
+            if minute != current_minute:
+                current_minute = minute
+                if minute > finalized:
+                    buffer = self.buffer_for(minute)
+                elif minute > amendable:
+                    buffer = self.amendment_for(minute)
+                else:
+                    buffer = None
+            if minute <= finalized:
+                if buffer is None:
+                    self.late_dropped += 1
+                    continue
+                self.late_amended += 1
+
+            if not buffer.seen[slot]:
+                buffer.seen[slot] = 1
+                buffer.touched.append(slot)
+            if ltp > 0:
+                o = buffer.open[slot]
+                if o != o:
+                    buffer.open[slot] = ltp
+                if ltp > buffer.high[slot]:
+                    buffer.high[slot] = ltp
+                if ltp < buffer.low[slot]:
+                    buffer.low[slot] = ltp
+                buffer.close[slot] = ltp
+            if atp > 0:
+                buffer.atp[slot] = atp
+            if volume > 0:
+                buffer.volume[slot] = volume
+            if oi > 0:
+                buffer.oi[slot] = oi
+            buffer.ticks[slot] += 1
+        if self.depth and batch.depth is not None:
+            self.update_depth(batch)
+
+    def update_depth(self, batch):
+        slots = self.slots
+        tokens, timestamps = batch.token, batch.timestamp
+        prices, quantities, divisors = batch.depth.price, batch.depth.qty, batch.depth.divisor
+        quote_at, quote_spread, quote_imbalance = self.quote_at, self.quote_spread, self.quote_imbalance
+        finalized = -1 if self.finalized is None else self.finalized
+        current_minute = None
+        buffer = None
+        level = 0
+        for i in range(len(tokens)):
+            top = level
+            level += DEPTH_WIDTH
+            bid, ask = prices[top], prices[top + BEST_ASK]
+            if bid <= 0 or ask <= 0:
+                continue
+            slot = slots.get(tokens[i])
+            if slot is None:
+                continue
+            timestamp = timestamps[i]
+            last = quote_at[slot]
+            if not timestamp or timestamp < last:
+                continue
+            minute = timestamp // 60
+            if minute <= finalized:
+                continue
+            if minute != current_minute:
+                current_minute = minute
+                buffer = self.buffer_for(minute)
+            if last:
+                start = minute * 60
+                elapsed = timestamp - (last if last > start else start)
+                if elapsed > 0:
+                    buffer.spread_time[slot] += quote_spread[slot] * elapsed
+                    buffer.imbalance_time[slot] += quote_imbalance[slot] * elapsed
+                    buffer.quoted[slot] += elapsed
+            bid_quantity, ask_quantity = quantities[top], quantities[top + BEST_ASK]
+            spread = (ask - bid) / divisors[i]
+            total = bid_quantity + ask_quantity
+            imbalance = (bid_quantity - ask_quantity) / total if total else 0.0
+            quote_at[slot] = timestamp
+            quote_spread[slot] = spread
+            quote_imbalance[slot] = imbalance
+            buffer.spread_last[slot] = spread
+            buffer.imbalance_last[slot] = imbalance
+            if not buffer.seen[slot]:
+                buffer.seen[slot] = 1
+                buffer.touched.append(slot)
+
+    def restore(self, minute, candles):
+        """
+        Load a checkpointed open minute, (broker token, open, high, low, close, atp, volume, oi, ticks)
+        per token. Ticks received afterwards merge into the restored candles. Returns how many loaded.
+        """
+        buffer = self.buffer_for(minute)
+        restored = 0
+        for broker_token, o, h, l, c, atp, volume, oi, ticks in candles:
+            slot = self.slots.get(broker_token)
+            if slot is None:
+                continue
+            if not buffer.seen[slot]:
+                buffer.seen[slot] = 1
+                buffer.touched.append(slot)
+            buffer.open[slot], buffer.high[slot], buffer.low[slot], buffer.close[slot] = o, h, l, c
+            buffer.atp[slot], buffer.volume[slot], buffer.oi[slot] = atp, volume, oi
+            buffer.ticks[slot] = ticks
+            restored += 1
+        return restored
+
+    def finalize(self, through_minute):
+        """
+        Close every minute up to and including through_minute (epoch minutes) and return
+        (closed buffers, amendment buffers), oldest first. Amendment buffers come back merged with
+        what was finalized before, so they hold complete candles for the slots they touch.
+        Must run on the same thread as update(), the swap is then atomic with respect to ingestion.
+        """
+        closed = [self.buffers.pop(minute) for minute in sorted(self.buffers) if minute <= through_minute]
+        if self.finalized is None or through_minute > self.finalized:
+            self.finalized = through_minute
+        amended = []
+        for minute in sorted(self.amendments):
+            buffer = self.amendments.pop(minute)
+            for earlier in self.retained.get(minute, ()):
+                buffer.merge_earlier(earlier)
+            amended.append(buffer)
+        for buffer in closed + amended:
+            self.retained.setdefault(buffer.minute, []).append(buffer)
+        self.recycle()
+        return closed, amended
+
+    def recycle(self):
+        """Release retained buffers that can no longer be amended and have been written."""
+        if self.finalized is None:
+            return
+        for minute in sorted(self.retained):
+            if minute > self.finalized - self.amend_window:
+                break
+            buffers = self.retained[minute]
+            if all(buffer.written for buffer in buffers):
+                for buffer in list(buffers):
+                    self.release(buffer)
+
+    def pop_closed(self, current_minute):
+        """Finalize minutes before current_minute and return closed and amendment buffers together."""
+        closed, amended = self.finalize(current_minute - 1)
+        return closed + amended
+
+    def live_candles(self, name):
+        """(minute, open, high, low, close, atp, volume, oi) of a token's still open minutes, oldest first."""
+        slot = self.slots_by_name.get(name)
+        if slot is None:
+            return []
+        candles = []
+        for minute in sorted(self.buffers):
+            buffer = self.buffers[minute]
+            o = buffer.open[slot]
+            if o == o:
+                candles.append((minute, o, buffer.high[slot], buffer.low[slot], buffer.close[slot],
+                                buffer.atp[slot], buffer.volume[slot], buffer.oi[slot]))
+        return candles
+
+    def memory_report(self):
+        per_instrument = CandleBuffer.bytes_per_slot(self.depth)
+        return {
+            "instruments": self.size,
+            "bytes_per_instrument": per_instrument,
+            "bytes_per_minute_buffer": per_instrument * self.size,
+        }
+
+
+def parse_timeframe(name, session_minutes):
+    """Length in minutes of a rollup timeframe such as 5m, 15m, 60m, 1h or day (the whole session)."""
+    if name == "day":
+        return session_minutes
+    if name.endswith("h"):
+        return int(name[:-1]) * 60
+    return int(name.rstrip("m"))
+
+
+class CandleRollup:
+    """
+    Higher timeframe candles folded from closed 1m candle rows, keyed by token.
+    Periods are anchored at the session open in local time and the last one is cut at the session
+    close (so 60m gives 09:15-10:15 ... 15:15-15:30); minutes outside the session are not rolled up.
+    volume and oi are running values in the 1m candles, so the period keeps the last one like close.
+    Rows are (token, period start epoch minute, open, high, low, close, atp, volume, oi), the same
+    shape as 1m rows. One writer folds; peek() may run on another thread, lock guards candles for it.
+    """
+
+    def __init__(self, name, session_open=9 * 60 + 15, session_close=15 * 60 + 30):
+        self.name = name
+        self.session_open = session_open
+        self.session_close = session_close
+        self.minutes = parse_timeframe(name, session_close - session_open)
+        # token -> [period start, period end, open, high, low, close, atp, volume, oi]
+        self.candles = {}
+        self.late_rows = 0
+        self.lock = threading.RLock()
+
+    def period(self, minute):
+        """(start, end) epoch minutes of the period a 1m candle belongs to, or None outside the session."""
+        local = time.localtime(minute * 60)
+        minute_of_day = local.tm_hour * 60 + local.tm_min
+        if not self.session_open <= minute_of_day < self.session_close:
+            return None
+        day_start = minute - minute_of_day
+        start = self.session_open + (minute_of_day - self.session_open) // self.minutes * self.minutes
+        return day_start + start, day_start + min(start + self.minutes, self.session_close)
+
+    def fold(self, rows):
+        """Fold 1m rows in and return the rows of every period that closed, oldest first."""
+        by_minute = {}
+        for row in rows:
+            by_minute.setdefault(row[1], []).append(row)
+        closed = []
+        candles = self.candles
+        for minute in sorted(by_minute):
+            period = self.period(minute)
+            if period is None:
+                continue
+            start, end = period
+            # Held a minute at a time, a peek waits for one minute's rows at most
+            with self.lock:
+                for token, _, o, h, l, c, atp, volume, oi in by_minute[minute]:
+                    candle = candles.get(token)
+                    if candle is not None and candle[0] != start:
+                        if candle[0] > start:
+                            # The period this minute belongs to was already written
+                            self.late_rows += 1
+                            continue
+                        closed.append(self._row(token, candles.pop(token)))
+                        candle = None
+                    if candle is None:
+                        candles[token] = [start, end, o, h, l, c, atp, volume, oi]
+                        continue
+                    if h > candle[3]:
+                        candle[3] = h
+                    if l < candle[4]:
+                        candle[4] = l
+                    candle[5] = c
+                    if atp > 0:
+                        candle[6] = atp
+                    if volume > 0:
+                        candle[7] = volume
+                    if oi > 0:
+                        candle[8] = oi
+                closed.extend(self.close_until(minute + 1))
+        return closed
+
+    def amend(self, rows):
+        """
+        Apply amended 1m rows (late ticks on minutes already folded). A period that is still open only
+        widens its high/low, its close and running values come from later minutes; a period that already
+        closed is not reopened, its stored row stands and the amendment is counted in late_rows.
+        """
+        with self.lock:
+            candles = self.candles
+            for token, minute, o, h, l, c, atp, volume, oi in rows:
+                period = self.period(minute)
+                if period is None:
+                    continue
+                candle = candles.get(token)
+                if candle is None or candle[0] != period[0]:
+                    self.late_rows += 1
+                    continue
+                if h > candle[3]:
+                    candle[3] = h
+                if l < candle[4]:
+                    candle[4] = l
+
+    def peek(self, token, candles):
+        """
+        The token's open period candles with still-forming 1m candles (minute, o, h, l, c, atp, volume, oi)
+        folded on top, oldest first, without changing any state.
+        """
+        with self.lock:
+            current = self.candles.get(token)
+            current = list(current) if current is not None else None
+        periods = {}
+        if current is not None:
+            periods[current[0]] = current
+        for minute, o, h, l, c, atp, volume, oi in candles:
+            period = self.period(minute)
+            if period is None:
+                continue
+            candle = periods.get(period[0])
+            if candle is None:
+                periods[period[0]] = [period[0], period[1], o, h, l, c, atp, volume, oi]
+                continue
+            candle[3] = max(candle[3], h)
+            candle[4] = min(candle[4], l)
+            candle[5] = c
+            candle[6] = atp or candle[6]
+            candle[7] = volume or candle[7]
+            candle[8] = oi or candle[8]
+        return [(start,) + tuple(periods[start][2:]) for start in sorted(periods)]
+
+    def close_until(self, minute):
+        """Remove and return the rows of periods that end at or before epoch minute."""
+        with self.lock:
+            ended = [token for token, candle in self.candles.items() if candle[1] <= minute]
+            return [self._row(token, self.candles.pop(token)) for token in ended]
+
+    @staticmethod
+    def _row(token, candle):
+        return (token, candle[0]) + tuple(candle[2:])
+
+
+class CandleWriter:
+    """
+    Background thread that writes closed minute buffers and marks them written for the engine to reuse.
+    Ingestion never waits on it, and finalized buffers are only read afterwards (to merge amendments).
+    finalized(through_minute), if given, is called after the buffers of each finalization are written,
+    also for a finalization that closed nothing.
+    """
+
+    def __init__(self, engine, write, finalized=None):
+        self.engine = engine
+        self.write = write
+        self.finalized = finalized
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._run, name="candle-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, buffers, through_minute=None):
+        self.queue.put((buffers, through_minute))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            buffers, through_minute = item
+            if buffers:
+                try:
+                    self.write(buffers)
+                except Exception as e:
+                    print(f"Error writing candles: {e}")
+                finally:
+                    # The engine recycles them on its own thread once they are out of the amend window
+                    self.engine.mark_written(buffers)
+            if through_minute is not None and self.finalized is not None:
+                try:
+                    self.finalized(through_minute)
+                except Exception as e:
+                    print(f"Error reporting finalized candles: {e}")
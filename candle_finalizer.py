@@ -0,0 +1,93 @@
+"""
+Minute finalization driven by exchange time instead of a wall-clock timer.
+
+Every connection advances a watermark, the newest exchange timestamp it has delivered. Minute m is
+finalized once the slowest live connection is past its end by the grace window, so ticks still in
+flight on a lagging socket land in the candle rather than after it. A connection that has gone quiet
+(a reconnect gap, an idle segment) stops holding the watermark back after stale_after seconds, and the
+local clock closes a minute regardless max_delay seconds after the grace window if no data arrives.
+
+Deadlines are slept against the event loop's monotonic clock, a wall-clock step (NTP) cannot make a
+flush fire twice or be skipped.
+"""
+import asyncio
+import time
+
+from utils.metrics import FINALIZE_LAG, WATERMARK_LAG
+
+
+class Watermarks:
+    def __init__(self, stale_after=5.0, clock=time.monotonic):
+        self.stale_after = stale_after
+        # A replay passes its simulated clock
+        self.clock = clock
+        # connection -> [newest exchange timestamp, clock time it last advanced]
+        self.marks = {}
+
+    def advance(self, connection, timestamp):
+        mark = self.marks.get(connection)
+        if mark is None:
+            self.marks[connection] = [timestamp, self.clock()]
+        elif timestamp > mark[0]:
+            mark[0] = timestamp
+            mark[1] = self.clock()
+
+    def value(self):
+        """Lowest watermark of the connections that advanced recently, None when none did."""
+        cutoff = self.clock() - self.stale_after
+        live = [timestamp for timestamp, advanced in self.marks.values() if advanced >= cutoff]
+        if live:
+            return min(live)
+        # Every connection is quiet, the furthest one still says how far the exchange got
+        return max((timestamp for timestamp, _ in self.marks.values()), default=None)
+
+
+class CandleFinalizer:
+    """
+    finalize(through_minute) is called on the event loop with the last epoch minute to close, at most
+    once per minute boundary and always with an increasing minute.
+    """
+
+    def __init__(self, finalize, watermarks, grace=2.0, max_delay=10.0, poll_interval=0.2):
+        self.finalize = finalize
+        self.watermarks = watermarks
+        self.grace = grace
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.finalized = None
+
+    def due(self, now):
+        """Last minute that may be finalized at wall time now."""
+        by_clock = int(now - self.grace - self.max_delay) // 60 - 1
+        watermark = self.watermarks.value()
+        if watermark is None:
+            return by_clock
+        WATERMARK_LAG.set(max(0.0, now - watermark))
+        # An exchange clock running ahead of ours must not close a minute we are still receiving
+        by_watermark = int(min(watermark, now) - self.grace) // 60 - 1
+        return max(by_clock, by_watermark)
+
+    async def step(self, now):
+        """Finalize what is due at wall time now, returns what finalize returned (None if nothing was due)."""
+        if self.finalized is None:
+            self.finalized = int(now) // 60 - 1
+        through = self.due(now)
+        if through <= self.finalized:
+            return None
+        result = None
+        try:
+            result = await self.finalize(through)
+        except Exception as e:
+            print(f"Error finalizing candles through {through}: {e}")
+        self.finalized = through
+        FINALIZE_LAG.observe(max(0.0, now - (through + 1) * 60))
+        return result
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        # Wall time is read once and then advanced with the monotonic clock
+        offset = time.time() - loop.time()
+        while True:
+            await self.step(offset + loop.time())
+            # Polled, the watermark moves with every frame and the check is a handful of comparisons
+            await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,80 @@
+"""
+Lifecycle of one broker WebSocket connection.
+
+A ConnectionSupervisor runs a session coroutine in a loop: when the session ends, for whatever reason,
+the reason is logged and the session is started again after a jittered exponential backoff. The
+backoff only grows while sessions keep failing quickly; a session that stayed up for stable_after
+seconds starts the next attempt from base_delay again.
+
+A gap is the time from a session ending to the first frame of the next one.
+"""
+import asyncio
+import random
+import time
+
+from utils.metrics import CONNECTION_GAP, CONNECTION_RECONNECTS, CONNECTION_UP
+
+
+class ConnectionSupervisor:
+    def __init__(self, connection_id, account, run_session, tokens=(), base_delay=0.5, max_delay=30.0,
+                 stable_after=60.0):
+        self.connection_id = connection_id
+        self.account = account
+        # Current subscription, rebalancing edits it so a reconnect subscribes what the socket last carried
+        self.tokens = list(tokens)
+        # Open socket while a session is connected
+        self.socket = None
+        # run_session(supervisor) connects, subscribes and returns (or raises) when the socket is gone
+        self.run_session = run_session
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stable_after = stable_after
+        self.labels = (account, str(connection_id))
+        self.attempts = 0
+        self.reconnects = 0
+        self.gap_started = None
+        self.receiving = False
+        self.last_gap = None
+
+    def next_delay(self, session_seconds):
+        if session_seconds >= self.stable_after:
+            self.attempts = 0
+        delay = min(self.max_delay, self.base_delay * 2 ** self.attempts)
+        self.attempts += 1
+        # Half fixed, half random: reconnects of many sockets dropped together spread out
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def frame_received(self):
+        """Called by the session for every frame; closes an open gap on the first one."""
+        if self.receiving:
+            return
+        self.receiving = True
+        CONNECTION_UP.set(1, self.labels)
+        if self.gap_started is not None:
+            self.last_gap = time.monotonic() - self.gap_started
+            self.gap_started = None
+            CONNECTION_GAP.observe(self.last_gap, self.labels[1:])
+            print(f"Connection {self.connection_id} ({self.account}) receiving again after {self.last_gap:.2f}s")
+
+    async def run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.run_session(self)
+                reason = "session ended"
+            except asyncio.CancelledError:
+                CONNECTION_UP.set(0, self.labels)
+                raise
+            except Exception as e:
+                reason = f"{type(e).__name__}: {e}"
+            ended = time.monotonic()
+            if self.receiving or self.gap_started is None:
+                self.gap_started = ended
+            self.receiving = False
+            self.reconnects += 1
+            CONNECTION_UP.set(0, self.labels)
+            CONNECTION_RECONNECTS.inc(1, self.labels)
+            delay = self.next_delay(ended - started)
+            print(f"Connection {self.connection_id} ({self.account}) lost after {ended - started:.1f}s ({reason}), "
+                  f"reconnecting in {delay:.2f}s")
+            await asyncio.sleep(delay)
@@ -11,6 +11,9 @@ redis_port = os.environ.get('REDIS_PORT', '6379')
 redis_password = os.environ.get('REDIS_PASSWORD', None)
 redis_db_no = os.environ.get('REDIS_DB_NO', 0)
 candle_redis_uri = os.environ.get('CANDLE_REDIS_URL')
+# CANDLE_REDIS_SHARDS=redis://a:6379/0,redis://b:6379/0 spreads the per-token keys over several instances
+candle_redis_shard_uris = [uri.strip() for uri in os.environ.get('CANDLE_REDIS_SHARDS', '').split(',')
+                           if uri.strip()] or [uri for uri in (candle_redis_uri,) if uri]
 
 try:
     REDIS_DB_CLIENT = redis.Redis(host=redis_host, port=int(redis_port), password=redis_password,
@@ -22,10 +25,18 @@ except Exception as e:
     logging.error(f"Error connecting to Redis DB: {e}")
 
 
+REDIS_DATA_STORE = None
 try:
     REDIS_DATA_STORE = redis.from_url(candle_redis_uri)
     if not REDIS_DATA_STORE.ping():
         raise ConnectionError("Failed to connect to Redis data store")
     logging.info("Connected to Redis data store successfully")
 except Exception as e:
-    logging.error(f"Error connecting to Redis DB: {e}")
\ No newline at end of file
+    logging.error(f"Error connecting to Redis DB: {e}")
+
+# Readers of sharded keys, see storage.redis_shards.shard_index
+REDIS_DATA_SHARDS = []
+try:
+    REDIS_DATA_SHARDS = [redis.from_url(uri) for uri in candle_redis_shard_uris]
+except Exception as e:
+    logging.error(f"Error creating Redis shard clients: {e}")
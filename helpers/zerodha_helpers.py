@@ -1,6 +1,10 @@
 import json
 import logging
 import struct
+import sys
+from array import array
+from itertools import repeat
+from operator import truediv
 
 import six
 
@@ -20,38 +24,72 @@ EXCHANGE_MAP = {
 }
 
 
-def fetch_all_tokens_for_zerodha(all_keys_list=None):
+def instrument_token(value):
+    """Broker token of a CT:* instrument document, or None if it should not be subscribed."""
+    if value['exchange'] == '' or value['exchange'] == '-' or value['instrument'] == '' or value[
+        'instrument'] == '-':
+        return None
+    instrument = value['instrument']
+    if instrument == "OPTCUR" or instrument == "FUTCUR":
+        return None
+    broker_avail = value['broker_avail']
+    if 'Z' not in broker_avail:
+        return None
+    return int(value['zerodha_token'])
+
+
+def scan_instrument_keys(client, patterns, count=5000):
+    """Stream keys matching any of the patterns with SCAN, never blocking Redis like KEYS does."""
+    seen = set()
+    for pattern in patterns:
+        for key in client.scan_iter(match=pattern, count=count):
+            # SCAN may return a key more than once while the keyspace is rehashing
+            if key in seen:
+                continue
+            seen.add(key)
+            yield key.decode('utf-8')
+
+
+def fetch_all_tokens_for_zerodha(all_keys_list=None, client=None, chunk_size=1000, pipeline_depth=8):
+    """
+    Load the subscribable instruments as (broker token list, broker token -> CT key mapping).
+    Keys are streamed with SCAN and their documents fetched with one JSON.MGET per chunk_size keys,
+    pipeline_depth chunks per round trip, so fetching overlaps with scanning and no single command is huge.
+    """
     if all_keys_list is None:
         all_keys_list = ["CT:*"]
-    all_keys = []
-    for keys_to_fetch in all_keys_list:
-        keys = REDIS_DB_CLIENT.keys(keys_to_fetch)
-        keys = [key.decode('utf-8') for key in keys]
-        all_keys.extend(keys)
-
-    data = REDIS_DB_CLIENT.json().mget(all_keys, path='.')
-    keys_data = {}
-    for key, result in zip(all_keys, data):
-        if result is None:
-            continue
-        keys_data[key] = result
+    if client is None:
+        client = REDIS_DB_CLIENT
 
     symbol_list, symbol_dict = [], {}
-    for key, value in keys_data.items():
-        if value['exchange'] == '' or value['exchange'] == '-' or value['instrument'] == '' or value[
-            'instrument'] == '-':
-            continue
-        instrument = value['instrument']
-        if instrument == "OPTCUR" or instrument == "FUTCUR":
-            continue
-        broker_avail = value['broker_avail']
-        if 'Z' not in broker_avail:
-            continue
 
-        token = value['zerodha_token']
-        token = int(token)
-        symbol_list.append(token)
-        symbol_dict[token] = key
+    def fetch(chunks):
+        pipe = client.json().pipeline(transaction=False)
+        for keys in chunks:
+            pipe.mget(keys, '.')
+        for keys, data in zip(chunks, pipe.execute()):
+            for key, value in zip(keys, data):
+                if value is None:
+                    continue
+                token = instrument_token(value)
+                if token is None:
+                    continue
+                symbol_list.append(token)
+                symbol_dict[token] = key
+
+    chunks, keys = [], []
+    for key in scan_instrument_keys(client, all_keys_list):
+        keys.append(key)
+        if len(keys) == chunk_size:
+            chunks.append(keys)
+            keys = []
+            if len(chunks) == pipeline_depth:
+                fetch(chunks)
+                chunks = []
+    if keys:
+        chunks.append(keys)
+    if chunks:
+        fetch(chunks)
     print("LENGTH OF SYMBOL LIST", len(symbol_list))
     return symbol_list, symbol_dict
 
@@ -67,107 +105,252 @@ def parse_text_message(payload):
     logging.info(f"ZERODHA MESSAGE: {data}")
 
 
-def parse_binary_ticks(bin):
-    packets = _split_packets(bin)
-    data = []
-
-    for packet in packets:
-        token = _unpack_int(packet, 0, 4)
-        segment = token & 0xff
-
-        if segment == EXCHANGE_MAP["cds"]:
-            divisor = 10000000.0
-        elif segment == EXCHANGE_MAP["bcd"]:
-            divisor = 10000.0
-        else:
-            divisor = 100.0
-
-        if len(packet) == 8:
-            data.append({
-                "token": token,
-                "ltp": _unpack_int(packet, 4, 8) / divisor
-            })
-        elif len(packet) == 28 or len(packet) == 32:
-            d = {
-                "token": token,
-                 "ltp": _unpack_int(packet, 4, 8) / divisor,
-                #  "high": _unpack_int(packet, 8, 12) / divisor,
-                #  "low": _unpack_int(packet, 12, 16) / divisor,
-                #  "open": _unpack_int(packet, 16, 20) / divisor,
-                #  "prev_close": _unpack_int(packet, 20, 24) / divisor
-            }
-
-            if len(packet) == 32:
-                try:
-                    timestamp = _unpack_int(packet, 28, 32)
-                except Exception:
-                    timestamp = None
-                d["timestamp"] = timestamp
-            data.append(d)
+DEPTH_LEVELS = 5
+
+
+class MarketDepth:
+    """
+    Depth of every row of a TickBatch in fixed-shape arrays of 2 * DEPTH_LEVELS entries per row, row-major:
+    the bid levels (best first) then the ask levels, so row ``i``'s best bid is at ``i * 10`` and its
+    best ask at ``i * 10 + 5``. Prices are the raw integers from the feed, divide by the row's divisor
+    for rupees. Rows of packets without depth (anything but full mode) are 0.
+    """
+    __slots__ = ("price", "qty", "orders", "divisor")
+    width = 2 * DEPTH_LEVELS
+
+    def __init__(self):
+        self.price = array("I")
+        self.qty = array("I")
+        self.orders = array("H")
+        self.divisor = array("d")
+
+    def _extend(self, levels, divisors):
+        """levels is the raw depth section (10 x quantity u32, price u32, orders u16, 2 pad bytes) of every row."""
+        words = array("I", levels)
+        halves = array("H", levels)
+        if _LITTLE_ENDIAN:
+            words.byteswap()
+            halves.byteswap()
+        self.qty.extend(words[0::3])
+        self.price.extend(words[1::3])
+        # orders is the first half of every third word
+        self.orders.extend(halves[4::6])
+        self.divisor.extend(divisors)
+
+    def _pad(self, count):
+        for name in ("price", "qty", "orders"):
+            column = getattr(self, name)
+            column.frombytes(bytes(column.itemsize * count * self.width))
+        self.divisor.extend(repeat(1.0, count))
+
+    def select(self, rows):
+        depth = MarketDepth()
+        width = self.width
+        for name in ("price", "qty", "orders"):
+            column = getattr(self, name)
+            getattr(depth, name).extend([value for i in rows for value in column[i * width:(i + 1) * width]])
+        depth.divisor.extend([self.divisor[i] for i in rows])
+        return depth
+
+
+class TickBatch:
+    """
+    Columnar view of one decoded frame. Row ``i`` of every column belongs to the same packet;
+    fields a packet does not carry (e.g. ``oi`` on a quote packet) are 0. depth is a MarketDepth
+    when the frame was decoded with depth, None otherwise.
+    """
+    __slots__ = ("token", "ltp", "atp", "volume", "oi", "timestamp", "length", "depth")
 
-        elif len(packet) == 44 or len(packet) == 184:
-            d = {"token": token,
-                 "ltp": _unpack_int(packet, 4, 8) / divisor, 
-                #  "ltq": _unpack_int(packet, 8, 12),
-                 "atp": _unpack_int(packet, 12, 16) / divisor, 
-                 "volume": _unpack_int(packet, 16, 20),
-                #  "open": _unpack_int(packet, 28, 32) / divisor,
-                #  "high": _unpack_int(packet, 32, 36) / divisor,
-                #  "low": _unpack_int(packet, 36, 40) / divisor,
-                #  "prev_close": _unpack_int(packet, 40, 44) / divisor
-                 }
-
-            if len(packet) == 184:
-                try:
-                    last_trade_time = _unpack_int(packet, 44, 48)
-                except Exception:
-                    last_trade_time = None
-                try:
-                    timestamp = _unpack_int(packet, 60, 64)
-                except Exception:
-                    timestamp = None
-
-                # d["ltt"] = last_trade_time
-                d["oi"] = _unpack_int(packet, 48, 52)
-                # d["oi_high"] = _unpack_int(packet, 52, 56)
-                # d["oi_low"] = _unpack_int(packet, 56, 60)
-                d["timestamp"] = timestamp
-
-                # depth = []
-
-                # for i, p in enumerate(range(64, len(packet), 12)):
-                #     qty = _unpack_int(packet, p, p + 4)
-                #     price = _unpack_int(packet, p + 4, p + 8) / divisor
-
-                #     level = i if i < 5 else i - 5
-                #     while len(depth) <= level:
-                #         depth.append({
-                #             'bid_qty': 0, 'ask_qty': 0,
-                #             'bid_price': '0.00', 'ask_price': '0.00'
-                #         })
-                #     if i < 5:
-                #         depth[level]['bid_qty'] = qty
-                #         depth[level]['bid_price'] = f"{price:.2f}"
-                #     else:
-                #         depth[level]['ask_qty'] = qty
-                #         depth[level]['ask_price'] = f"{price:.2f}"
-                # d['depth'] = depth
+    def __init__(self, depth=False):
+        self.token = array("I")
+        self.ltp = array("d")
+        self.atp = array("d")
+        self.volume = array("I")
+        self.oi = array("I")
+        self.timestamp = array("I")
+        self.length = array("H")
+        self.depth = MarketDepth() if depth else None
+
+    def __len__(self):
+        return len(self.token)
+
+    def _extend(self, packet_length, columns, depth_levels=None):
+        fields = _PACKET_FIELDS[packet_length]
+        count = len(columns[0])
+        tokens = columns[0]
+        divisors = [_DIVISORS[token & 0xff] for token in tokens]
+        for name in _COLUMNS:
+            column = getattr(self, name)
+            if name not in fields:
+                column.frombytes(bytes(column.itemsize * count))
+                continue
+            values = columns[fields.index(name)]
+            if name in ("ltp", "atp"):
+                column.extend(map(truediv, values, divisors))
+            else:
+                column.extend(values)
+        self.length.extend(repeat(packet_length, count))
+        if self.depth is not None:
+            if depth_levels is not None:
+                self.depth._extend(depth_levels, divisors)
+            else:
+                self.depth._pad(count)
+
+    def select(self, rows):
+        """New batch with only the given row indices, in that order."""
+        batch = TickBatch()
+        for name in _COLUMNS + ("length",):
+            column = getattr(self, name)
+            getattr(batch, name).extend([column[i] for i in rows])
+        if self.depth is not None:
+            batch.depth = self.depth.select(rows)
+        return batch
+
+    def to_dicts(self):
+        data = []
+        for i in range(len(self.token)):
+            packet_length = self.length[i]
+            d = {"token": self.token[i], "ltp": self.ltp[i]}
+            if packet_length == 32:
+                d["timestamp"] = self.timestamp[i]
+            elif packet_length == 44 or packet_length == 184:
+                d["atp"] = self.atp[i]
+                d["volume"] = self.volume[i]
+                if packet_length == 184:
+                    d["oi"] = self.oi[i]
+                    d["timestamp"] = self.timestamp[i]
             data.append(d)
-    return data
+        return data
+
 
+class TickDeduplicator:
+    """
+    Drops ticks that were already received on another connection subscribed to the same token.
+    Every packet of the connection the token's newest tick came from is kept, consecutive packets of
+    one connection are distinct updates even when timestamp and volume repeat (an index's ltp, oi or
+    depth moving within a second). A packet from any other connection is kept only when its exchange
+    timestamp is newer, or equal with a higher volume, and that connection then becomes the source.
+    Packets without a timestamp cannot be told apart and are always kept.
+    """
 
-def _unpack_int(bin, start, end, byte_format="I"):
-    return struct.unpack(">" + byte_format, bin[start:end])[0]
+    def __init__(self):
+        # token -> ((timestamp, volume) of the newest tick, connection it came from)
+        self.last_seen = {}
+        self.dropped = 0
 
+    def filter(self, batch, source=None):
+        last_seen = self.last_seen
+        tokens, timestamps, volumes = batch.token, batch.timestamp, batch.volume
+        dropped = None
+        for i in range(len(tokens)):
+            timestamp = timestamps[i]
+            if not timestamp:
+                continue
+            key = (timestamp, volumes[i])
+            token = tokens[i]
+            seen = last_seen.get(token)
+            if seen is None or key > seen[0]:
+                last_seen[token] = (key, source)
+            elif seen[1] != source:
+                if dropped is None:
+                    dropped = set()
+                dropped.add(i)
+        if dropped is None:
+            return batch
+        self.dropped += len(dropped)
+        return batch.select([i for i in range(len(tokens)) if i not in dropped])
+
+
+_COLUMNS = ("token", "ltp", "atp", "volume", "oi", "timestamp")
+
+# Only the fields we aggregate on are unpacked, everything else is skipped with pad bytes.
+# 8: ltp | 28: index quote | 32: index full | 44: quote | 184: full (depth only when asked for)
+_PACKET_FIELDS = {
+    8: ("token", "ltp"),
+    28: ("token", "ltp"),
+    32: ("token", "ltp", "timestamp"),
+    44: ("token", "ltp", "atp", "volume"),
+    184: ("token", "ltp", "atp", "volume", "oi", "timestamp"),
+}
+_PACKET_STRUCTS = {
+    8: struct.Struct(">II"),
+    28: struct.Struct(">II20x"),
+    32: struct.Struct(">II20xI"),
+    44: struct.Struct(">II4xII24x"),
+    184: struct.Struct(">II4xII24x4xI8xI120x"),
+}
+# Same layouts including the 2 byte length prefix, used when a whole frame is one packet type
+_FRAMED_STRUCTS = {length: struct.Struct(">H" + s.format[1:]) for length, s in _PACKET_STRUCTS.items()}
+# Where the 10 depth levels sit in a full packet
+_DEPTH_START = 64
+_DEPTH_END = 184
+_LITTLE_ENDIAN = sys.byteorder == "little"
+_UINT16 = struct.Struct(">H")
 
-def _split_packets(bin):
-    if len(bin) < 2:
-        return []
-    number_of_packets = _unpack_int(bin, 0, 2, byte_format="H")
-    packets = []
+_DIVISORS = tuple(
+    10000000.0 if segment == EXCHANGE_MAP["cds"] else 10000.0 if segment == EXCHANGE_MAP["bcd"] else 100.0
+    for segment in range(256)
+)
+
+
+def decode_binary_ticks(bin, depth=False):
+    """
+    Decode a binary frame into a TickBatch without copying packets out of the frame.
+    Frames made of a single packet type (the usual case in full mode) are decoded with one
+    iter_unpack call, mixed frames are grouped by packet length and each group is decoded
+    with its precompiled struct. Rows keep frame order within a packet type. A packet whose declared
+    length runs past the end of a truncated frame is skipped with everything after it, the packets
+    before it are kept.
+    With depth the 5 bid and ask levels of full packets are decoded into batch.depth, a frame at a time.
+    """
+    batch = TickBatch(depth)
+    view = memoryview(bin)
+    if len(view) < 4:
+        return batch
+    number_of_packets = _UINT16.unpack_from(view, 0)[0]
+    if number_of_packets == 0:
+        return batch
+
+    first_length = _UINT16.unpack_from(view, 2)[0]
+    framed = _FRAMED_STRUCTS.get(first_length)
+    end = 2 + number_of_packets * (2 + first_length)
+    if framed is not None and len(view) >= end:
+        columns = list(zip(*framed.iter_unpack(view[2:end])))
+        if columns[0].count(first_length) == number_of_packets:
+            levels = None
+            if depth and first_length == 184:
+                levels = b"".join([view[offset + _DEPTH_START:offset + _DEPTH_END]
+                                   for offset in range(4, end, 2 + first_length)])
+            batch._extend(first_length, columns[1:], levels)
+            return batch
+
+    groups = {}
     j = 2
-    for i in range(number_of_packets):
-        packet_length = _unpack_int(bin, j, j + 2, byte_format="H")
-        packets.append(bin[j + 2: j + 2 + packet_length])
-        j = j + 2 + packet_length
-    return packets
+    unpack_length = _UINT16.unpack_from
+    size = len(view)
+    for _ in range(number_of_packets):
+        if j + 2 > size:
+            break
+        packet_length = unpack_length(view, j)[0]
+        if j + 2 + packet_length > size:
+            break
+        offsets = groups.get(packet_length)
+        if offsets is None:
+            offsets = groups[packet_length] = []
+        offsets.append(j + 2)
+        j += 2 + packet_length
+
+    for packet_length, offsets in groups.items():
+        packet_struct = _PACKET_STRUCTS.get(packet_length)
+        if packet_struct is None:
+            continue
+        unpack = packet_struct.unpack_from
+        levels = None
+        if depth and packet_length == 184:
+            levels = b"".join([view[offset + _DEPTH_START:offset + _DEPTH_END] for offset in offsets])
+        batch._extend(packet_length, list(zip(*[unpack(view, offset) for offset in offsets])), levels)
+    return batch
+
+
+def parse_binary_ticks(bin):
+    return decode_binary_ticks(bin).to_dicts()
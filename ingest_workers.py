@@ -0,0 +1,148 @@
+import asyncio
+import multiprocessing
+import time
+from queue import Empty
+
+
+def shard_plan(plan, worker_count):
+    """
+    Split the (connection_id, account_name, token_chunk) connection plan into worker_count shards.
+    Connections subscribed to the same chunk (hot standby) stay in one shard so their ticks can be de-duplicated.
+    """
+    groups = {}
+    for connection in plan:
+        chunk = connection[-1]
+        groups.setdefault(chunk[0] if chunk else None, []).append(connection)
+    groups = list(groups.values())
+    shards = [[connection for group in groups[i::worker_count] for connection in group] for i in range(worker_count)]
+    return [shard for shard in shards if shard]
+
+
+class ShardCoordinator:
+    """
+    Runs each shard of the connection plan in its own process and owns the minute flush.
+    Workers push their closed (and amended) candle rows onto a shared queue, followed by the minute they
+    finalized through. The coordinator merges the rows of a minute into a single save_rows call once
+    every live worker has finalized past it, or max_wait_seconds after the minute ended for a worker
+    that never reports. Token sets of different shards never overlap, so merging is a concatenation.
+    A worker that dies is restarted with the same shard, with backoff if it keeps crashing.
+    """
+
+    def __init__(self, target, plan, worker_count, mapping, save_rows, max_wait_seconds=15, max_backoff=30,
+                 late=((), (), 0), worker_args=()):
+        self.target = target
+        # Passed to every worker after its shard, mapping, queue and late accounts, restarts included
+        self.worker_args = tuple(worker_args)
+        self.shards = shard_plan(plan, worker_count)
+        self.mappings = [
+            {token: mapping[token] for _, _, chunk in shard for token in chunk if token in mapping}
+            for shard in self.shards
+        ]
+        # (accounts, tokens, first connection id) of accounts that log in after the start, all of them
+        # go to the worker with the fewest tokens
+        self.late = late
+        self.late_worker = min(range(len(self.shards)), key=lambda i: len(self.mappings[i]), default=None)
+        if self.late_worker is not None:
+            self.mappings[self.late_worker].update(
+                (token, mapping[token]) for token in late[1] if token in mapping)
+        self.save_rows = save_rows
+        self.max_wait_seconds = max_wait_seconds
+        self.max_backoff = max_backoff
+
+        self.context = multiprocessing.get_context("spawn")
+        self.output = self.context.Queue()
+        self.processes = {}
+        self.restarts = [0] * len(self.shards)
+        self.next_start = [0.0] * len(self.shards)
+        self.started_at = [0.0] * len(self.shards)
+        self.pending = []
+        self.pending_amended = []
+        # worker -> last minute it finalized, since it (re)started
+        self.finalized = {}
+        self.running = False
+
+    def start_worker(self, worker_id):
+        process = self.context.Process(
+            target=self.target,
+            args=(worker_id, self.shards[worker_id], self.mappings[worker_id], self.output,
+                  self.late if worker_id == self.late_worker else ((), (), 0)) + self.worker_args,
+            name=f"ingest-worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        self.finalized.pop(worker_id, None)
+        self.processes[worker_id] = process
+        self.started_at[worker_id] = time.monotonic()
+        print(f"Started ingest worker {worker_id} (pid {process.pid}) with {len(self.shards[worker_id])} connections")
+
+    async def supervise(self):
+        while self.running:
+            now = time.monotonic()
+            for worker_id, process in list(self.processes.items()):
+                if process.is_alive():
+                    continue
+                if self.next_start[worker_id] == 0.0:
+                    # Only back off further if the worker keeps dying quickly
+                    attempts = 1 if now - self.started_at[worker_id] > 60 else self.restarts[worker_id] + 1
+                    self.restarts[worker_id] += 1
+                    delay = min(self.max_backoff, 2 ** (attempts - 1))
+                    self.next_start[worker_id] = now + delay
+                    print(f"Ingest worker {worker_id} exited with {process.exitcode}, restarting in {delay}s")
+                elif now >= self.next_start[worker_id]:
+                    self.next_start[worker_id] = 0.0
+                    self.start_worker(worker_id)
+            await asyncio.sleep(1)
+
+    async def collect(self):
+        loop = asyncio.get_running_loop()
+        while self.running:
+            try:
+                worker_id, through_minute, rows, amended_rows = await loop.run_in_executor(
+                    None, self.output.get, True, 1)
+            except Empty:
+                continue
+            self.pending.extend(rows)
+            self.pending_amended.extend(amended_rows)
+            if through_minute is not None:
+                self.finalized[worker_id] = max(through_minute, self.finalized.get(worker_id, through_minute))
+
+    def ready_through(self, now):
+        """Last epoch minute every live worker has finalized, or the clock has given up waiting for."""
+        by_clock = int(now - self.max_wait_seconds) // 60 - 1
+        live = [worker_id for worker_id, process in self.processes.items() if process.is_alive()]
+        if not live or any(worker_id not in self.finalized for worker_id in live):
+            return by_clock
+        return max(by_clock, min(self.finalized[worker_id] for worker_id in live))
+
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        while self.running:
+            await asyncio.sleep(1)
+            through = self.ready_through(time.time())
+            rows = [row for row in self.pending if row[1] <= through]
+            amended_rows = [row for row in self.pending_amended if row[1] <= through]
+            if not rows and not amended_rows:
+                continue
+            self.pending = [row for row in self.pending if row[1] > through]
+            self.pending_amended = [row for row in self.pending_amended if row[1] > through]
+            try:
+                await loop.run_in_executor(None, self.save_rows, rows, amended_rows)
+            except Exception as e:
+                print(f"Error saving merged candles: {e}")
+
+    def worker_stats(self):
+        return {
+            worker_id: {"pid": process.pid, "alive": process.is_alive(), "restarts": self.restarts[worker_id]}
+            for worker_id, process in self.processes.items()
+        }
+
+    async def run(self):
+        self.running = True
+        for worker_id in range(len(self.shards)):
+            self.start_worker(worker_id)
+        try:
+            await asyncio.gather(self.supervise(), self.collect(), self.flush())
+        finally:
+            self.running = False
+            for process in self.processes.values():
+                process.terminate()
@@ -1,46 +1,82 @@
 import asyncio
 import json
-import random
-from datetime import datetime, timedelta
-from queue import Queue
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import websockets
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.date import DateTrigger
 
-from database import REDIS_DB_CLIENT
-from helpers.zerodha_helpers import fetch_all_tokens_for_zerodha, parse_binary_ticks, parse_text_message
-from ohlc_handler import process_tick, threaded_save
+from accounts import AccountDirectory
+from candle_finalizer import CandleFinalizer, Watermarks
+from connection_supervisor import ConnectionSupervisor
+from database import REDIS_DATA_SHARDS, REDIS_DB_CLIENT
+from helpers.zerodha_helpers import (TickDeduplicator, decode_binary_ticks, fetch_all_tokens_for_zerodha,
+                                     parse_text_message)
+from ingest_workers import ShardCoordinator
+from ohlc_handler import (candle_listeners, candle_rows, checkpoint_candles, close_clickhouse_sinks, depth_rows,
+                          finalize_candles, ingest_lock, init_candle_engine, init_candle_stores, init_redis_writer,
+                          live_candles, market_depth, process_ticks, restore_candles, save_depth_rows_to_redis,
+                          store_candle_rows, update_instruments)
+from query_service import CandleCache, CandleQueryService
+from storage.candle_checkpoint import CandleCheckpoint, load_checkpoint
+from token_placement import TickRateProfile, load_profile, place_tokens, plan_moves, profile_path
+from utils.frame_queue import FrameQueue
+from utils.frame_recorder import FrameRecorder
+from utils.instrument_snapshot import diff_instruments, load_snapshot, save_snapshot
+from utils.metrics import (CHECKPOINT_SECONDS, CHECKPOINT_SLOTS, CONNECTION_TICK_RATE, DUPLICATE_TICKS, FRAME_BYTES,
+                           FRAME_PROCESS_DELAY, FRAMES, INSTRUMENT_CHANGES, RECEIVE_LAG, STAGE_SECONDS, STARTUP_SECONDS,
+                           TICKS, TOKENS_MOVED, UNSUBSCRIBED_TOKENS, monitor_event_loop_lag, start_metrics_server)
+from utils.publisher import CoalescingPublisher, MarketDataUpdater
+from utils.tick_shm import TickRingWriter
 from utils.utils import ping_task
 
-data_queue = Queue()
+# Raw frames waiting for the frame workers, one queue per worker, empty while frames are processed on
+# the event loop
+frame_queues = []
+connection_labels = {}
+# Running connections (supervisor -> task), empty in the ingest coordinator
+connection_supervisors = {}
+frame_recorder = None
+tick_updater = None
+tick_coalescer = None
+tick_symbols = {}
+tick_deduplicator = None
+tick_profile = None
+tick_ring = None
+tick_profile_file = None
+account_directory = None
+# Startup is measured from import, which for the ingester is process start
+process_started = time.monotonic()
+first_tick_at = None
+candle_checkpoint = None
+restored_minutes = {}
+# First minute whose candles are complete, reported as the "first_candle" startup stage once written
+first_complete_minute = None
+INSTRUMENT_PATTERNS = ['CT*']
+# Ticker endpoint, e.g. KITE_WS_URL=ws://127.0.0.1:8765 for benchmarks.mock_kite
+KITE_WS_URL = os.environ.get("KITE_WS_URL", "wss://ws.kite.trade")
+# Waits out the coalesced publishes off the event loop, they queue behind the TICKS:* writes on the "ticks" lane
+publish_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tick-publisher")
 
-cirrus_token_to_broker_token_mapping = {}
-task_scheduler = AsyncIOScheduler()
+# Newest exchange timestamp per connection, minutes are finalized behind the slowest live one
+watermarks = Watermarks()
 
 
-async def schedule_task_at_time(target_time: datetime, task: callable, args=None, kwargs=None):
-    if kwargs is None:
-        kwargs = {}
-    if args is None:
-        args = []
-    random_id = random.randint(0, 100000)
-    task_scheduler.add_job(
-        task,
-        DateTrigger(run_date=target_time),
-        args=args,
-        kwargs=kwargs,
-        id=str(random_id),
-    )
-    print(f"Task scheduled for {target_time} at {datetime.now()}")
-    return str(random_id)
-
-
-async def send_instruments_to_zerodha(socket, instruments):
-    message = {
-        "a": "mode",
-        "v": ["full", instruments]
-    }
+async def send_instruments_to_zerodha(socket, instruments, action="mode"):
+    """Send a mode (full), subscribe or unsubscribe message. A failed send closes the socket."""
+    if action == "mode":
+        message = {
+            "a": "mode",
+            "v": ["full", instruments]
+        }
+    else:
+        message = {
+            "a": action,
+            "v": instruments
+        }
     try:
         await socket.send(json.dumps(message))
     except Exception as e:
@@ -49,7 +85,8 @@ async def send_instruments_to_zerodha(socket, instruments):
             await socket.close()
         except Exception as e:
             print("Error in closing socket", e)
-        return
+        return False
+    return True
 
 
 async def close_socket(ws):
@@ -59,70 +96,355 @@ async def close_socket(ws):
         print("Error in closing socket", e)
 
 
-async def ohlc_flush_task_generator():
-    last_scheduled_time = None
+def init_frame_recorder(mapping, worker_id=None):
+    global frame_recorder
+    directory = os.environ.get("FRAME_RECORD_DIR")
+    if not directory:
+        return None
+    if worker_id is not None:
+        directory = os.path.join(directory, f"worker-{worker_id}")
+    frame_recorder = FrameRecorder(directory)
+    frame_recorder.write_session(mapping)
+    print(f"Recording raw frames to {directory}")
+    return frame_recorder
+
+
+async def flush_frame_recorder(interval):
+    # The recorder buffers a megabyte per file, a crash loses at most interval seconds of frames
     while True:
-        now = datetime.now().replace(second=0, microsecond=0)
-        next_minute = now + timedelta(minutes=1)
-        # if next_minute is after 15:30 PM, skip scheduling
+        await asyncio.sleep(interval)
+        try:
+            frame_recorder.flush()
+        except Exception as e:
+            print(f"Error flushing recorded frames: {e}")
+
+
+def close_frame_recorder():
+    global frame_recorder
+    recorder, frame_recorder = frame_recorder, None
+    if recorder is not None:
+        recorder.close()
+
+
+def init_tick_publisher(mapping, redis_writer):
+    global tick_updater, tick_coalescer, tick_symbols
+    if os.environ.get("PUBLISH_TICKS", "1") != "1":
+        return None
+    # Hash writes and the messages announcing them share a lane, so they land in that order
+    ticks_lane = redis_writer.lane("ticks")
+    window_ms = int(os.environ.get("TICK_COALESCE_MS", "0"))
+    if window_ms > 0:
+        tick_coalescer = CoalescingPublisher(ticks_lane, window=window_ms / 1000,
+                                             shards=int(os.environ.get("TICK_CHANNEL_SHARDS", "1")),
+                                             executor=publish_executor, lock=ingest_lock)
+        asyncio.create_task(tick_coalescer.run())
+    tick_updater = MarketDataUpdater(ticks_lane, coalescer=tick_coalescer)
+    tick_symbols = mapping
+    return tick_updater
+
+
+def init_tick_ring(mapping, worker_id=None):
+    """Publish the last TICK_SHM_DEPTH ticks per token to shared memory region TICK_SHM_NAME[-worker]."""
+    global tick_ring
+    name = os.environ.get("TICK_SHM_NAME")
+    if not name:
+        return None
+    if worker_id is not None:
+        name = f"{name}-{worker_id}"
+    tick_ring = TickRingWriter(name, mapping, int(os.environ.get("TICK_SHM_DEPTH", "16")))
+    print(f"Publishing last ticks to shared memory {name}")
+    return tick_ring
 
 
-        if last_scheduled_time and next_minute <= last_scheduled_time:
-            # print("Skipping scheduling for", next_minute, "as it is already scheduled")
-            await asyncio.sleep(10)
+def close_tick_ring():
+    """Remove the shared memory region, readers attached to it keep their mapping until they detach."""
+    global tick_ring
+    with ingest_lock:
+        ring, tick_ring = tick_ring, None
+    if ring is not None:
+        ring.close()
+
+
+def stop_on_sigterm():
+    # terminate() (the coordinator restarting a worker, or a service manager) unwinds run_connections, so
+    # the finally blocks release what the process holds outside itself
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+
+def publish_ticks(batch):
+    pipe = tick_updater.update_batch(batch, tick_symbols)
+    if len(pipe):
+        pipe.submit()
+
+
+async def fetch_zerodha_market_data(supervisor, account_name):
+    """
+    One session: connect with the account's current session, subscribe the supervisor's tokens and
+    receive until the socket is gone. The supervisor reconnects.
+    """
+    api_key, access_token = await account_directory.credentials(account_name)
+    url = f"{KITE_WS_URL}?api_key={api_key}&access_token={access_token}"
+    async with websockets.connect(url, ping_interval=None) as target:
+        print(f'Connection established with Zerodha with {account_name} and {len(supervisor.tokens)} tokens')
+        await send_instruments_to_zerodha(target, supervisor.tokens)
+        supervisor.socket = target
+        tasks = [
+            asyncio.create_task(ping_task(5, target)),
+            asyncio.create_task(handle_received_data(target, supervisor.connection_id, account_name, supervisor)),
+        ]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            supervisor.socket = None
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def init_candle_checkpoint(mapping, worker_id=None):
+    """
+    Resume the open minutes from the CANDLE_CHECKPOINT file a previous process left behind and start a
+    fresh checkpoint for this one. Without a checkpoint the first minute received from its start is
+    the first complete one.
+    """
+    global candle_checkpoint, restored_minutes, first_complete_minute
+    current_minute = int(time.time()) // 60
+    first_complete_minute = current_minute + 1
+    path = os.environ.get("CANDLE_CHECKPOINT", "candle_checkpoint.bin")
+    if not path:
+        return None
+    if worker_id is not None:
+        root, ext = os.path.splitext(path)
+        path = f"{root}.worker-{worker_id}{ext}"
+    loaded = load_checkpoint(path)
+    if loaded is not None:
+        # Anything older than the previous minute was finalized by the last process or is beyond repair
+        restored_minutes = restore_candles(loaded[1], current_minute - 1)
+        if restored_minutes:
+            first_complete_minute = min(restored_minutes)
+            print(f"Resumed {sum(restored_minutes.values())} candles of {len(restored_minutes)} open minutes "
+                  f"from {path}")
+    candle_checkpoint = CandleCheckpoint(path, mapping)
+    return candle_checkpoint
+
+
+async def run_candle_checkpoint(interval):
+    clock = time.perf_counter
+    while True:
+        await asyncio.sleep(interval)
+        start = clock()
+        try:
+            CHECKPOINT_SLOTS.inc(checkpoint_candles(candle_checkpoint))
+        except Exception as e:
+            print(f"Error checkpointing candles: {e}")
+        CHECKPOINT_SECONDS.observe(clock() - start)
+
+
+async def finalize_minutes(through_minute):
+    global first_complete_minute
+    closed = await finalize_candles(through_minute)
+    if first_complete_minute is not None and closed and through_minute >= first_complete_minute:
+        first_complete_minute = None
+        STARTUP_SECONDS.set(time.monotonic() - process_started, ("first_candle",))
+    return closed
+
+
+def mark_first_tick():
+    global first_tick_at
+    first_tick_at = time.monotonic()
+    elapsed = first_tick_at - process_started
+    STARTUP_SECONDS.set(elapsed, ("first_tick",))
+    print(f"First subscribed tick {elapsed:.2f}s after start")
+
+
+def load_instruments(snapshot_path):
+    """Instruments from today's local snapshot if there is one, otherwise from Redis (then snapshotted)."""
+    started = time.monotonic()
+    loaded = load_snapshot(snapshot_path, INSTRUMENT_PATTERNS) if snapshot_path else None
+    source = "snapshot"
+    if loaded is None:
+        loaded = fetch_all_tokens_for_zerodha(INSTRUMENT_PATTERNS)
+        source = "redis"
+        if snapshot_path:
+            save_snapshot(snapshot_path, INSTRUMENT_PATTERNS, *loaded)
+    STARTUP_SECONDS.set(time.monotonic() - process_started, ("instruments",))
+    print(f"Loaded {len(loaded[0])} instruments from {source} in {time.monotonic() - started:.2f}s")
+    return loaded + (source,)
+
+
+async def refresh_instruments(snapshot_path, symbol_dict, interval, immediately=False):
+    """
+    Periodically re-read the instruments from Redis in the background, persist any difference to the
+    snapshot and apply it to the running connections (see apply_instrument_changes). The ingest
+    coordinator runs no connections, with INGEST_WORKERS the next start picks the new universe up.
+    """
+    loop = asyncio.get_running_loop()
+    if not immediately:
+        await asyncio.sleep(interval)
+    while True:
+        try:
+            symbol_list, latest = await loop.run_in_executor(None, fetch_all_tokens_for_zerodha, INSTRUMENT_PATTERNS)
+            added, removed, changed = diff_instruments(symbol_dict, latest)
+            if added or removed or changed:
+                for kind, tokens in (("added", added), ("removed", removed), ("changed", changed)):
+                    INSTRUMENT_CHANGES.inc(len(tokens), (kind,))
+                print(f"Instrument universe changed: {len(added)} added, {len(removed)} removed, "
+                      f"{len(changed)} remapped")
+                save_snapshot(snapshot_path, INSTRUMENT_PATTERNS, symbol_list, latest)
+                await apply_instrument_changes(latest, added, removed, changed)
+                symbol_dict = latest
+        except Exception as e:
+            print(f"Error refreshing instruments: {e}")
+        await asyncio.sleep(interval)
+
+
+async def apply_instrument_changes(latest, added, removed, changed, capacity=3000):
+    """
+    Follow an instrument universe change on the running connections. Removed tokens are unsubscribed.
+    Added ones get candle slots and are subscribed on the connections with the fewest tokens, up to
+    capacity each. Remapped ones write candles and ticks under their new key from now on.
+    """
+    if not connection_supervisors:
+        return
+    mapping = update_instruments({token: latest[token] for token in added},
+                                 {token: latest[token] for token in changed})
+    if tick_updater is not None:
+        with ingest_lock:
+            for token in removed:
+                tick_symbols.pop(token, None)
+            tick_symbols.update((token, latest[token]) for token in added + changed)
+    if frame_recorder is not None:
+        # Replays of the recording need the added tokens too
+        frame_recorder.write_session(mapping)
+
+    removed = set(removed)
+    for supervisor in connection_supervisors:
+        gone = [token for token in supervisor.tokens if token in removed]
+        if not gone:
             continue
-        print("Scheduling OHLC flush at", next_minute)
-        await schedule_task_at_time(next_minute, threaded_save)
-        last_scheduled_time = next_minute
-        await asyncio.sleep(10)
+        supervisor.tokens = [token for token in supervisor.tokens if token not in removed]
+        # A connection between sessions subscribes what is left when it reconnects
+        if supervisor.socket is not None:
+            await send_instruments_to_zerodha(supervisor.socket, gone, "unsubscribe")
+    placed = {}
+    for token in added:
+        supervisor = min(connection_supervisors, key=lambda supervisor: len(supervisor.tokens))
+        if len(supervisor.tokens) >= capacity:
+            break
+        supervisor.tokens.append(token)
+        placed.setdefault(supervisor, []).append(token)
+    for supervisor, tokens in placed.items():
+        if supervisor.socket is not None and await send_instruments_to_zerodha(supervisor.socket, tokens, "subscribe"):
+            await send_instruments_to_zerodha(supervisor.socket, tokens)
+    subscribed = sum(len(tokens) for tokens in placed.values())
+    print(f"Subscribed {subscribed} added tokens on {len(placed)} connections, unsubscribed {len(removed)}"
+          + (f", no room for {len(added) - subscribed}" if subscribed < len(added) else ""))
 
 
-async def fetch_zerodha_market_data(api_key, access_token, broker_token_list_to_share):
-    url = f"wss://ws.kite.trade?api_key={api_key}&access_token={access_token}"
-    tasks = []
+def frame_labels(connection_id, account=""):
+    """Metric label tuples of a connection, built once: (ticks, decode, aggregate, publish, connection)."""
+    labels = connection_labels.get(connection_id)
+    if labels is None:
+        connection = str(connection_id)
+        labels = connection_labels[connection_id] = ((account, connection), ("decode", connection),
+                                                     ("aggregate", connection), ("publish", connection),
+                                                     (connection,))
+    return labels
+
+
+def process_frame(payload, received_at, connection_id):
+    """
+    Decode and aggregate one binary frame, inline on the event loop or on a frame worker thread.
+    Everything past decoding touches shared ingest state and runs under ingest_lock.
+    """
+    labels, decode_labels, aggregate_labels, publish_labels, lag_labels = frame_labels(connection_id)
+    clock = time.perf_counter
     try:
-        ws_conn = None
-        async with websockets.connect(url, ping_interval=None) as target:
-            ws_conn = target
-            ws_ping_task: asyncio.Task = asyncio.create_task(ping_task(5, target))
-            data_recv_task: asyncio.Task = asyncio.create_task(handle_received_data(target))
-
-            print(f'Connection established with Zerodha with {api_key} and {len(broker_token_list_to_share)} tokens')
-            await send_instruments_to_zerodha(ws_conn, broker_token_list_to_share)
-            tasks.append(ws_ping_task)
-            tasks.append(data_recv_task)
-            await asyncio.gather(*tasks)
-    except websockets.exceptions.ConnectionClosedError:
-        pass
-    except asyncio.CancelledError:
-        pass
+        start = clock()
+        batch = decode_binary_ticks(payload, market_depth)
+        with ingest_lock:
+            if tick_deduplicator is not None:
+                received = len(batch)
+                batch = tick_deduplicator.filter(batch, connection_id)
+                if len(batch) != received:
+                    DUPLICATE_TICKS.inc(received - len(batch))
+            decoded = clock()
+            process_ticks(batch)
+            if tick_ring is not None:
+                tick_ring.write(batch)
+            aggregated = clock()
+            if tick_updater is not None:
+                publish_ticks(batch)
+                STAGE_SECONDS.observe(clock() - aggregated, publish_labels)
+            if tick_profile is not None:
+                tick_profile.observe(batch.token)
+        STAGE_SECONDS.observe(decoded - start, decode_labels)
+        STAGE_SECONDS.observe(aggregated - decoded, aggregate_labels)
+        TICKS.inc(len(batch), labels)
+        if first_tick_at is None and len(batch):
+            mark_first_tick()
+        newest = max(batch.timestamp, default=0)
+        if newest:
+            watermarks.advance(connection_id, newest)
+            RECEIVE_LAG.observe(received_at - newest, lag_labels)
+        if frame_queues:
+            FRAME_PROCESS_DELAY.observe(time.time() - received_at, lag_labels)
     except Exception as e:
-        pass
-    finally:
-        for task in tasks:
-            task.cancel()
-        if ws_conn is not None:
-            await ws_conn.close()
-            await fetch_zerodha_market_data(api_key, access_token, broker_token_list_to_share)
-        else:
-            await fetch_zerodha_market_data(api_key, access_token, broker_token_list_to_share)
+        print(f"Error processing tick data: {e}")
+
+
+def run_frame_worker(queue):
+    while True:
+        item = queue.get()
+        if item is None:
+            return
+        received_at, connection_id, payload = item
+        process_frame(payload, received_at, connection_id)
+
 
+def init_frame_workers():
+    """
+    FRAME_WORKERS > 0 moves decoding and aggregation off the event loop: receive tasks only queue raw
+    frames (FRAME_QUEUE_SIZE in all, FRAME_QUEUE_POLICY block|drop-oldest|spill, spills under
+    FRAME_SPILL_DIR) and that many threads drain them. Each worker has its own queue and every frame of
+    a connection goes to the same one, so a connection's frames are processed in arrival order.
+    """
+    count = int(os.environ.get("FRAME_WORKERS", "0"))
+    if count <= 0:
+        return None
+    capacity = max(1, int(os.environ.get("FRAME_QUEUE_SIZE", "10000")) // count)
+    for i in range(count):
+        queue = FrameQueue(capacity, os.environ.get("FRAME_QUEUE_POLICY", "block"),
+                           os.environ.get("FRAME_SPILL_DIR"), name=str(i))
+        frame_queues.append(queue)
+        threading.Thread(target=run_frame_worker, args=(queue,), name=f"frame-worker-{i}", daemon=True).start()
+    print(f"Processing frames on {count} worker threads, queues of {capacity} "
+          f"({frame_queues[0].policy} when full)")
+    return frame_queues
 
-async def handle_received_data(ws):
-    global cirrus_token_to_broker_token_mapping
+
+async def handle_received_data(ws, connection_id=0, account="", supervisor=None):
+    labels = frame_labels(connection_id, account)[0]
+    frame_queue = frame_queues[hash(connection_id) % len(frame_queues)] if frame_queues else None
+    binary_labels = labels + ("binary",)
+    text_labels = labels + ("text",)
     try:
         while True:
             result = await ws.recv()
+            received_at = time.time()
+            if supervisor is not None:
+                supervisor.frame_received()
+            if frame_recorder is not None:
+                frame_recorder.record(connection_id, result, received_at)
             if isinstance(result, bytes):
-                result = parse_binary_ticks(result)
-                for res in result:
-                    try:
-                        c_token = cirrus_token_to_broker_token_mapping[res['token']]
-                        res['token'] = c_token
-                        process_tick(res)
-                    except Exception as e:
-                        print(f"Error processing tick data: {e}")
+                FRAMES.inc(1, binary_labels)
+                FRAME_BYTES.inc(len(result), labels)
+                if frame_queue is None:
+                    process_frame(result, received_at, connection_id)
+                elif not frame_queue.put((received_at, connection_id, result)):
+                    await frame_queue.put_wait((received_at, connection_id, result))
             else:
+                FRAMES.inc(1, text_labels)
                 parse_text_message(result)
     except websockets.exceptions.ConnectionClosedError:
         print("Zerodha WebSocket connection closed")
@@ -132,50 +454,327 @@ async def handle_received_data(ws):
         print(f"Internal Error: {e}")
 
 
-async def main():
-    task_scheduler.start()
-    print("Initializing ZeroDha")
-    global cirrus_token_to_broker_token_mapping
-    broker_token_list_to_share, cirrus_token_to_broker_token_mapping = fetch_all_tokens_for_zerodha(['CT*'])
-    token_limit_per_connection = 3000
-    connection_per_account = 3
+def plan_connections(account_names, broker_token_list_to_share, token_limit_per_connection=3000,
+                     connection_per_account=3, standby=False, rates=None):
+    """
+    Split the tokens into (connection_id, account_name, token_chunk) connections. Every connection of
+    every account is used, so load is spread as thin as the accounts allow and each socket keeps headroom
+    for rebalancing. Chunks are balanced by tick rate (see token_placement.place_tokens), without rates
+    by token count. With standby every chunk is subscribed a second time on a different account, which
+    halves the number of connections available to primaries. Plan over the accounts that have logged in,
+    tokens past their capacity are left out (see add_late_accounts).
+    """
+    slots = [(name,) for name in account_names for _ in range(connection_per_account)]
+    chunk_count = len(broker_token_list_to_share)
+    if standby and len(account_names) < 2:
+        print("Hot standby needs at least two accounts, subscribing every chunk once")
+        standby = False
+    if standby:
+        # Replicas start on the first account after the primaries, so a chunk never shares an account
+        accounts_per_copy = len(account_names) // 2
+        chunk_count = min(chunk_count, accounts_per_copy * connection_per_account)
+        replica_offset = -(-chunk_count // connection_per_account) * connection_per_account
+    else:
+        chunk_count = min(chunk_count, len(slots))
+
+    tokens = broker_token_list_to_share[:chunk_count * token_limit_per_connection]
+    chunks = place_tokens(tokens, rates or {}, chunk_count, token_limit_per_connection)
+    plan = []
+    for chunk_index, chunk in enumerate(chunks):
+        plan.append((chunk_index,) + slots[chunk_index] + (chunk,))
+        if standby:
+            plan.append((chunk_count + chunk_index,) + slots[replica_offset + chunk_index] + (chunk,))
+    return plan
+
+
+async def start_query_service(live=True):
+    """Serve candle queries on CANDLE_QUERY_PORT from the process that writes candles."""
+    port = os.environ.get("CANDLE_QUERY_PORT")
+    if not port:
+        return None
+    cache = CandleCache(max_candles=int(os.environ.get("CANDLE_CACHE_CANDLES", "1000000")))
+    candle_listeners.append(cache.add_rows)
+    stores = [name.strip() for name in os.environ.get("CANDLE_STORES", "redis").split(",")]
+    service = CandleQueryService(
+        cache,
+        redis_client=REDIS_DATA_SHARDS if "redis" in stores and REDIS_DATA_SHARDS else None,
+        segment_root=os.environ.get("SEGMENT_STORE_DIR", "segments") if "segments" in stores else None,
+        # Sharded workers hold the live candles, the coordinator only serves closed ones
+        live_candles=live_candles if live else None,
+    )
+    return await service.start(int(port), os.environ.get("CANDLE_QUERY_HOST", "127.0.0.1"))
+
+
+async def start_metrics(port_offset=0):
+    port = os.environ.get("METRICS_PORT")
+    if not port:
+        return None
+    asyncio.create_task(monitor_event_loop_lag())
+    return await start_metrics_server(int(port) + port_offset, os.environ.get("METRICS_HOST", "127.0.0.1"))
+
+
+def init_tick_deduplicator():
+    global tick_deduplicator
+    # Rebalancing subscribes a moved token on two connections for a moment
+    if os.environ.get("HOT_STANDBY") == "1" or int(os.environ.get("TOKEN_REBALANCE_SECONDS", "0")) > 0:
+        tick_deduplicator = TickDeduplicator()
+    return tick_deduplicator
+
+
+def init_tick_profile(worker_id=None, session=None):
+    global tick_profile, tick_profile_file
+    path = os.environ.get("TICK_PROFILE", "tick_profile.json")
+    if not path:
+        return None
+    tick_profile = TickRateProfile(session)
+    tick_profile_file = profile_path(path, worker_id)
+    return tick_profile
+
+
+async def save_tick_profile(interval=300):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            with ingest_lock:
+                tick_profile.save(tick_profile_file)
+        except Exception as e:
+            print(f"Error saving tick profile: {e}")
+
+
+async def rebalance_connections(supervisors, interval, capacity=3000):
+    """
+    Every interval, move tokens from the busiest connections to the least busy ones by the tick rates
+    of the last interval. A token is subscribed on its new connection before it is unsubscribed on the
+    old one, the overlap is de-duplicated, so no ticks are lost.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        with ingest_lock:
+            rates = tick_profile.roll_window()
+        live = {supervisor.connection_id: supervisor for supervisor in supervisors
+                if supervisor.socket is not None and supervisor.receiving}
+        for connection_id, supervisor in live.items():
+            CONNECTION_TICK_RATE.set(sum(rates.get(token, 0.0) for token in supervisor.tokens),
+                                     (str(connection_id),))
+        moves = plan_moves({connection_id: supervisor.tokens for connection_id, supervisor in live.items()},
+                           rates, capacity)
+        if not moves:
+            continue
+        grouped = {}
+        for token, source, target in moves:
+            grouped.setdefault((source, target), []).append(token)
+        moved = 0
+        for (source, target), tokens in grouped.items():
+            source, target = live[source], live[target]
+            if source.socket is None or target.socket is None:
+                continue
+            if not (await send_instruments_to_zerodha(target.socket, tokens, "subscribe")
+                    and await send_instruments_to_zerodha(target.socket, tokens)):
+                continue
+            target.tokens.extend(tokens)
+            tokens_set = set(tokens)
+            source.tokens = [token for token in source.tokens if token not in tokens_set]
+            if source.socket is not None:
+                await send_instruments_to_zerodha(source.socket, tokens, "unsubscribe")
+            moved += len(tokens)
+        TOKENS_MOVED.inc(moved)
+        print(f"Rebalanced {moved} tokens across {len(grouped)} connection pairs")
+
+
+async def add_late_accounts(supervisors, accounts, tokens, next_id, token_limit_per_connection=3000,
+                            connection_per_account=3):
+    """
+    Subscribe the tokens the logged in accounts had no room for on the connections of accounts that log
+    in later, in the order they are announced. Until then the tokens are counted in UNSUBSCRIBED_TOKENS.
+    New connections are numbered from next_id, the first id the start plan left free.
+    """
+    pending = list(tokens)
+    # A worker (re)started after some of them logged in finds them ready already
+    ready = [name for name in accounts if name in account_directory.accounts]
+    while pending:
+        account_name = ready.pop(0) if ready else await account_directory.next_ready()
+        if account_name not in accounts:
+            continue
+        chunk_count = min(connection_per_account, -(-len(pending) // token_limit_per_connection))
+        taken = pending[:chunk_count * token_limit_per_connection]
+        pending = pending[len(taken):]
+        for chunk in place_tokens(taken, {}, chunk_count, token_limit_per_connection):
+            session = partial(fetch_zerodha_market_data, account_name=account_name)
+            supervisor = ConnectionSupervisor(next_id, account_name, session, chunk)
+            supervisors[supervisor] = asyncio.create_task(supervisor.run())
+            next_id += 1
+        UNSUBSCRIBED_TOKENS.set(len(pending))
+        print(f"Account {account_name} logged in: {len(taken)} tokens on {chunk_count} new connections, "
+              f"{len(pending)} tokens still unsubscribed")
+
 
+async def run_connections(plan, late_accounts=(), late_tokens=(), late_connection_id=0):
     tasks = []
-    chunk_index = 0
+    supervisors = connection_supervisors
+    for connection_id, account_name, token_chunk in plan:
+        session = partial(fetch_zerodha_market_data, account_name=account_name)
+        supervisor = ConnectionSupervisor(connection_id, account_name, session, token_chunk)
+        supervisors[supervisor] = asyncio.create_task(supervisor.run())
+    tasks.extend(supervisors.values())
+    if late_tokens:
+        UNSUBSCRIBED_TOKENS.set(len(late_tokens))
+        print(f"{len(late_tokens)} tokens unsubscribed until one of {len(late_accounts)} accounts logs in")
+        tasks.append(asyncio.create_task(add_late_accounts(supervisors, late_accounts, late_tokens,
+                                                                late_connection_id)))
+    if tick_profile is not None:
+        tasks.append(asyncio.create_task(save_tick_profile()))
+        interval = int(os.environ.get("TOKEN_REBALANCE_SECONDS", "0"))
+        # Both copies of a hot standby chunk would have to move together, so standby plans stay as placed
+        if interval > 0 and os.environ.get("HOT_STANDBY") != "1":
+            # The dict itself, so connections of accounts that log in later are rebalanced too
+            tasks.append(asyncio.create_task(rebalance_connections(supervisors, interval)))
+
+    print("Total connections created: ", len(supervisors))
+    # CANDLE_GRACE_SECONDS past a minute's end on every live connection's exchange clock closes it,
+    # CANDLE_MAX_DELAY_SECONDS more on the local clock closes it without data
+    finalizer = CandleFinalizer(finalize_minutes, watermarks,
+                                grace=float(os.environ.get("CANDLE_GRACE_SECONDS", "2")),
+                                max_delay=float(os.environ.get("CANDLE_MAX_DELAY_SECONDS", "10")))
+    if restored_minutes:
+        finalizer.finalized = min(restored_minutes) - 1
+    tasks.append(asyncio.create_task(finalizer.run()))
+    if candle_checkpoint is not None:
+        tasks.append(asyncio.create_task(
+            run_candle_checkpoint(int(os.environ.get("CANDLE_CHECKPOINT_MS", "1000")) / 1000)))
+    if frame_recorder is not None:
+        tasks.append(asyncio.create_task(
+            flush_frame_recorder(int(os.environ.get("FRAME_RECORD_FLUSH_MS", "1000")) / 1000)))
+
+    await asyncio.gather(*tasks)
+
+
+def run_worker(worker_id, plan, mapping, output, late=((), (), 0), session=None):
+    """
+    Entry point of an ingest worker process: own connections, decoder and candle state. late is the
+    (accounts, tokens, first connection id) of run_connections' late accounts, given to one worker;
+    session stamps the worker's tick profile with the coordinator's start.
+    """
+
+    def emit(buffers):
+        # Flat candles too, the coordinator folds them into the rollups
+        rows = candle_rows([buffer for buffer in buffers if not buffer.amendment], skip_flat=False)
+        amended_rows = candle_rows([buffer for buffer in buffers if buffer.amendment], skip_flat=False)
+        if rows or amended_rows:
+            output.put((worker_id, None, rows, amended_rows))
+        if market_depth:
+            # Depth aggregates are not rolled up, the worker stores them itself
+            try:
+                save_depth_rows_to_redis(depth_rows(buffers))
+            except Exception as e:
+                print(f"Error writing depth candles to redis: {e}")
+
+    def finalized(through_minute):
+        # After the rows of the same finalization, the coordinator folds a minute once every worker is past it
+        output.put((worker_id, through_minute, [], []))
+
+    async def worker():
+        global account_directory
+        account_directory = AccountDirectory(REDIS_DB_CLIENT,
+                                             dict.fromkeys([name for _, name, _ in plan] + list(late[0])))
+        account_directory.load()
+        account_directory.start()
+        redis_writer = init_redis_writer()
+        init_candle_engine(mapping, write=emit, finalized=finalized)
+        init_frame_recorder(mapping, worker_id)
+        init_tick_publisher(mapping, redis_writer)
+        init_tick_deduplicator()
+        init_tick_profile(worker_id, session)
+        init_tick_ring(mapping, worker_id)
+        init_candle_checkpoint(mapping, worker_id)
+        init_frame_workers()
+        await start_metrics(port_offset=worker_id + 1)
+        print(f"Ingest worker {worker_id}: {len(plan)} connections, {len(mapping)} tokens")
+        stop_on_sigterm()
+        try:
+            await run_connections(plan, *late)
+        finally:
+            close_tick_ring()
+            close_frame_recorder()
+
+    try:
+        asyncio.run(worker())
+    except asyncio.CancelledError:
+        print(f"Ingest worker {worker_id} stopped")
+
+
+async def main():
+    global account_directory
+    print("Initializing ZeroDha")
+    snapshot_path = os.environ.get("INSTRUMENT_SNAPSHOT", "instrument_snapshot.json")
+    broker_token_list_to_share, cirrus_token_to_broker_token_mapping, source = load_instruments(snapshot_path)
+    if snapshot_path:
+        asyncio.create_task(refresh_instruments(snapshot_path, cirrus_token_to_broker_token_mapping,
+                                                int(os.environ.get("INSTRUMENT_REFRESH_SECONDS", "300")),
+                                                immediately=source == "snapshot"))
 
     runner_key_start = 1
     runner_key_end = 12
     runners_names = [f"TS{runner_key}" for runner_key in range(runner_key_start, runner_key_end + 1)]
     print("Runners Names: ", runners_names)
 
-    account_list = REDIS_DB_CLIENT.hmget("ZERODHA_TOKENS_FOR_MINUTE_DATA", runners_names)
-    account_list = [json.loads(acc.decode('utf-8')) for acc in account_list if acc is not None]
-    if not account_list:
-        print("No Zerodha accounts found in Redis")
-        return
+    account_directory = AccountDirectory(REDIS_DB_CLIENT, runners_names)
+    ready = account_directory.load()
+    print(f"{len(ready)} of {len(runners_names)} Zerodha accounts logged in")
+    account_directory.start()
+    if not ready:
+        print("Waiting for a Zerodha account to log in")
+        ready = [await account_directory.next_ready()]
 
-    max_total_tokens = token_limit_per_connection * connection_per_account * len(account_list)
-    tokens_to_process = broker_token_list_to_share[:max_total_tokens]
+    standby = os.environ.get("HOT_STANDBY") == "1"
+    profile_file = os.environ.get("TICK_PROFILE", "tick_profile.json")
+    rates = load_profile(profile_file) if profile_file else {}
+    print(f"Placing tokens with tick rates for {len(rates)} tokens")
+    plan = plan_connections(ready, broker_token_list_to_share, standby=standby, rates=rates)
+    # Accounts still logging in are announced by ts_login_worker, the tokens that did not fit on the
+    # logged in ones are subscribed on their connections then
+    planned = {token for _, _, chunk in plan for token in chunk}
+    late_accounts = [name for name in runners_names if name not in ready]
+    late_tokens = [token for token in broker_token_list_to_share if token not in planned]
+    redis_writer = init_redis_writer()
+    init_candle_stores()
+    await start_metrics()
 
-    for account in account_list:
-        client_id = account["api_key"]
-        access_token = account["access_token"]
-
-        for _ in range(connection_per_account):
-            start = chunk_index * token_limit_per_connection
-            end = start + token_limit_per_connection
-            if start >= len(tokens_to_process):
-                break
-            token_chunk = tokens_to_process[start:end]
-            t = asyncio.create_task(fetch_zerodha_market_data(client_id, access_token, token_chunk))
-            tasks.append(t)
-            chunk_index += 1
-
-    print("Total connections created: ", len(tasks))
-    saver_task = asyncio.create_task(ohlc_flush_task_generator())
-    tasks.append(saver_task)
+    worker_count = int(os.environ.get("INGEST_WORKERS", "1"))
+    await start_query_service(live=worker_count <= 1)
+    if worker_count > 1:
+        # Workers close a minute by the clock at the latest grace + max delay after it ends
+        max_wait = (float(os.environ.get("CANDLE_GRACE_SECONDS", "2"))
+                    + float(os.environ.get("CANDLE_MAX_DELAY_SECONDS", "10")) + 3)
+        coordinator = ShardCoordinator(run_worker, plan, worker_count, cirrus_token_to_broker_token_mapping,
+                                       store_candle_rows, max_wait_seconds=max_wait,
+                                       late=(late_accounts, late_tokens, len(plan)), worker_args=(time.time(),))
+        stop_on_sigterm()
+        try:
+            await coordinator.run()
+        finally:
+            close_clickhouse_sinks()
+        return
 
-    await asyncio.gather(*tasks)
+    init_candle_engine(cirrus_token_to_broker_token_mapping)
+    init_frame_recorder(cirrus_token_to_broker_token_mapping)
+    init_tick_publisher(cirrus_token_to_broker_token_mapping, redis_writer)
+    init_tick_deduplicator()
+    init_tick_profile()
+    init_tick_ring(cirrus_token_to_broker_token_mapping)
+    init_candle_checkpoint(cirrus_token_to_broker_token_mapping)
+    init_frame_workers()
+    stop_on_sigterm()
+    try:
+        await run_connections(plan, late_accounts, late_tokens, len(plan))
+    finally:
+        close_tick_ring()
+        close_frame_recorder()
+        # Queued rows are inserted, or spilled to CLICKHOUSE_SPILL_DIR for the next start to replay
+        close_clickhouse_sinks()
 
 
-asyncio.run(main())
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except asyncio.CancelledError:
+        print("Ingester stopped")
@@ -1,123 +1,355 @@
 import json
+import os
 import threading
-from collections import defaultdict
+import time
 from datetime import datetime
+from functools import partial
 
-from database import REDIS_DATA_STORE
-
-# from clickhouse_connect import get_client
+from candle_engine import CandleEngine, CandleRollup, CandleWriter
+from database import REDIS_DATA_STORE, candle_redis_shard_uris
+from storage.candle_codec import candle_key, depth_key, encode_candle, encode_depth, minute_field
+from storage.candle_retention import CandleRetention
+from storage.clickhouse_sink import ClickHouseSink
+from storage.redis_shards import RedisShards
+from storage.segment_store import SegmentStore
+from utils.metrics import AMENDED_CANDLES, CANDLES_WRITTEN, EXCHANGE_TO_WRITE, FLUSH_SECONDS, LATE_TICKS
 
 time_lower_limit = datetime.now().replace(hour=9, minute=14, second=0, microsecond=0)
 time_upper_limit = datetime.now().replace(hour=15, minute=31, second=0, microsecond=0)
 
-# clickhouse_client = get_client(host='localhost', port=8123)
-
-ohlc_snaps = defaultdict(lambda: defaultdict(lambda: {
-    "open": None, "high": float("-inf"), "low": float("inf"), "close": None,
-    "atp": 0.0, "volume": 0, "oi": 0
-}))
-
-
-# def ensure_table_exists():
-#     tables = clickhouse_client.query("SHOW TABLES").result_rows
-#     if not any(row[0] == 'ohlc' for row in tables):
-#         clickhouse_client.command("""
-#                                   CREATE TABLE ohlc
-#                                   (
-#                                       token     String,
-#                                       timestamp DateTime('Asia/Kolkata'),
-#                                       open      Float32,
-#                                       high      Float32,
-#                                       low       Float32,
-#                                       close     Float32,
-#                                       atp       Nullable(Float32),
-#                                       volume    Nullable(UInt64),
-#                                       oi        Nullable(UInt64)
-#                                   ) ENGINE = ReplacingMergeTree()
-#         ORDER BY (token, timestamp)
-#                                   """)
-#         print("✅ ClickHouse OHLC table created.")
-#
-#
-# ensure_table_exists()
-
-
-def save_candles_to_storage():
-    # ensure_table_exists()
-    rows = []
-    current_minute = datetime.now().replace(second=0, microsecond=0)
+# Keep writing the legacy JSON MINUTE_CANDLES:{token} hashes next to the binary ones while consumers migrate
+candle_json_compat = os.environ.get("CANDLE_JSON_COMPAT", "0") == "1"
 
-    pipe = REDIS_DATA_STORE.pipeline()
-    for token, minutes in list(ohlc_snaps.items()):
-        for minute, candle in list(minutes.items()):
-            if current_minute <= minute:
-                continue
-            if candle["open"] == candle["high"] == candle["low"] == candle["close"]:
-                del ohlc_snaps[token][minute]
-                continue
-            if not (time_lower_limit <= current_minute <= time_upper_limit):
-                del ohlc_snaps[token][minute]
-                print("⚠️ Skipping candle outside trading hours:", token, minute)
-                continue
-            rows.append((
-                token,
-                minute,
-                candle["open"],
-                candle["high"],
-                candle["low"],
-                candle["close"],
-                candle.get("atp"),
-                candle.get("volume"),
-                candle.get("oi"),
-            ))
-            pipe.hset(f"MINUTE_CANDLES:{token}", minute.strftime("%H:%M"), json.dumps(candle))
-            del ohlc_snaps[token][minute]
-
-        if not ohlc_snaps[token]:
-            del ohlc_snaps[token]
-
-    if rows:
-        pipe.execute()
-        # clickhouse_client.insert(
-        #     table='ohlc',
-        #     data=rows,
-        #     column_names=['token', 'timestamp', 'open', 'high', 'low', 'close', 'atp', 'volume', 'oi']
-        # )
-
-        print(f"✅ Inserted {len(rows)} unique candles to REDIS.")
+candle_stores = []
+clickhouse_sink = None
+segment_store = None
+# Higher timeframes folded from the closed 1m candles, e.g. CANDLE_ROLLUPS=5m,15m,60m,day (empty to disable)
+candle_rollups = []
+rollup_stores = {}
+rollup_sinks = []
+# Called with (rows, timeframe) after rows were written, e.g. to feed the query service cache
+candle_listeners = []
+# Pooled async writes over CANDLE_REDIS_SHARDS, REDIS_DATA_STORE pipelines until init_redis_writer()
+redis_writer = None
+# CANDLE_RETENTION_DAYS=N drops candle and depth fields older than N days from the Redis hashes, 0 keeps all
+candle_retention = None
+
+
+def init_redis_writer():
+    global redis_writer
+    if redis_writer is not None:
+        redis_writer.close()
+    # Tick writes are only worth their latest value, past REDIS_TICK_PENDING queued batches new ones are merged
+    redis_writer = RedisShards(candle_redis_shard_uris,
+                               pool_size=int(os.environ.get("REDIS_POOL_SIZE", "32")),
+                               pipeline_size=int(os.environ.get("REDIS_PIPELINE_SIZE", "1000")),
+                               lane_limits={"ticks": int(os.environ.get("REDIS_TICK_PENDING", "1000"))})
+    print(f"Writing to {len(candle_redis_shard_uris)} redis shard(s), "
+          f"pipelines of up to {redis_writer.pipeline_size} commands")
+    return redis_writer
+
+
+def _redis_pipeline(lane):
+    if redis_writer is None:
+        return REDIS_DATA_STORE.pipeline()
+    return redis_writer.pipeline(lane)
+
+
+def init_clickhouse_sink(timeframe="1m"):
+    """Start a sink for one timeframe: table ohlc for 1m, ohlc_{timeframe} for rollups."""
+    global clickhouse_sink
+    host = os.environ.get("CLICKHOUSE_HOST")
+    if not host:
+        return None
+    from clickhouse_connect import get_client
+
+    # A client per sink, a clickhouse_connect session does not allow concurrent queries
+    client = get_client(host=host, port=int(os.environ.get("CLICKHOUSE_PORT", "8123")))
+    spill_dir = os.environ.get("CLICKHOUSE_SPILL_DIR")
+    if timeframe == "1m":
+        sink = clickhouse_sink = ClickHouseSink(client, spill_dir=spill_dir)
     else:
-        print("⚠️ No candles to insert.")
+        if spill_dir:
+            spill_dir = os.path.join(spill_dir, timeframe)
+        sink = ClickHouseSink(client, table=f"ohlc_{timeframe}", spill_dir=spill_dir)
+        rollup_sinks.append(sink)
+    sink.ensure_table()
+    sink.start()
+    print(f"✅ ClickHouse sink for {timeframe} candles started.")
+    return sink
+
+
+def close_clickhouse_sinks(timeout=10.0):
+    """Stop every ClickHouse sink, each inserting (or spilling) what is queued for up to timeout seconds."""
+    for sink in ([clickhouse_sink] if clickhouse_sink is not None else []) + rollup_sinks:
+        sink.stop(timeout)
+
+
+def _session_minutes():
+    # ROLLUP_SESSION=09:15-15:30, local time, anchors and cuts the rollup periods
+    start, end = os.environ.get("ROLLUP_SESSION", "09:15-15:30").split("-")
+    return [int(part[:2]) * 60 + int(part[3:]) for part in (start, end)]
+
+
+def _stores_for(timeframe):
+    stores = []
+    for name in os.environ.get("CANDLE_STORES", "redis").split(","):
+        name = name.strip()
+        if name == "redis":
+            stores.append(("redis", partial(save_rows_to_redis, timeframe=timeframe)))
+        elif name == "segments":
+            root = os.environ.get("SEGMENT_STORE_DIR", "segments")
+            if timeframe == "1m":
+                global segment_store
+                segment_store = SegmentStore(root)
+                stores.append(("segments", segment_store.write))
+            else:
+                stores.append(("segments", SegmentStore(os.path.join(root, timeframe)).write))
+        elif name == "clickhouse":
+            sink = init_clickhouse_sink(timeframe)
+            if sink is not None:
+                stores.append(("clickhouse", sink.submit))
+        elif name:
+            print(f"⚠️ Unknown candle store {name}")
+    return stores
+
+
+def init_candle_stores():
+    """
+    Select where closed candles go, e.g. CANDLE_STORES=redis,segments,clickhouse.
+    Every store is a (name, callable) pair, the callable takes the rows built by candle_rows.
+    Each rollup timeframe gets the same stores with its own destination (key, directory or table).
+    """
+    candle_stores[:] = _stores_for("1m")
+    session_open, session_close = _session_minutes()
+    candle_rollups[:] = [
+        CandleRollup(name.strip(), session_open, session_close)
+        for name in os.environ.get("CANDLE_ROLLUPS", "5m,15m,60m,day").split(",") if name.strip()
+    ]
+    rollup_stores.clear()
+    for rollup in candle_rollups:
+        rollup_stores[rollup.name] = _stores_for(rollup.name)
+    if candle_rollups:
+        print(f"Rolling 1m candles up to {', '.join(rollup.name for rollup in candle_rollups)}")
+    init_candle_retention()
+    return candle_stores
+
+
+def init_candle_retention():
+    global candle_retention
+    days = int(os.environ.get("CANDLE_RETENTION_DAYS", "0"))
+    candle_retention = None
+    if days > 0 and any(name == "redis" for name, _ in candle_stores):
+        candle_retention = CandleRetention(candle_redis_shard_uris, days, in_trading_hours)
+        print(f"Keeping {days} days of candles in redis")
+    return candle_retention
+
+
+candle_engine = CandleEngine({})
+candle_writer = None
+# MARKET_DEPTH=1 decodes the 5 depth levels of full packets and stores per-minute spread/imbalance
+market_depth = os.environ.get("MARKET_DEPTH", "0") == "1"
+# Minutes after finalization a late tick still amends its candle, CANDLE_AMEND_MINUTES=0 only counts them
+amend_minutes = int(os.environ.get("CANDLE_AMEND_MINUTES", "0"))
+late_ticks_counted = [0, 0]
+# Serializes candle (and other ingest) state between frame worker threads and the event loop
+ingest_lock = threading.Lock()
+
+
+def init_candle_engine(broker_to_cirrus_mapping, write=None, finalized=None):
+    global candle_engine, candle_writer
+    if candle_writer is not None:
+        candle_writer.close()
+    candle_engine = CandleEngine(broker_to_cirrus_mapping, amend_window=amend_minutes, depth=market_depth)
+    late_ticks_counted[:] = [0, 0]
+    candle_writer = CandleWriter(candle_engine, write or save_candles_to_storage, finalized)
+    report = candle_engine.memory_report()
+    print(f"Candle engine ready: {report['instruments']} instruments, "
+          f"{report['bytes_per_instrument']} bytes/instrument, "
+          f"{report['bytes_per_minute_buffer'] / 1024:.1f} KiB per minute buffer")
+    return candle_engine
+
+
+def candle_rows(buffers, skip_flat=True):
+    rows = []
+    names = candle_engine.names
+    for buffer in buffers:
+        minute = buffer.minute
+        for slot, o, h, l, c, atp, volume, oi in buffer.candles():
+            if skip_flat and o == h == l == c:
+                continue
+            rows.append((names[slot], minute, o, h, l, c, atp, volume, oi))
+    return rows
 
 
-def process_tick(data: dict):
-    token = data["token"]
-    ltp = data.get("ltp", 0.0)
-    atp = data.get("atp", 0.0)
-    volume = data.get("volume", 0)
-    oi = data.get("oi", 0)
-    ts = datetime.fromtimestamp(data["timestamp"])
-    minute_key = ts.replace(second=0, microsecond=0)
+def depth_rows(buffers):
+    """(token, minute, spread, imbalance) of every quoted slot within trading hours."""
+    rows = []
+    names = candle_engine.names
+    for buffer in buffers:
+        minute = buffer.minute
+        if not in_trading_hours(minute):
+            continue
+        for slot, spread, imbalance in buffer.depth_candles():
+            rows.append((names[slot], minute, spread, imbalance))
+    return rows
+
 
-    if ltp == 0 and atp == 0 and volume == 0 and oi == 0:
+def save_depth_rows_to_redis(rows):
+    if not rows:
         return
+    pipe = _redis_pipeline("depth")
+    for token, minute, spread, imbalance in rows:
+        pipe.hset(depth_key(token), minute_field(minute), encode_depth(minute, spread, imbalance))
+    pipe.execute()
+
+
+def in_trading_hours(minute):
+    # A candle is kept if it would have been flushed (at the following minute) within trading hours
+    flushed_at = datetime.fromtimestamp((minute + 1) * 60).time()
+    return time_lower_limit.time() <= flushed_at <= time_upper_limit.time()
+
+
+def save_candle_rows(rows, timeframe="1m", closes_at=None):
+    """Write rows of one timeframe to its stores. closes_at (epoch seconds) defaults to the last 1m close."""
+    minutes = {row[1] for row in rows}
+    outside = {minute for minute in minutes if not in_trading_hours(minute)}
+    if outside:
+        kept = [row for row in rows if row[1] not in outside]
+        print(f"⚠️ Skipping {len(rows) - len(kept)} candles outside trading hours")
+        rows = kept
+    if not rows:
+        print("⚠️ No candles to insert.")
+        return
+
+    last_close = closes_at or (max(minutes) + 1) * 60
+    stores = candle_stores if timeframe == "1m" else rollup_stores.get(timeframe, ())
+    for name, store in stores:
+        start = time.perf_counter()
+        try:
+            store(rows)
+        except Exception as e:
+            print(f"Error writing {timeframe} candles to {name}: {e}")
+            continue
+        labels = (name, timeframe)
+        FLUSH_SECONDS.observe(time.perf_counter() - start, labels)
+        EXCHANGE_TO_WRITE.observe(time.time() - last_close, labels)
+        CANDLES_WRITTEN.inc(len(rows), labels)
+    for listener in candle_listeners:
+        try:
+            listener(rows, timeframe)
+        except Exception as e:
+            print(f"Error in candle listener: {e}")
+
+
+def save_rows_to_redis(rows, timeframe="1m"):
+    pipe = _redis_pipeline("candles")
+    for token, minute, o, h, l, c, atp, volume, oi in rows:
+        pipe.hset(candle_key(token, timeframe), minute_field(minute),
+                  encode_candle(minute, o, h, l, c, atp, volume, oi))
+        if candle_json_compat and timeframe == "1m":
+            candle = {"open": o, "high": h, "low": l, "close": c, "atp": atp, "volume": volume, "oi": oi}
+            field = datetime.fromtimestamp(minute * 60).strftime("%H:%M")
+            pipe.hset(f"MINUTE_CANDLES:{token}", field, json.dumps(candle))
+
+    pipe.execute()
+    print(f"✅ Inserted {len(rows)} unique {timeframe} candles to REDIS.")
+
+
+def store_candle_rows(rows, amended_rows=()):
+    """
+    Write closed 1m rows and every higher timeframe period they close. rows include flat candles,
+    which are folded into the rollups but, as before, not stored as 1m candles. amended_rows replace
+    already written 1m candles and only touch rollup periods that are still open.
+    """
+    save_candle_rows([row for row in list(amended_rows) + rows if not row[2] == row[3] == row[4] == row[5]])
+    if candle_retention is not None and rows:
+        # The day's first flush sweeps the day that fell out of the retention
+        candle_retention.maybe_sweep(datetime.fromtimestamp(max(row[1] for row in rows) * 60).date())
+    for rollup in candle_rollups:
+        # Before the fold, which may close the period an amended minute belongs to
+        rollup.amend(amended_rows)
+        closed = rollup.fold(rows)
+        if closed:
+            save_candle_rows(closed, rollup.name, closes_at=rollup.period(max(row[1] for row in closed))[1] * 60)
+
+
+def save_candles_to_storage(buffers):
+    store_candle_rows(candle_rows([buffer for buffer in buffers if not buffer.amendment], skip_flat=False),
+                      candle_rows([buffer for buffer in buffers if buffer.amendment], skip_flat=False))
+    if market_depth:
+        try:
+            save_depth_rows_to_redis(depth_rows(buffers))
+        except Exception as e:
+            print(f"Error writing depth candles to redis: {e}")
+
+
+def live_candles(token, timeframe="1m"):
+    """Still-forming candles of a Cirrus token for a timeframe, oldest first. Call on the event loop thread."""
+    with ingest_lock:
+        candles = candle_engine.live_candles(token)
+    if timeframe == "1m":
+        return candles
+    for rollup in candle_rollups:
+        if rollup.name == timeframe:
+            return rollup.peek(token, candles)
+    return []
+
+
+def restore_candles(minutes, since_minute):
+    """Load checkpointed open minutes from since_minute on into the engine, {minute: candles restored}."""
+    with ingest_lock:
+        return {minute: candle_engine.restore(minute, candles)
+                for minute, candles in sorted(minutes.items()) if minute >= since_minute}
+
+
+def update_instruments(added, renamed):
+    """
+    Give added broker tokens candle slots and point renamed ones at their new Cirrus token, both
+    {broker token: Cirrus token}. Returns the engine's broker token -> Cirrus token mapping after it.
+    """
+    with ingest_lock:
+        candle_engine.add_tokens(added)
+        for broker_token, cirrus_token in renamed.items():
+            candle_engine.rename(broker_token, cirrus_token)
+        return {broker_token: candle_engine.names[slot] for broker_token, slot in candle_engine.slots.items()}
+
+
+def checkpoint_candles(checkpoint):
+    with ingest_lock:
+        return checkpoint.write(candle_engine)
+
+
+def process_ticks(batch):
+    candle_engine.update(batch)
+
 
-    candle = ohlc_snaps[token][minute_key]
+def _count_late_ticks():
+    amended, dropped = candle_engine.late_amended, candle_engine.late_dropped
+    if amended != late_ticks_counted[0]:
+        LATE_TICKS.inc(amended - late_ticks_counted[0], ("amended",))
+    if dropped != late_ticks_counted[1]:
+        LATE_TICKS.inc(dropped - late_ticks_counted[1], ("dropped",))
+    late_ticks_counted[:] = [amended, dropped]
 
-    if ltp > 0:
-        if candle["open"] is None:
-            candle["open"] = ltp
-        candle["high"] = max(candle["high"], ltp)
-        candle["low"] = min(candle["low"], ltp)
-        candle["close"] = ltp
 
-    if atp > 0:
-        candle["atp"] = atp
-    if volume > 0:
-        candle["volume"] = volume
-    if oi > 0:
-        candle["oi"] = oi
+async def finalize_candles(through_minute):
+    """
+    Close every minute up to through_minute and hand it, with any amended candles, to the writer thread.
+    Runs on the event loop; frame workers feed process_ticks under ingest_lock.
+    """
+    with ingest_lock:
+        closed, amended = candle_engine.finalize(through_minute)
+    _count_late_ticks()
+    if amended:
+        AMENDED_CANDLES.inc(sum(len(buffer.touched) for buffer in amended))
+    if closed or amended or candle_writer.finalized is not None:
+        candle_writer.submit(closed + amended, through_minute)
+    return len(closed)
 
 
-def threaded_save():
-    thread = threading.Thread(target=save_candles_to_storage)
-    thread.start()
+async def rollover_candles(current_minute=None):
+    """Finalize every minute before current_minute (epoch minutes, default the wall-clock minute)."""
+    if current_minute is None:
+        current_minute = int(datetime.now().timestamp()) // 60
+    return await finalize_candles(current_minute - 1)
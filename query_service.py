@@ -0,0 +1,286 @@
+"""
+Candle query service running inside the ingester.
+
+Closed candles are kept in an LRU-bounded in-memory cache as they are written, misses are read from
+Redis (or the segment store when Redis is not a candle store) and cached, and the still-forming candle
+comes straight from the candle engine. HTTP/1.1 with JSON, one request per connection:
+
+    GET  /candles?token=CT:X&from=M&to=M[&timeframe=5m][&live=1]    candles with from <= minute < to
+    GET  /latest?tokens=CT:X,CT:Y[&n=20][&timeframe=1m][&live=1]     last n candles per token
+    POST /batch   {"queries": [{"token", "from", "to", "timeframe", "live"}, ...]}
+                  {"tokens": [...], "n": 20, "timeframe": "1m", "live": true}
+
+Minutes are epoch minutes and candles are [minute, open, high, low, close, atp, volume, oi].
+"""
+import asyncio
+import json
+import os
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+from storage.candle_codec import CANDLE_FIELDS, fetch_many
+from storage.redis_shards import shard_index
+from storage.segment_store import SegmentStore
+
+_NO_END = 2 ** 32
+
+
+class CandleSeries:
+    """Cached candles of one (timeframe, token), complete for every minute >= since."""
+    __slots__ = ("since", "minutes", "candles")
+
+    def __init__(self, since):
+        self.since = since
+        self.minutes = []
+        self.candles = []
+
+    def add(self, candle):
+        minute = candle[0]
+        if not self.minutes or minute > self.minutes[-1]:
+            self.minutes.append(minute)
+            self.candles.append(candle)
+            return 1
+        i = bisect_left(self.minutes, minute)
+        if i < len(self.minutes) and self.minutes[i] == minute:
+            self.candles[i] = candle
+            return 0
+        self.minutes.insert(i, minute)
+        self.candles.insert(i, candle)
+        return 1
+
+    def range(self, start, end):
+        return self.candles[bisect_left(self.minutes, start):bisect_left(self.minutes, end)]
+
+    def trim(self, keep):
+        dropped = len(self.candles) - keep
+        if dropped > 0:
+            del self.minutes[:dropped], self.candles[:dropped]
+            self.since = self.minutes[0]
+        return max(dropped, 0)
+
+
+class CandleCache:
+    """
+    LRU of CandleSeries bounded by the total number of candles held. add_rows is called by the candle
+    writer thread, reads come from the event loop, so both take the lock.
+    """
+
+    def __init__(self, max_candles=1_000_000, max_per_series=1500):
+        self.max_candles = max_candles
+        self.max_per_series = max_per_series
+        self.series = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _evict(self):
+        while self.size > self.max_candles and self.series:
+            _, series = self.series.popitem(last=False)
+            self.size -= len(series.candles)
+
+    def add_rows(self, rows, timeframe="1m"):
+        """Cache freshly written rows; a new series is complete from its first row on."""
+        with self.lock:
+            for token, minute, *values in rows:
+                key = (timeframe, token)
+                series = self.series.get(key)
+                if series is None:
+                    series = self.series[key] = CandleSeries(minute)
+                self.size += series.add((minute, *values))
+                self.size -= series.trim(self.max_per_series)
+            self._evict()
+
+    def load(self, timeframe, token, candles, since):
+        """Merge candles read from a store, complete for minutes >= since."""
+        with self.lock:
+            key = (timeframe, token)
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = CandleSeries(since)
+            series.since = min(series.since, since)
+            for candle in candles:
+                self.size += series.add(candle)
+            self.size -= series.trim(self.max_per_series)
+            self.series.move_to_end(key)
+            self._evict()
+
+    def range(self, timeframe, token, start, end):
+        """Candles in [start, end), or None when the cache does not cover start."""
+        with self.lock:
+            series = self.series.get((timeframe, token))
+            if series is None or series.since > start:
+                self.misses += 1
+                return None
+            self.series.move_to_end((timeframe, token))
+            self.hits += 1
+            return series.range(start, end)
+
+    def latest(self, timeframe, token, n):
+        """Last n candles, or None when fewer than n are cached and older ones may exist."""
+        with self.lock:
+            series = self.series.get((timeframe, token))
+            if series is None or (len(series.candles) < n and series.since > 0):
+                self.misses += 1
+                return None
+            self.series.move_to_end((timeframe, token))
+            self.hits += 1
+            return series.candles[-n:] if n else []
+
+
+class CandleQueryService:
+    def __init__(self, cache, redis_client=None, segment_root=None, live_candles=None):
+        self.cache = cache
+        # A client, or the candle shards' clients in CANDLE_REDIS_SHARDS order
+        self.redis = redis_client
+        self.segment_root = segment_root
+        # live_candles(token, timeframe) -> still-forming candles, called on the event loop thread
+        self.live_candles = live_candles
+
+    def _fetch_store(self, timeframe, tokens):
+        """{token: all stored candles as tuples}, blocking, run in an executor."""
+        if self.redis is not None:
+            if isinstance(self.redis, list):
+                # Candle shards, each token's keys live on one of them
+                by_shard = {}
+                for token in tokens:
+                    by_shard.setdefault(shard_index(token, len(self.redis)), []).append(token)
+                fetched = {}
+                for shard, shard_tokens in by_shard.items():
+                    fetched.update(fetch_many(self.redis[shard], shard_tokens, timeframe))
+            else:
+                fetched = fetch_many(self.redis, tokens, timeframe)
+            return {token: [tuple(candle[field] for field in CANDLE_FIELDS) for candle in candles]
+                    for token, candles in fetched.items()}
+        if self.segment_root is not None:
+            root = self.segment_root if timeframe == "1m" else os.path.join(self.segment_root, timeframe)
+            result = {token: [] for token in tokens}
+            if not os.path.isdir(root):
+                return result
+            store = SegmentStore(root)
+            for day in sorted(os.listdir(root)):
+                if not day.isdigit():
+                    continue
+                reader = store.reader(day)
+                try:
+                    for token in tokens:
+                        result[token].extend(tuple(candle[field] for field in CANDLE_FIELDS)
+                                             for candle in reader.token(token))
+                finally:
+                    reader.close()
+            return result
+        return {token: [] for token in tokens}
+
+    async def _fill(self, timeframe, tokens):
+        """Read tokens from the store, cache them and return {token: candles}."""
+        if not tokens:
+            return {}
+        loop = asyncio.get_running_loop()
+        fetched = await loop.run_in_executor(None, self._fetch_store, timeframe, tokens)
+        for token, candles in fetched.items():
+            # A store read returns everything there is for the token
+            self.cache.load(timeframe, token, candles, 0)
+        return fetched
+
+    def _with_live(self, token, timeframe, candles, start=0, end=_NO_END):
+        if self.live_candles is None:
+            return candles
+        live = [candle for candle in self.live_candles(token, timeframe) if start <= candle[0] < end]
+        if not live:
+            return candles
+        first_live = live[0][0]
+        return [candle for candle in candles if candle[0] < first_live] + live
+
+    async def ranges(self, queries):
+        """queries: [(token, start, end, timeframe, live)] -> list of candle lists, one store round trip per timeframe."""
+        results = [self.cache.range(timeframe, token, start, end) for token, start, end, timeframe, _ in queries]
+        missing = {}
+        for (token, _, _, timeframe, _), result in zip(queries, results):
+            if result is None:
+                missing.setdefault(timeframe, set()).add(token)
+        fetched = {}
+        for timeframe, tokens in missing.items():
+            fetched[timeframe] = await self._fill(timeframe, sorted(tokens))
+        answers = []
+        for (token, start, end, timeframe, live), result in zip(queries, results):
+            if result is None:
+                # Served from the read itself, the cache may keep only the most recent part of it
+                result = [candle for candle in fetched[timeframe].get(token, ()) if start <= candle[0] < end]
+            answers.append(self._with_live(token, timeframe, result, start, end) if live else result)
+        return answers
+
+    async def latest(self, tokens, n, timeframe="1m", live=False):
+        results = {token: self.cache.latest(timeframe, token, n) for token in tokens}
+        fetched = await self._fill(timeframe, [token for token, result in results.items() if result is None])
+        answers = {}
+        for token, result in results.items():
+            if result is None:
+                result = fetched.get(token, [])[-n:] if n else []
+            if live:
+                result = self._with_live(token, timeframe, result)[-n:]
+            answers[token] = result
+        return answers
+
+    async def handle(self, method, path, body):
+        url = urlsplit(path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if method == "GET" and url.path == "/candles":
+            timeframe = params.get("timeframe", "1m")
+            query = (params["token"], int(params.get("from", 0)), int(params.get("to", _NO_END)), timeframe,
+                     params.get("live") == "1")
+            return {"fields": CANDLE_FIELDS, "candles": (await self.ranges([query]))[0]}
+        if method == "GET" and url.path == "/latest":
+            tokens = [token for token in params.get("tokens", "").split(",") if token]
+            candles = await self.latest(tokens, int(params.get("n", 1)), params.get("timeframe", "1m"),
+                                        params.get("live") == "1")
+            return {"fields": CANDLE_FIELDS, "candles": candles}
+        if method == "POST" and url.path == "/batch":
+            request = json.loads(body or b"{}")
+            if "queries" in request:
+                queries = [(q["token"], int(q.get("from", 0)), int(q.get("to", _NO_END)), q.get("timeframe", "1m"),
+                            bool(q.get("live"))) for q in request["queries"]]
+                return {"fields": CANDLE_FIELDS, "results": await self.ranges(queries)}
+            candles = await self.latest(request.get("tokens", []), int(request.get("n", 1)),
+                                        request.get("timeframe", "1m"), bool(request.get("live")))
+            return {"fields": CANDLE_FIELDS, "candles": candles}
+        return None
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            parts = request.decode("latin-1").split()
+            try:
+                result = await self.handle(parts[0], parts[1], body) if len(parts) >= 2 else None
+                status = "200 OK" if result is not None else "404 Not Found"
+                payload = json.dumps(result if result is not None else {"error": "not found"},
+                                     separators=(",", ":")).encode()
+            except (KeyError, ValueError, TypeError, AttributeError) as e:
+                # Malformed JSON or a body of the wrong shape, e.g. a list or null where an object belongs
+                status = "400 Bad Request"
+                payload = json.dumps({"error": f"bad request: {e}"}).encode()
+            except Exception as e:
+                print(f"Candle query failed: {e}")
+                status = "500 Internal Server Error"
+                payload = json.dumps({"error": "internal error"}).encode()
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+            await writer.drain()
+        except Exception as e:
+            print(f"Candle query failed: {e}")
+        finally:
+            writer.close()
+
+    async def start(self, port, host="127.0.0.1"):
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        print(f"Candle queries on http://{host}:{port}")
+        return server
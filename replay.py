@@ -0,0 +1,105 @@
+"""
+Replay a frame recording through the ingest path: decode -> candle engine -> rollover -> candle stores.
+
+The clock is simulated from the recorded receive times: at each frame a CandleFinalizer closes what
+would have been due live at that receive time, by the same grace past the connections' exchange-time
+watermarks (CANDLE_GRACE_SECONDS) and the same local-clock deadline (CANDLE_MAX_DELAY_SECONDS), so a
+tick that arrived shortly after its minute ended lands in the candle as it did live.
+    python replay.py RECORDING_DIR [RECORDING_DIR ...] [--speed 1|10|max] [--dry-run]
+With several directories (one per ingest worker) frames are merged by receive time.
+Candles go to the stores selected by CANDLE_STORES unless --dry-run is given.
+"""
+import argparse
+import asyncio
+import heapq
+import os
+import time
+
+import ohlc_handler
+from candle_finalizer import CandleFinalizer, Watermarks
+from helpers.zerodha_helpers import decode_binary_ticks, parse_text_message
+from utils.frame_recorder import BINARY_FRAME, load_session, read_frames, recording_files
+
+
+async def replay(directories, speed=None, dry_run=False):
+    mapping = {}
+    for directory in directories:
+        mapping.update(load_session(directory))
+
+    written = []
+    if dry_run:
+        ohlc_handler.init_candle_engine(mapping, write=lambda buffers: written.extend(ohlc_handler.candle_rows(buffers)))
+    else:
+        # Writes go over CANDLE_REDIS_SHARDS as in main, REDIS_DATA_STORE alone may not be configured
+        ohlc_handler.init_redis_writer()
+        ohlc_handler.init_candle_stores()
+        ohlc_handler.init_candle_engine(mapping)
+
+    streams = [read_frames(recording_files(directory)) for directory in directories]
+    frames = ticks = rollovers = 0
+    first_received = None
+    started = time.perf_counter()
+    now = None
+    # Watermarks go stale and minutes close by the clock on receive time, as they did live
+    watermarks = Watermarks(clock=lambda: now)
+    finalizer = CandleFinalizer(ohlc_handler.finalize_candles, watermarks,
+                                grace=float(os.environ.get("CANDLE_GRACE_SECONDS", "2")),
+                                max_delay=float(os.environ.get("CANDLE_MAX_DELAY_SECONDS", "10")))
+
+    for received_at, kind, connection_id, payload in heapq.merge(*streams, key=lambda record: record[0]):
+        if first_received is None:
+            first_received = received_at
+        if speed is not None:
+            delay = (received_at - first_received) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        now = received_at
+        rollovers += await finalizer.step(now) or 0
+
+        frames += 1
+        if kind == BINARY_FRAME:
+            # Depth is decoded as live (MARKET_DEPTH), so replayed spread/imbalance match the recorded run
+            batch = decode_binary_ticks(payload, ohlc_handler.market_depth)
+            ohlc_handler.process_ticks(batch)
+            ticks += len(batch)
+            newest = max(batch.timestamp, default=0)
+            if newest:
+                watermarks.advance(connection_id, newest)
+        else:
+            parse_text_message(payload)
+
+    if now is not None:
+        rollovers += await ohlc_handler.rollover_candles(int(now) // 60 + 2)
+    ohlc_handler.candle_writer.close()
+    if ohlc_handler.redis_writer is not None:
+        ohlc_handler.redis_writer.close()
+    ohlc_handler.close_clickhouse_sinks()
+    elapsed = time.perf_counter() - started
+    return {
+        "frames": frames,
+        "ticks": ticks,
+        "minutes_closed": rollovers,
+        "seconds": elapsed,
+        "ticks_per_sec": ticks / elapsed if elapsed else 0.0,
+        "candles": len(written) if dry_run else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directories", nargs="+")
+    parser.add_argument("--speed", default="max", help="1 for real time, N for N times faster, max for unthrottled")
+    parser.add_argument("--dry-run", action="store_true", help="aggregate but do not write candles anywhere")
+    args = parser.parse_args()
+
+    speed = None if args.speed == "max" else float(args.speed)
+    result = asyncio.run(replay(args.directories, speed, args.dry_run))
+    print(f"Replayed {result['frames']:,} frames / {result['ticks']:,} ticks in {result['seconds']:.2f}s "
+          f"({result['ticks_per_sec']:,.0f} ticks/sec), {result['minutes_closed']} minutes closed")
+    if args.dry_run:
+        print(f"{result['candles']:,} candles built")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Memory-mapped checkpoint of the candle engine's open minutes, for a warm restart mid-session.
+
+File layout (little-endian):
+    header     magic "CKPT" | version u16 | region count u16 | slot count u32 | finalized i64 |
+               written at f64 | 36 pad bytes
+    directory  slot count x (broker token u32, Cirrus token 48 bytes, NUL padded)
+    regions    region count x (minute i64 | slot count x record)
+    record     minute u32 | open, high, low, close, atp f64 | volume, oi i64 | ticks u32
+
+A region holds one open minute. Records carry their own minute, so a region is reused without being
+cleared: records left from an earlier minute are ignored on restore. Only slots whose tick count
+moved since the last write are rewritten, which keeps a checkpoint to the slots that actually ticked.
+Writes land in the page cache, so the checkpoint survives the process (not the host) going down.
+"""
+import mmap
+import os
+import struct
+import time
+from array import array
+
+MAGIC = b"CKPT"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIqd36x")
+DIRECTORY_ENTRY = struct.Struct("<I48s")
+REGION_HEADER = struct.Struct("<q")
+RECORD = struct.Struct("<I5d2qI")
+
+
+def checkpoint_size(slot_count, region_count):
+    return (HEADER.size + slot_count * DIRECTORY_ENTRY.size
+            + region_count * (REGION_HEADER.size + slot_count * RECORD.size))
+
+
+def load_checkpoint(path):
+    """
+    (finalized minute, {minute: [(broker token, open, high, low, close, atp, volume, oi, ticks)]}) of the
+    open minutes in a checkpoint file, None if there is no usable one.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if len(data) < HEADER.size:
+        return None
+    magic, version, region_count, slot_count, finalized, _ = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION or len(data) < checkpoint_size(slot_count, region_count):
+        return None
+    broker_tokens = [DIRECTORY_ENTRY.unpack_from(data, HEADER.size + slot * DIRECTORY_ENTRY.size)[0]
+                     for slot in range(slot_count)]
+    region_size = REGION_HEADER.size + slot_count * RECORD.size
+    regions_start = HEADER.size + slot_count * DIRECTORY_ENTRY.size
+    minutes = {}
+    for region in range(region_count):
+        offset = regions_start + region * region_size
+        minute = REGION_HEADER.unpack_from(data, offset)[0]
+        if minute < 0 or minute <= finalized:
+            continue
+        candles = []
+        for slot, record in enumerate(RECORD.iter_unpack(data[offset + REGION_HEADER.size:offset + region_size])):
+            if record[0] == minute and record[-1]:
+                candles.append((broker_tokens[slot],) + record[1:])
+        minutes[minute] = candles
+    return finalized, minutes
+
+
+class CandleCheckpoint:
+    def __init__(self, path, broker_to_cirrus_mapping, region_count=4):
+        self.path = path
+        self.slot_count = len(broker_to_cirrus_mapping)
+        self.region_count = region_count
+        self.region_size = REGION_HEADER.size + self.slot_count * RECORD.size
+        self.regions_start = HEADER.size + self.slot_count * DIRECTORY_ENTRY.size
+        size = checkpoint_size(self.slot_count, region_count)
+        # A fresh file every start, whatever was in it has been restored by then
+        with open(path, "wb") as f:
+            f.truncate(size)
+        self.file = open(path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), size)
+        for slot, (broker_token, cirrus_token) in enumerate(broker_to_cirrus_mapping.items()):
+            DIRECTORY_ENTRY.pack_into(self.map, HEADER.size + slot * DIRECTORY_ENTRY.size, broker_token,
+                                      cirrus_token.encode()[:48])
+        for region in range(region_count):
+            REGION_HEADER.pack_into(self.map, self.regions_start + region * self.region_size, -1)
+        # minute -> region, and per region the tick counts last written for each slot
+        self.regions = {}
+        self.free = list(range(region_count))
+        self.written_ticks = [array("I", bytes(4 * self.slot_count)) for _ in range(region_count)]
+        self.zero_ticks = array("I", bytes(4 * self.slot_count))
+        self.write_header(-1)
+
+    def write_header(self, finalized):
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.region_count, self.slot_count,
+                         -1 if finalized is None else finalized, time.time())
+
+    def write(self, engine):
+        """Write the slots that ticked since the last call. Runs on the thread that owns the engine."""
+        live = engine.buffers
+        for minute in [minute for minute in self.regions if minute not in live]:
+            region = self.regions.pop(minute)
+            REGION_HEADER.pack_into(self.map, self.regions_start + region * self.region_size, -1)
+            self.free.append(region)
+        pack, record_size = RECORD.pack_into, RECORD.size
+        dirty = 0
+        for minute in sorted(live):
+            region = self.regions.get(minute)
+            if region is None:
+                if not self.free:
+                    # More open minutes than regions, the newest ones wait for a region to free up
+                    break
+                region = self.regions[minute] = self.free.pop()
+                self.written_ticks[region][:] = self.zero_ticks
+                REGION_HEADER.pack_into(self.map, self.regions_start + region * self.region_size, minute)
+            buffer = live[minute]
+            written = self.written_ticks[region]
+            records = self.regions_start + region * self.region_size + REGION_HEADER.size
+            ticks = buffer.ticks
+            for slot in buffer.touched:
+                if slot >= self.slot_count:
+                    # Subscribed after the checkpoint was laid out, the next start gives it a slot
+                    continue
+                count = ticks[slot]
+                if count == written[slot]:
+                    continue
+                written[slot] = count
+                pack(self.map, records + slot * record_size, minute, buffer.open[slot], buffer.high[slot],
+                     buffer.low[slot], buffer.close[slot], buffer.atp[slot], buffer.volume[slot],
+                     buffer.oi[slot], count)
+                dirty += 1
+        self.write_header(engine.finalized)
+        return dirty
+
+    def close(self):
+        self.map.close()
+        self.file.close()
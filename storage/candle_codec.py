@@ -0,0 +1,93 @@
+"""
+Packed binary format for 1m candles.
+
+Each candle is a fixed 61 byte little-endian record:
+    version u8 | epoch minute u32 | open, high, low, close, atp f64 | volume, oi i64
+stored in the MINUTE_CANDLES_BIN:{token} hash under a 4 byte big-endian epoch-minute field,
+so fields sort by time and a hash can hold more than one day. Higher timeframe rollups use the same
+record in CANDLES_BIN:{timeframe}:{token}, keyed and stamped with the period's first minute.
+Per-minute market depth aggregates are a 21 byte record in MINUTE_DEPTH_BIN:{token}, same fields:
+    version u8 | epoch minute u32 | time-weighted spread, time-weighted top-of-book imbalance f64
+"""
+import struct
+
+CANDLE_VERSION = 1
+CANDLE_STRUCT = struct.Struct("<BIdddddqq")
+MINUTE_FIELD = struct.Struct(">I")
+CANDLE_FIELDS = ("minute", "open", "high", "low", "close", "atp", "volume", "oi")
+DEPTH_STRUCT = struct.Struct("<BIdd")
+DEPTH_FIELDS = ("minute", "spread", "imbalance")
+
+_pack = CANDLE_STRUCT.pack
+_pack_field = MINUTE_FIELD.pack
+# Same layout with the version byte skipped
+_CANDLE_BODY = struct.Struct("<xIdddddqq")
+_VERSION_BYTE = bytes([CANDLE_VERSION])
+
+
+def candle_key(token, timeframe="1m"):
+    if timeframe == "1m":
+        return f"MINUTE_CANDLES_BIN:{token}"
+    return f"CANDLES_BIN:{timeframe}:{token}"
+
+
+def minute_field(minute):
+    return _pack_field(minute)
+
+
+def encode_candle(minute, o, h, l, c, atp, volume, oi):
+    return _pack(CANDLE_VERSION, minute, o, h, l, c, atp, volume, oi)
+
+
+def depth_key(token):
+    return f"MINUTE_DEPTH_BIN:{token}"
+
+
+def encode_depth(minute, spread, imbalance):
+    return DEPTH_STRUCT.pack(CANDLE_VERSION, minute, spread, imbalance)
+
+
+def decode_depth(data):
+    values = DEPTH_STRUCT.unpack(data)
+    if values[0] != CANDLE_VERSION:
+        raise ValueError(f"Unsupported depth version {values[0]}")
+    return dict(zip(DEPTH_FIELDS, values[1:]))
+
+
+def decode_candle(data):
+    values = CANDLE_STRUCT.unpack(data)
+    if values[0] != CANDLE_VERSION:
+        raise ValueError(f"Unsupported candle version {values[0]}")
+    return dict(zip(CANDLE_FIELDS, values[1:]))
+
+
+def decode_candles(values):
+    """Decode many records at once, in input order."""
+    blob = b"".join(values)
+    # The version byte leads every record, so a strided slice collects all of them
+    if blob[::CANDLE_STRUCT.size].strip(_VERSION_BYTE):
+        raise ValueError("Unsupported candle version")
+    return [dict(zip(CANDLE_FIELDS, row)) for row in _CANDLE_BODY.iter_unpack(blob)]
+
+
+def decode_hash(mapping):
+    """Decode an HGETALL result, sorted by minute (big-endian minute fields sort bytewise)."""
+    return decode_candles([mapping[field] for field in sorted(mapping)])
+
+
+def fetch_candles(redis_client, token, start_minute=None, end_minute=None, timeframe="1m"):
+    """Read a token's candles from Redis, optionally limited to [start_minute, end_minute) in epoch minutes."""
+    candles = decode_hash(redis_client.hgetall(candle_key(token, timeframe)))
+    if start_minute is not None:
+        candles = [candle for candle in candles if candle["minute"] >= start_minute]
+    if end_minute is not None:
+        candles = [candle for candle in candles if candle["minute"] < end_minute]
+    return candles
+
+
+def fetch_many(redis_client, tokens, timeframe="1m"):
+    """HGETALL a list of tokens in one pipeline, returning {token: [candle, ...]}."""
+    pipe = redis_client.pipeline()
+    for token in tokens:
+        pipe.hgetall(candle_key(token, timeframe))
+    return {token: decode_hash(result) for token, result in zip(tokens, pipe.execute())}
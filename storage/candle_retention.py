@@ -0,0 +1,76 @@
+"""
+Retention for the per-token binary hashes in Redis (MINUTE_CANDLES_BIN, CANDLES_BIN, MINUTE_DEPTH_BIN).
+
+A hash holds every day a token traded, so the fields of days older than the retention are deleted
+once a day. Fields are epoch minutes, so the fields of an expired day are known without reading the
+hash: every key of the prefixes is SCANned and sent one HDEL with the day's kept minutes. Each shard
+remembers the last day it swept under CANDLE_RETENTION_SWEPT (a date ordinal), so days that expired
+while the ingester was down are swept by the next run; a shard never swept before starts catchup_days
+before the cutoff.
+"""
+import threading
+from datetime import date, datetime, timedelta
+
+import redis
+
+from storage.candle_codec import minute_field
+
+RETENTION_PREFIXES = ("MINUTE_CANDLES_BIN:", "CANDLES_BIN:", "MINUTE_DEPTH_BIN:")
+SWEPT_KEY = "CANDLE_RETENTION_SWEPT"
+
+
+def day_fields(day, keep_minute):
+    """Minute fields of a date whose epoch minute passes keep_minute (e.g. within trading hours)."""
+    first = int(datetime.combine(day, datetime.min.time()).timestamp()) // 60
+    return [minute_field(minute) for minute in range(first, first + 24 * 60) if keep_minute(minute)]
+
+
+def sweep_fields(client, fields, batch_size=1000, fields_per_command=2000):
+    """HDEL fields from every key of the retention prefixes, returns the number of keys visited."""
+    keys = 0
+    pipe = client.pipeline(transaction=False)
+    for prefix in RETENTION_PREFIXES:
+        for key in client.scan_iter(match=f"{prefix}*", count=batch_size):
+            for start in range(0, len(fields), fields_per_command):
+                pipe.hdel(key, *fields[start:start + fields_per_command])
+            keys += 1
+            if len(pipe) >= batch_size:
+                pipe.execute()
+    pipe.execute()
+    return keys
+
+
+class CandleRetention:
+    def __init__(self, urls, days, keep_minute, catchup_days=7):
+        self.urls = list(urls)
+        self.days = days
+        self.keep_minute = keep_minute
+        self.catchup_days = catchup_days
+        self.checked = None
+        self.thread = None
+
+    def maybe_sweep(self, today):
+        """Start the day's sweep in the background the first time a date is seen."""
+        if today == self.checked or (self.thread is not None and self.thread.is_alive()):
+            return
+        self.checked = today
+        self.thread = threading.Thread(target=self.sweep, args=(today,), name="candle-retention", daemon=True)
+        self.thread.start()
+
+    def sweep(self, today):
+        cutoff = today - timedelta(days=self.days)
+        for url in self.urls:
+            client = redis.from_url(url)
+            try:
+                swept = client.get(SWEPT_KEY)
+                first = int(swept) + 1 if swept else (cutoff - timedelta(days=self.catchup_days)).toordinal()
+                days = [date.fromordinal(ordinal) for ordinal in range(first, cutoff.toordinal() + 1)]
+                fields = [field for day in days for field in day_fields(day, self.keep_minute)]
+                if fields:
+                    keys = sweep_fields(client, fields)
+                    print(f"Candle retention: removed {len(days)} day(s) up to {cutoff} from {keys} keys")
+                client.set(SWEPT_KEY, cutoff.toordinal())
+            except Exception as e:
+                print(f"Error sweeping expired candles: {e}")
+            finally:
+                client.close()
@@ -0,0 +1,197 @@
+import os
+import pickle
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+from utils.metrics import CLICKHOUSE_QUEUE_ROWS, CLICKHOUSE_RETRIES, CLICKHOUSE_ROWS
+
+OHLC_COLUMNS = ['token', 'timestamp', 'open', 'high', 'low', 'close', 'atp', 'volume', 'oi']
+
+OHLC_TABLE_DDL = """
+                 CREATE TABLE IF NOT EXISTS {table}
+                 (
+                     token     String,
+                     timestamp DateTime('Asia/Kolkata'),
+                     open      Float32,
+                     high      Float32,
+                     low       Float32,
+                     close     Float32,
+                     atp       Nullable(Float32),
+                     volume    Nullable(UInt64),
+                     oi        Nullable(UInt64)
+                 ) ENGINE = ReplacingMergeTree()
+        ORDER BY (token, timestamp)
+                 """
+
+
+class ClickHouseSink:
+    """
+    Ships closed candle rows (token, epoch minute, open, high, low, close, atp, volume, oi) to ClickHouse.
+
+    submit() never blocks the minute flush: rows go into a bounded in-memory queue that a background
+    thread drains in large column-oriented inserts, retrying with exponential backoff. Once the queue
+    is full, new rows are spilled to disk (or dropped and counted if no spill_dir is set), and spilled
+    files are replayed when the queue has drained. The client only needs command() and insert(),
+    so an in-process fake can stand in for a server. Queue depth, rows by outcome and retries are
+    exported per table in utils.metrics.
+    """
+
+    def __init__(self, client, table="ohlc", max_queue_rows=2_000_000, batch_rows=200_000, spill_dir=None,
+                 max_backoff=30.0):
+        self.client = client
+        self.table = table
+        self.max_queue_rows = max_queue_rows
+        self.batch_rows = batch_rows
+        self.spill_dir = spill_dir
+        self.max_backoff = max_backoff
+
+        self.queue = deque()
+        self.queued_rows = 0
+        self.condition = threading.Condition()
+        self.spill_lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+        self.rows_inserted = 0
+        self.rows_spilled = 0
+        self.rows_replayed = 0
+        self.rows_dropped = 0
+        self.inserts = 0
+        self.retries = 0
+        self.last_error = None
+        self.started_at = None
+        self._spill_sequence = 0
+        self.labels = (table,)
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def ensure_table(self):
+        self.client.command(OHLC_TABLE_DDL.format(table=self.table))
+
+    def start(self):
+        self.running = True
+        self.started_at = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name="clickhouse-sink", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def submit(self, rows):
+        if not rows:
+            return True
+        with self.condition:
+            if self.queued_rows + len(rows) <= self.max_queue_rows:
+                self.queue.append(rows)
+                self.queued_rows += len(rows)
+                CLICKHOUSE_QUEUE_ROWS.set(self.queued_rows, self.labels)
+                self.condition.notify()
+                return True
+        self._spill(rows)
+        return False
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        return {
+            "queue_rows": self.queued_rows,
+            "queue_batches": len(self.queue),
+            "rows_inserted": self.rows_inserted,
+            "rows_per_sec": self.rows_inserted / elapsed if elapsed else 0.0,
+            "rows_spilled": self.rows_spilled,
+            "rows_replayed": self.rows_replayed,
+            "rows_dropped": self.rows_dropped,
+            "spill_files": len(self._spill_files()),
+            "inserts": self.inserts,
+            "retries": self.retries,
+            "last_error": self.last_error,
+        }
+
+    def _take_batch(self):
+        rows = []
+        with self.condition:
+            while self.running and not self.queue:
+                self.condition.wait(1.0)
+                if not self.queue and self._spill_files():
+                    break
+            while self.queue and len(rows) < self.batch_rows:
+                chunk = self.queue.popleft()
+                self.queued_rows -= len(chunk)
+                rows.extend(chunk)
+            CLICKHOUSE_QUEUE_ROWS.set(self.queued_rows, self.labels)
+        return rows
+
+    def _run(self):
+        while self.running or self.queue:
+            rows = self._take_batch()
+            if rows:
+                if not self._insert_with_retry(rows):
+                    self._spill(rows)
+            elif self.running:
+                self._replay_spill()
+
+    def _insert_with_retry(self, rows):
+        delay = 0.5
+        while True:
+            try:
+                self._insert(rows)
+                return True
+            except Exception as e:
+                self.last_error = str(e)
+                self.retries += 1
+                CLICKHOUSE_RETRIES.inc(1, self.labels)
+                print(f"ClickHouse insert of {len(rows)} rows failed, retrying in {delay:.1f}s: {e}")
+                if not self.running:
+                    return False
+                # Keep the queue bounded while we wait, newer rows spill instead of piling up behind us
+                time.sleep(delay)
+                delay = min(self.max_backoff, delay * 2)
+
+    def _insert(self, rows):
+        columns = [list(column) for column in zip(*rows)]
+        columns[1] = [datetime.fromtimestamp(minute * 60, tz=timezone.utc) for minute in columns[1]]
+        self.client.insert(table=self.table, data=columns, column_names=OHLC_COLUMNS, column_oriented=True)
+        self.inserts += 1
+        self.rows_inserted += len(rows)
+        CLICKHOUSE_ROWS.inc(len(rows), self.labels + ("inserted",))
+
+    def _spill(self, rows):
+        if not self.spill_dir:
+            self.rows_dropped += len(rows)
+            CLICKHOUSE_ROWS.inc(len(rows), self.labels + ("dropped",))
+            return
+        with self.spill_lock:
+            self._spill_sequence += 1
+            path = os.path.join(self.spill_dir, f"ohlc-{time.time_ns()}-{self._spill_sequence}.spill")
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + ".tmp", path)
+            self.rows_spilled += len(rows)
+            CLICKHOUSE_ROWS.inc(len(rows), self.labels + ("spilled",))
+
+    def _spill_files(self):
+        if not self.spill_dir:
+            return []
+        return sorted(name for name in os.listdir(self.spill_dir) if name.endswith(".spill"))
+
+    def _replay_spill(self):
+        for name in self._spill_files():
+            if self.queue or not self.running:
+                return
+            path = os.path.join(self.spill_dir, name)
+            with open(path, "rb") as f:
+                rows = pickle.load(f)
+            try:
+                self._insert(rows)
+            except Exception as e:
+                self.last_error = str(e)
+                return
+            os.remove(path)
+            self.rows_replayed += len(rows)
+            CLICKHOUSE_ROWS.inc(len(rows), self.labels + ("replayed",))
@@ -0,0 +1,235 @@
+"""
+Pooled, shard-aware Redis writes on redis.asyncio.
+
+Per-token keys (MINUTE_CANDLES*, CANDLES_BIN, MINUTE_DEPTH_BIN and TICKS) are spread over the shards by
+crc32 of the token, the hash the tick channels are sharded with, so every key of a token lives on one
+instance. Other keys and PUBLISH go to the first shard. Each shard has its own bounded connection pool;
+a writer waits for a free connection instead of opening more.
+
+Writers queue commands on a RedisBatch, which has the part of the pipeline API they use (hset, publish,
+len, execute), and hand it to a lane. Batches of one lane are applied in the order they were submitted,
+each shard's commands going out in pipelines of at most pipeline_size commands and the shards in
+parallel; a batch's publishes follow its key writes, so a message never announces a write that has not
+landed. Lanes share the pools but not their order, a slow candle flush does not hold up tick writes.
+
+The clients run on their own event loop thread, callers on any thread either block on execute() or
+submit() and move on. Once a lane given a limit in lane_limits has that many batches pending, submitted
+batches are merged into one overflow batch instead (counted in REDIS_COALESCED_BATCHES): an HSET of a
+key already in it updates the queued mapping, so the latest value of every field wins and a stalled
+shard holds one write per key instead of a backlog. The overflow batch joins the lane as soon as it has
+room, or ahead of the next execute(), so it keeps its place in the lane's order and its publishes still
+follow its writes.
+"""
+import asyncio
+import concurrent.futures
+import threading
+import time
+import zlib
+
+import redis.asyncio as aioredis
+
+from utils.metrics import (REDIS_COALESCED_BATCHES, REDIS_PENDING_BATCHES, REDIS_PIPELINE_COMMANDS,
+                           REDIS_PIPELINE_SECONDS, REDIS_WRITE_ERRORS)
+
+# Key prefix -> ":" separated parts before the token, tokens may contain ":" themselves
+SHARDED_KEYS = {"MINUTE_CANDLES_BIN": 1, "MINUTE_CANDLES": 1, "CANDLES_BIN": 2, "MINUTE_DEPTH_BIN": 1, "TICKS": 1}
+
+
+def shard_index(token, shard_count):
+    """Shard of a Cirrus token, also used by readers to find its keys."""
+    if shard_count <= 1:
+        return 0
+    return zlib.crc32(str(token).encode()) % shard_count
+
+
+class RedisBatch:
+    def __init__(self, shards, lane):
+        self.shards = shards
+        self.lane = lane
+        # (shard, command, args, kwargs), publishes kept apart to go out last
+        self.commands = []
+        self.publishes = []
+        # key -> HSET mapping queued for it, only on overflow batches
+        self.mappings = {}
+
+    def __len__(self):
+        return len(self.commands) + len(self.publishes)
+
+    def hset(self, key, *args, **kwargs):
+        self.commands.append((self.shards.shard_for_key(key), "hset", (key,) + args, kwargs))
+        return self
+
+    def publish(self, channel, message):
+        self.publishes.append((channel, message))
+        return self
+
+    def merge(self, batch):
+        """Fold a later batch in, its HSET mappings update those already queued for the same key."""
+        for shard, command, args, kwargs in batch.commands:
+            if command == "hset" and len(args) == 1 and set(kwargs) == {"mapping"}:
+                mapping = self.mappings.get(args[0])
+                if mapping is not None:
+                    mapping.update(kwargs["mapping"])
+                    continue
+                mapping = self.mappings[args[0]] = dict(kwargs["mapping"])
+                kwargs = {"mapping": mapping}
+            self.commands.append((shard, command, args, kwargs))
+        self.publishes.extend(batch.publishes)
+
+    def submit(self):
+        """
+        Apply without waiting, failures are logged. Returns a concurrent.futures.Future, already done
+        with 0 if the lane was over its limit and the batch was merged into its overflow batch.
+        """
+        future = self.shards.submit(self, coalesce=True)
+        future.add_done_callback(_log_failure)
+        return future
+
+    def execute(self):
+        """Apply and wait, raising the first shard's error."""
+        return self.shards.submit(self).result()
+
+
+class RedisLane:
+    """A lane bound view with a redis.Redis-like pipeline(), for writers that take a client."""
+
+    def __init__(self, shards, name):
+        self.shards = shards
+        self.name = name
+
+    def pipeline(self, transaction=False):
+        return RedisBatch(self.shards, self.name)
+
+
+class RedisShards:
+    def __init__(self, urls, pool_size=32, pipeline_size=1000, timeout=10.0, lane_limits=None):
+        self.urls = list(urls)
+        self.pipeline_size = pipeline_size
+        # lane -> most batches that may be pending before submit() merges into the overflow batch
+        self.lane_limits = dict(lane_limits or {})
+        self.loop = asyncio.new_event_loop()
+        self.clients = [
+            aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool.from_url(
+                url, max_connections=pool_size, timeout=timeout))
+            for url in self.urls
+        ]
+        self.labels = [str(shard) for shard in range(len(self.urls))]
+        # key -> shard, keys repeat every flush and routing is on the writers' hot path
+        self.routes = {}
+        self.lanes = {}
+        self.pending = {}
+        # Batches handed to the loop and not yet finished per lane, counted on the callers' threads
+        self.queued = {}
+        # lane -> batch collecting what was submitted while the lane was full
+        self.overflow = {}
+        self.queued_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="redis-writer", daemon=True)
+        self.thread.start()
+
+    def shard_for_key(self, key):
+        shard = self.routes.get(key)
+        if shard is None:
+            parts = SHARDED_KEYS.get(key.partition(":")[0])
+            if parts is None:
+                shard = 0
+            else:
+                shard = shard_index(key.split(":", parts)[parts], len(self.clients))
+            self.routes[key] = shard
+        return shard
+
+    def lane(self, name):
+        return RedisLane(self, name)
+
+    def pipeline(self, lane="writes"):
+        return RedisBatch(self, lane)
+
+    def submit(self, batch, coalesce=False):
+        lane = batch.lane
+        with self.queued_lock:
+            queued = self.queued.get(lane, 0)
+            if coalesce and queued >= self.lane_limits.get(lane, queued + 1):
+                overflow = self.overflow.get(lane)
+                if overflow is None:
+                    overflow = self.overflow[lane] = RedisBatch(self, lane)
+                overflow.merge(batch)
+                REDIS_COALESCED_BATCHES.inc(1, (lane,))
+                future = concurrent.futures.Future()
+                future.set_result(0)
+                return future
+            self._flush_overflow(lane)
+            return self._schedule(batch)
+
+    def _schedule(self, batch):
+        # Under queued_lock, batches of a lane reach the loop in the order they are scheduled
+        self.queued[batch.lane] = self.queued.get(batch.lane, 0) + 1
+        return asyncio.run_coroutine_threadsafe(self._apply(batch), self.loop)
+
+    def _flush_overflow(self, lane):
+        overflow = self.overflow.pop(lane, None)
+        if overflow is not None:
+            self._schedule(overflow).add_done_callback(_log_failure)
+
+    async def _apply(self, batch):
+        lane = batch.lane
+        lock = self.lanes.get(lane)
+        if lock is None:
+            lock = self.lanes[lane] = asyncio.Lock()
+        # Lane state is only touched on the writer loop
+        self.pending[lane] = self.pending.get(lane, 0) + 1
+        REDIS_PENDING_BATCHES.set(self.pending[lane], (lane,))
+        try:
+            # asyncio.Lock wakes waiters first come first served, batches apply in submission order
+            async with lock:
+                by_shard = {}
+                for shard, command, args, kwargs in batch.commands:
+                    by_shard.setdefault(shard, []).append((command, args, kwargs))
+                results = await asyncio.gather(
+                    *(self._write(shard, commands, lane) for shard, commands in by_shard.items()),
+                    return_exceptions=True)
+                errors = [result for result in results if isinstance(result, BaseException)]
+                if errors:
+                    raise errors[0]
+                if batch.publishes:
+                    await self._write(0, [("publish", publish, {}) for publish in batch.publishes], lane)
+            return len(batch)
+        finally:
+            self.pending[lane] -= 1
+            REDIS_PENDING_BATCHES.set(self.pending[lane], (lane,))
+            with self.queued_lock:
+                self.queued[lane] -= 1
+                if self.queued[lane] < self.lane_limits.get(lane, 0):
+                    self._flush_overflow(lane)
+
+    async def _write(self, shard, commands, lane):
+        client = self.clients[shard]
+        labels = (self.labels[shard], lane)
+        # In order within a shard, a batch may write the same key twice
+        for start in range(0, len(commands), self.pipeline_size):
+            chunk = commands[start:start + self.pipeline_size]
+            started = time.perf_counter()
+            try:
+                async with client.pipeline(transaction=False) as pipe:
+                    for command, args, kwargs in chunk:
+                        getattr(pipe, command)(*args, **kwargs)
+                    await pipe.execute()
+            except Exception:
+                REDIS_WRITE_ERRORS.inc(1, labels)
+                raise
+            REDIS_PIPELINE_SECONDS.observe(time.perf_counter() - started, labels)
+            REDIS_PIPELINE_COMMANDS.observe(len(chunk), labels)
+
+    def close(self, timeout=10.0):
+        async def shutdown():
+            for client in self.clients:
+                await client.aclose()
+
+        try:
+            asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(timeout)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout)
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Error writing to redis: {future.exception()}")
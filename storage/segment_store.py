@@ -0,0 +1,232 @@
+"""
+Append-only, per-day columnar store for closed 1m candles.
+
+A segment is a directory per trading day:
+    tokens.idx    one token per line, the line number is the token id used in the columns
+    minutes.idx   (epoch minute u32, first row u64, row count u32) per appended minute block
+    token.u32, open/high/low/close/atp.f64, volume/oi.i64
+                  one little-endian column file per field, rows of a block sorted by token id
+Columns are fsynced before the minute index entry is appended, so readers only ever see whole blocks.
+A writer cuts every file back to the last indexed block when it opens a segment and after a failed
+append, so a block that was only partly written never shifts the rows of the next one.
+Readers memory-map the column files and binary search inside blocks, nothing is deserialized up front.
+"""
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+
+COLUMNS = (
+    ("token", "I"),
+    ("open", "d"),
+    ("high", "d"),
+    ("low", "d"),
+    ("close", "d"),
+    ("atp", "d"),
+    ("volume", "q"),
+    ("oi", "q"),
+)
+INDEX_ENTRY = struct.Struct("<IQI")
+
+
+def segment_day(minute):
+    return datetime.fromtimestamp(minute * 60).strftime("%Y%m%d")
+
+
+def _column_path(path, name, typecode):
+    return os.path.join(path, f"{name}.{typecode}")
+
+
+class SegmentWriter:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._open()
+
+    def _open(self):
+        """Truncate the segment to its last whole index entry and open it for appending."""
+        tokens_path = os.path.join(self.path, "tokens.idx")
+        index_path = os.path.join(self.path, "minutes.idx")
+        self.rows = 0
+        if os.path.exists(index_path):
+            with open(index_path, "r+b") as f:
+                data = f.read()
+                usable = len(data) - len(data) % INDEX_ENTRY.size
+                f.truncate(usable)
+            if usable:
+                _, start, count = INDEX_ENTRY.unpack_from(data, usable - INDEX_ENTRY.size)
+                self.rows = start + count
+        for name, typecode in COLUMNS:
+            column_path = _column_path(self.path, name, typecode)
+            if os.path.exists(column_path):
+                with open(column_path, "r+b") as f:
+                    f.truncate(self.rows * array(typecode).itemsize)
+        self.token_ids = {}
+        if os.path.exists(tokens_path):
+            with open(tokens_path, "r+b") as f:
+                data = f.read()
+                # A token line without its newline was cut short
+                data = data[:data.rfind(b"\n") + 1]
+                f.truncate(len(data))
+            for line in data.decode().splitlines():
+                self.token_ids[line] = len(self.token_ids)
+        self.tokens_file = open(tokens_path, "a")
+        self.index_file = open(index_path, "ab")
+        self.column_files = [open(_column_path(self.path, name, typecode), "ab") for name, typecode in COLUMNS]
+
+    def append(self, minute, rows):
+        """Append one minute block. rows are (token, open, high, low, close, atp, volume, oi)."""
+        new_tokens = []
+        keyed = []
+        for row in rows:
+            token_id = self.token_ids.get(row[0])
+            if token_id is None:
+                token_id = self.token_ids[row[0]] = len(self.token_ids)
+                new_tokens.append(row[0])
+            keyed.append((token_id,) + tuple(row[1:]))
+        keyed.sort()
+
+        try:
+            if new_tokens:
+                self.tokens_file.write("".join(f"{token}\n" for token in new_tokens))
+                self.tokens_file.flush()
+                os.fsync(self.tokens_file.fileno())
+
+            for (name, typecode), f, values in zip(COLUMNS, self.column_files, zip(*keyed)):
+                f.write(array(typecode, values).tobytes())
+            for f in self.column_files:
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.index_file.write(INDEX_ENTRY.pack(minute, self.rows, len(keyed)))
+            self.index_file.flush()
+            os.fsync(self.index_file.fileno())
+        except Exception:
+            # Drop whatever part of the block made it to disk, the caller may retry it
+            self._close_files()
+            self._open()
+            raise
+        self.rows += len(keyed)
+
+    def _close_files(self):
+        for f in [self.tokens_file, self.index_file] + self.column_files:
+            try:
+                f.close()
+            except OSError:
+                pass
+
+    def close(self):
+        for f in [self.tokens_file, self.index_file] + self.column_files:
+            f.close()
+
+
+class SegmentStore:
+    """Candle store backend: write(rows) takes the same rows as save_candle_rows."""
+
+    def __init__(self, root):
+        self.root = root
+        self.writers = {}
+
+    def writer(self, day):
+        writer = self.writers.get(day)
+        if writer is None:
+            for old_day in list(self.writers):
+                self.writers.pop(old_day).close()
+            writer = self.writers[day] = SegmentWriter(os.path.join(self.root, day))
+        return writer
+
+    def write(self, rows):
+        blocks = {}
+        for token, minute, o, h, l, c, atp, volume, oi in rows:
+            blocks.setdefault(minute, []).append((token, o, h, l, c, atp, volume, oi))
+        for minute in sorted(blocks):
+            self.writer(segment_day(minute)).append(minute, blocks[minute])
+
+    def reader(self, day):
+        return SegmentReader(os.path.join(self.root, day))
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+
+class SegmentReader:
+    def __init__(self, path):
+        self.path = path
+        self._maps = []
+        self.refresh()
+
+    def refresh(self):
+        """Pick up blocks appended since the reader was opened."""
+        self.close()
+        with open(os.path.join(self.path, "tokens.idx")) as f:
+            self.tokens = f.read().splitlines()
+        self.token_ids = {token: i for i, token in enumerate(self.tokens)}
+        with open(os.path.join(self.path, "minutes.idx"), "rb") as f:
+            data = f.read()
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        self.blocks = list(INDEX_ENTRY.iter_unpack(data[:usable]))
+        self.minute_blocks = {}
+        for minute, start, count in self.blocks:
+            self.minute_blocks.setdefault(minute, []).append((start, count))
+
+        self.columns = {}
+        for name, typecode in COLUMNS:
+            with open(_column_path(self.path, name, typecode), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    self.columns[name] = memoryview(b"").cast(typecode)
+                    continue
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps.append(mapped)
+            view = memoryview(mapped)
+            self.columns[name] = view[:len(view) - len(view) % array(typecode).itemsize].cast(typecode)
+
+    def _row(self, minute, i):
+        columns = self.columns
+        return {
+            "token": self.tokens[columns["token"][i]],
+            "minute": minute,
+            "open": columns["open"][i],
+            "high": columns["high"][i],
+            "low": columns["low"][i],
+            "close": columns["close"][i],
+            "atp": columns["atp"][i],
+            "volume": columns["volume"][i],
+            "oi": columns["oi"][i],
+        }
+
+    def minute(self, minute):
+        """All tokens' candles for an epoch minute. Later blocks for the same minute win."""
+        candles = {}
+        for start, count in self.minute_blocks.get(minute, ()):
+            for i in range(start, start + count):
+                candle = self._row(minute, i)
+                candles[candle["token"]] = candle
+        return list(candles.values())
+
+    def token(self, token):
+        """One token's candles for the day, in minute order."""
+        token_id = self.token_ids.get(token)
+        if token_id is None:
+            return []
+        token_column = self.columns["token"]
+        candles = {}
+        for minute, start, count in self.blocks:
+            block = token_column[start:start + count]
+            i = bisect_left(block, token_id)
+            if i < count and block[i] == token_id:
+                candles[minute] = self._row(minute, start + i)
+        return [candles[minute] for minute in sorted(candles)]
+
+    def close(self):
+        # Views into the maps have to be released before the maps can be closed
+        self.columns = {}
+        for mapped in self._maps:
+            try:
+                mapped.close()
+            except BufferError:
+                pass
+        self._maps = []
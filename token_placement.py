@@ -0,0 +1,143 @@
+"""
+Placement of broker tokens on connections by tick rate.
+
+Liquid instruments tick many times more often than the long tail, so equal sized chunks do not mean
+equal load. TickRateProfile counts ticks per token while the ingester runs and is saved between
+sessions; place_tokens spreads tokens over connections by that rate and plan_moves finds the few
+tokens to move when live load drifts apart.
+"""
+import glob
+import heapq
+import json
+import os
+import time
+from bisect import bisect_right, insort
+from collections import Counter
+from statistics import median
+
+
+class TickRateProfile:
+    def __init__(self, session=None):
+        # Start time of the ingester run, shared by its workers, so load_profile can tell runs apart
+        self.session = time.time() if session is None else session
+        self.counts = Counter()
+        self.window = Counter()
+        self.seconds = 0.0
+        self.window_started = time.monotonic()
+
+    def observe(self, tokens):
+        self.window.update(tokens)
+
+    def roll_window(self):
+        """Close the current window and return its {token: ticks per second}."""
+        now = time.monotonic()
+        elapsed = max(now - self.window_started, 1e-9)
+        window, self.window = self.window, Counter()
+        self.window_started = now
+        self.counts.update(window)
+        self.seconds += elapsed
+        return {token: count / elapsed for token, count in window.items()}
+
+    def save(self, path):
+        # The open window is included without closing it, it belongs to whoever rolls windows
+        counts = self.counts + self.window
+        seconds = self.seconds + time.monotonic() - self.window_started
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump({"session": self.session, "seconds": seconds,
+                       "counts": [[token, count] for token, count in counts.items()]}, f)
+        os.replace(temporary, path)
+
+
+def profile_path(path, worker_id=None):
+    if worker_id is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.worker-{worker_id}{ext}"
+
+
+def load_profile(path):
+    """
+    {token: ticks per second} from a saved profile and the per-worker profiles next to it. Only the
+    files of the latest run count: those a run with another worker count (or without workers) left
+    behind cover the same tokens again and would add up.
+    """
+    profiles = []
+    root, ext = os.path.splitext(path)
+    for name in [path] + sorted(glob.glob(f"{glob.escape(root)}.worker-*{ext}")):
+        try:
+            with open(name) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    # Profiles saved before runs were stamped only count when there is nothing newer
+    latest = max((profile.get("session", 0) for profile in profiles), default=0)
+    rates = {}
+    for profile in profiles:
+        if profile.get("session", 0) != latest:
+            continue
+        seconds = profile["seconds"]
+        for token, count in profile["counts"]:
+            rates[token] = rates.get(token, 0.0) + count / seconds
+    return rates
+
+
+def place_tokens(tokens, rates, bin_count, capacity):
+    """
+    Split tokens into bin_count lists of at most capacity tokens with similar total rate, heaviest
+    token first onto the lightest bin that has room. Tokens without a rate count as the median one.
+    """
+    default = median(rates.values()) if rates else 1.0
+    weighted = sorted(((rates.get(token, default), token) for token in tokens), reverse=True)
+    bins = [[] for _ in range(bin_count)]
+    heap = [(0.0, i) for i in range(bin_count)]
+    for rate, token in weighted:
+        if not heap:
+            break
+        load, i = heapq.heappop(heap)
+        bins[i].append(token)
+        if len(bins[i]) < capacity:
+            heapq.heappush(heap, (load + rate, i))
+    return bins
+
+
+def plan_moves(assignment, rates, capacity, tolerance=0.2, max_moves=200):
+    """
+    Moves [(token, source, target)] that bring the busiest connection within tolerance of the mean, or
+    of the busiest single token when that alone is above the mean. assignment is {connection: [tokens]};
+    each move takes the largest token from the busiest connection that does not overshoot the least busy one.
+    """
+    if len(assignment) < 2:
+        return []
+    loads = {}
+    ranked = {}
+    for connection, tokens in assignment.items():
+        ranked[connection] = sorted((rates.get(token, 0.0), token) for token in tokens)
+        loads[connection] = sum(rate for rate, _ in ranked[connection])
+    mean = sum(loads.values()) / len(loads)
+    heaviest = max((tokens[-1][0] for tokens in ranked.values() if tokens), default=0.0)
+    ceiling = max(mean, heaviest) * (1 + tolerance)
+    sizes = {connection: len(tokens) for connection, tokens in assignment.items()}
+
+    moves = []
+    while len(moves) < max_moves:
+        source = max(loads, key=loads.get)
+        if loads[source] <= ceiling:
+            break
+        open_targets = [connection for connection in loads if sizes[connection] < capacity]
+        if not open_targets:
+            break
+        target = min(open_targets, key=loads.get)
+        gap = loads[source] - loads[target]
+        candidates = ranked[source]
+        i = bisect_right(candidates, (gap / 2, float("inf"))) - 1
+        if i < 0 or candidates[i][0] <= 0:
+            break
+        rate, token = candidates.pop(i)
+        insort(ranked[target], (rate, token))
+        loads[source] -= rate
+        loads[target] += rate
+        sizes[source] -= 1
+        sizes[target] += 1
+        moves.append((token, source, target))
+    return moves
@@ -1,8 +1,19 @@
+"""
+Headless Kite logins for the ingester's accounts.
+
+Sessions already in ZERODHA_TOKENS_FOR_MINUTE_DATA are checked with a profile call first and only the
+accounts whose session no longer works go through a browser login, LOGIN_POOL_SIZE of them at a time,
+each in its own Chrome profile. Every account is announced on ZERODHA_ACCOUNT_READY as soon as its
+session is usable, the ingester brings that account's connections up without waiting for the rest.
+KITE_LOGIN_URL and KITE_API_ROOT point the logins at a local stub instead of Kite.
+"""
 import json
 import os
+import shutil
 import ssl
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 import tempfile
 
@@ -13,15 +24,42 @@ from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
 
+from accounts import ACCOUNT_READY_CHANNEL, ACCOUNTS_KEY
 from database import REDIS_DB_CLIENT
 
 ssl._create_default_https_context = ssl._create_unverified_context
 
+KITE_LOGIN_URL = os.environ.get("KITE_LOGIN_URL", "https://kite.zerodha.com/connect/login")
+KITE_API_ROOT = os.environ.get("KITE_API_ROOT", "https://api.kite.trade")
+SESSION_TTL = 60 * 60 * 15
+
+
+def save_session(api_name, session):
+    REDIS_DB_CLIENT.hset(ACCOUNTS_KEY, api_name, json.dumps(session))
+    REDIS_DB_CLIENT.expire(ACCOUNTS_KEY, SESSION_TTL)
+    REDIS_DB_CLIENT.publish(ACCOUNT_READY_CHANNEL, api_name)
+
+
+def session_is_valid(account, entry):
+    """Whether a stored session still works for the account, one profile call."""
+    if entry is None:
+        return False
+    session = json.loads(entry)
+    if session.get("api_key") != account["api_key"]:
+        return False
+    try:
+        KiteConnect(api_key=session["api_key"], access_token=session["access_token"], root=KITE_API_ROOT).profile()
+    except Exception as e:
+        print(f"Session of {account['name']} is no longer valid: {e}")
+        return False
+    return True
+
 
 
 
 def run_zerodha_login(api_name, api_key, secret_key, client_id, user_password, totp_key, redirect_url, is_headless=True):
     try:
+        user_data_dir = None
         options = Options()
         if is_headless:
             options.add_argument("--headless")
@@ -35,21 +73,21 @@ def run_zerodha_login(api_name, api_key, secret_key, client_id, user_password, t
         options.add_argument("--disable-extensions")
         options.add_argument("--disable-software-rasterizer")
 
-        # ✅ Create unique user-data-dir AND specify remote-debugging-port
-        user_data_dir = tempfile.mkdtemp()
+        # A profile per browser, logins run side by side. No fixed debugging port, chromedriver picks one.
+        user_data_dir = tempfile.mkdtemp(prefix=f"kite-login-{api_name}-")
         options.add_argument(f"--user-data-dir={user_data_dir}")
-        options.add_argument("--remote-debugging-port=9222")  # Needed for profile isolation
-        chromedriver_autoinstaller.install()
         driver = webdriver.Chrome(options=options)
     except Exception as e:
         print(f"ExecutorWorker error: {e}")
+        if user_data_dir:
+            shutil.rmtree(user_data_dir, ignore_errors=True)
         return {
             "status": False,
             "message": f"Failed to set up Chrome driver {e}"
         }
     try:
         driver.maximize_window()
-        url = f"https://kite.zerodha.com/connect/login?v=3&api_key={api_key}&redirect_params=account_id%3D{client_id}"
+        url = f"{KITE_LOGIN_URL}?v=3&api_key={api_key}&redirect_params=account_id%3D{client_id}"
 
         driver.get(url)
         user = WebDriverWait(driver, 10).until(
@@ -97,12 +135,15 @@ def run_zerodha_login(api_name, api_key, secret_key, client_id, user_password, t
         except Exception as e:
             print(f"Some Error Occured Please Try Again\n{e}")
             driver.close()
-            return None
+            return {
+                "status": False,
+                "message": f"No request token after login {e}"
+            }
         if "request_token" not in params:
             driver.close()
         request_token = params.get("request_token")
         driver.close()
-        kite = KiteConnect(api_key=api_key)
+        kite = KiteConnect(api_key=api_key, root=KITE_API_ROOT)
         request_token = request_token
 
         rec_data = kite.generate_session(request_token, api_secret=secret_key)
@@ -115,8 +156,7 @@ def run_zerodha_login(api_name, api_key, secret_key, client_id, user_password, t
             "client_id": client_id,
         }
         print("Zerodha login successful")
-        REDIS_DB_CLIENT.hset("ZERODHA_TOKENS_FOR_MINUTE_DATA", api_name, json.dumps(data_to_save))
-        REDIS_DB_CLIENT.expire("ZERODHA_TOKENS_FOR_MINUTE_DATA", 60 * 60 * 15)
+        save_session(api_name, data_to_save)
     except Exception as e:
         print(f"ExecutorWorker error: {e}")
         return {
@@ -125,7 +165,57 @@ def run_zerodha_login(api_name, api_key, secret_key, client_id, user_password, t
         }
     finally:
         driver.quit()
-    return None
+        shutil.rmtree(user_data_dir, ignore_errors=True)
+    return {
+        "status": True,
+        "message": "Zerodha login successful"
+    }
+
+
+def login_accounts(accounts, pool_size=4, is_headless=True):
+    """
+    Bring every account to a valid session: stored sessions that still work are kept and announced,
+    the others are logged in pool_size browsers at a time. Returns {name: status}.
+    """
+    names = [account["name"] for account in accounts]
+    entries = dict(zip(names, REDIS_DB_CLIENT.hmget(ACCOUNTS_KEY, names)))
+    results = {}
+    with ThreadPoolExecutor(max_workers=pool_size) as pool:
+        checks = {pool.submit(session_is_valid, account, entries[account["name"]]): account
+                  for account in accounts}
+        pending = []
+        for check in as_completed(checks):
+            account = checks[check]
+            if check.result():
+                print(f"Session of {account['name']} is still valid, skipping login")
+                REDIS_DB_CLIENT.publish(ACCOUNT_READY_CHANNEL, account["name"])
+                results[account["name"]] = {"status": True, "message": "Session still valid"}
+            else:
+                pending.append(account)
+        if not pending:
+            return results
+
+        # Once for the pool, concurrent installs race on the same driver binary
+        chromedriver_autoinstaller.install()
+        logins = {}
+        for account in pending:
+            print("Running Zerodha login for account:", account["name"])
+            logins[pool.submit(
+                run_zerodha_login,
+                account["name"],
+                account["api_key"],
+                account["secret_key"],
+                account["client_id"],
+                account["user_password"],
+                account["totp_key"],
+                account["redirect_url"],
+                is_headless,
+            )] = account
+        for login in as_completed(logins):
+            name = logins[login]["name"]
+            results[name] = login.result()
+            print(f"Zerodha login for {name}: {results[name]['message']}")
+    return results
 
 
 if __name__ == "__main__":
@@ -252,15 +342,7 @@ if __name__ == "__main__":
         },
     ]
 
-    for acc in accounts:
-        print("Running Zerodha login for account:", acc['name'])
-        run_zerodha_login(
-            acc['name'],
-            acc["api_key"],
-            acc["secret_key"],
-            acc["client_id"],
-            acc["user_password"],
-            acc["totp_key"],
-            acc["redirect_url"],
-            True
-        )
+    results = login_accounts(accounts, pool_size=int(os.environ.get("LOGIN_POOL_SIZE", "4")))
+    failed = [name for name, result in results.items() if not result["status"]]
+    print(f"{len(results) - len(failed)} of {len(results)} accounts logged in"
+          + (f", failed: {', '.join(failed)}" if failed else ""))
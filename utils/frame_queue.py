@@ -0,0 +1,123 @@
+"""
+Bounded queue of raw WebSocket frames between the receive tasks (event loop) and the frame workers
+(threads).
+
+Items are (receive time, connection id, payload). What happens when the queue is full is explicit:
+    block        the receive task waits for room, the socket stops being read and TCP pushes back
+    drop-oldest  the oldest queued frame is discarded to make room
+    spill        frames go to an append-only file and are read back in order once the workers catch up;
+                 the spill uses the frame recorder's record layout
+"""
+import asyncio
+import os
+import tempfile
+import threading
+from collections import deque
+
+from utils.frame_recorder import BINARY_FRAME, RECORD_HEADER
+from utils.metrics import FRAME_QUEUE_DEPTH, FRAME_QUEUE_OVERFLOW
+
+POLICIES = ("block", "drop-oldest", "spill")
+
+
+class FrameQueue:
+    def __init__(self, capacity=10000, policy="block", spill_dir=None, name="0"):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown frame queue policy {policy}, expected one of {', '.join(POLICIES)}")
+        self.capacity = capacity
+        self.policy = policy
+        self.labels = (name,)
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        # (loop, future) of receive tasks waiting for room under the block policy
+        self.waiters = []
+        self.spill = None
+        self.spill_read = 0
+        self.spilled = 0
+        if policy == "spill":
+            self.spill = tempfile.TemporaryFile(prefix="frames-spill-", dir=spill_dir)
+
+    @property
+    def depth(self):
+        return len(self.items) + self.spilled
+
+    def put(self, item):
+        """Queue a frame from the event loop. False when it is full under the block policy."""
+        with self.condition:
+            if self.spilled or len(self.items) >= self.capacity:
+                if self.policy == "block":
+                    return False
+                if self.policy == "spill":
+                    self._spill(item)
+                    FRAME_QUEUE_OVERFLOW.inc(1, ("spilled",))
+                    self.condition.notify()
+                    return True
+                self.items.popleft()
+                FRAME_QUEUE_OVERFLOW.inc(1, ("dropped",))
+            self.items.append(item)
+            FRAME_QUEUE_DEPTH.set(len(self.items) + self.spilled, self.labels)
+            self.condition.notify()
+        return True
+
+    async def put_wait(self, item):
+        """put() that waits for room instead of failing."""
+        if self.put(item):
+            return
+        FRAME_QUEUE_OVERFLOW.inc(1, ("blocked",))
+        loop = asyncio.get_running_loop()
+        while True:
+            waiter = loop.create_future()
+            with self.condition:
+                self.waiters.append((loop, waiter))
+            # Room may have been made before the waiter was registered
+            if self.put(item):
+                return
+            await waiter
+
+    def get(self):
+        """Next frame for a worker thread, None once the queue is closed and drained."""
+        with self.condition:
+            while not self.items:
+                if self.spilled:
+                    self._unspill(max(1, self.capacity // 2))
+                    break
+                if self.closed:
+                    return None
+                self.condition.wait()
+            item = self.items.popleft()
+            FRAME_QUEUE_DEPTH.set(len(self.items) + self.spilled, self.labels)
+            if self.waiters:
+                waiters, self.waiters = self.waiters, []
+                for loop, waiter in waiters:
+                    loop.call_soon_threadsafe(_wake, waiter)
+            return item
+
+    def _spill(self, item):
+        received_at, connection_id, payload = item
+        self.spill.seek(0, os.SEEK_END)
+        self.spill.write(RECORD_HEADER.pack(received_at, BINARY_FRAME, connection_id, len(payload)))
+        self.spill.write(payload)
+        self.spilled += 1
+
+    def _unspill(self, count):
+        self.spill.seek(self.spill_read)
+        for _ in range(min(count, self.spilled)):
+            received_at, _, connection_id, length = RECORD_HEADER.unpack(self.spill.read(RECORD_HEADER.size))
+            self.items.append((received_at, connection_id, self.spill.read(length)))
+            self.spilled -= 1
+        self.spill_read = self.spill.tell()
+        if not self.spilled:
+            self.spill.seek(0)
+            self.spill.truncate()
+            self.spill_read = 0
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
@@ -0,0 +1,94 @@
+"""
+Raw WebSocket frame capture.
+
+A recording is a directory of rotating frames-*.bin files plus session.json (the broker token ->
+Cirrus token mapping the ingester was started with). Every frame is stored as
+    receive time f64 | kind u8 (0 binary, 1 text) | connection id u16 | length u32 | payload
+"""
+import json
+import mmap
+import os
+import struct
+import time
+from datetime import datetime
+
+RECORD_HEADER = struct.Struct("<dBHI")
+BINARY_FRAME = 0
+TEXT_FRAME = 1
+
+
+class FrameRecorder:
+    def __init__(self, directory, max_file_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_file_bytes = max_file_bytes
+        self.file = None
+        self.file_bytes = 0
+        self.sequence = 0
+        self.frames = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def write_session(self, mapping):
+        with open(os.path.join(self.directory, "session.json"), "w") as f:
+            json.dump({"started_at": time.time(), "mapping": [[k, v] for k, v in mapping.items()]}, f)
+
+    def _rotate(self):
+        if self.file is not None:
+            self.file.close()
+        self.sequence += 1
+        name = f"frames-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{self.sequence:04d}.bin"
+        self.file = open(os.path.join(self.directory, name), "ab", buffering=1024 * 1024)
+        self.file_bytes = 0
+
+    def record(self, connection_id, payload, received_at=None):
+        if isinstance(payload, str):
+            kind = TEXT_FRAME
+            payload = payload.encode("utf-8")
+        else:
+            kind = BINARY_FRAME
+        if self.file is None or self.file_bytes >= self.max_file_bytes:
+            self._rotate()
+        header = RECORD_HEADER.pack(received_at or time.time(), kind, connection_id, len(payload))
+        self.file.write(header)
+        self.file.write(payload)
+        self.file_bytes += len(header) + len(payload)
+        self.frames += 1
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def load_session(directory):
+    with open(os.path.join(directory, "session.json")) as f:
+        session = json.load(f)
+    return {int(k): v for k, v in session["mapping"]}
+
+
+def recording_files(directory):
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.startswith("frames-") and name.endswith(".bin")]
+
+
+def read_frames(paths):
+    """Yield (received_at, kind, connection_id, payload) from recording files in order."""
+    header_size = RECORD_HEADER.size
+    for path in paths:
+        if os.path.getsize(path) == 0:
+            continue
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size = len(data)
+            offset = 0
+            # A recording cut short by a crash ends with a partial record, which is skipped
+            while offset + header_size <= size:
+                received_at, kind, connection_id, length = RECORD_HEADER.unpack_from(data, offset)
+                offset += header_size
+                if offset + length > size:
+                    break
+                payload = data[offset:offset + length]
+                yield received_at, kind, connection_id, payload if kind == BINARY_FRAME else payload.decode("utf-8")
+                offset += length
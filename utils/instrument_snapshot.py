@@ -0,0 +1,49 @@
+"""
+Local copy of the instrument universe, so a restart during the day can subscribe without waiting on Redis.
+
+The snapshot is one JSON file: {"day", "patterns", "saved_at", "tokens": [[broker token, CT key], ...]}
+in subscription order. It is only used on the day it was written and for the same key patterns.
+"""
+import json
+import os
+import time
+from datetime import date
+
+
+def save_snapshot(path, patterns, symbol_list, symbol_dict):
+    snapshot = {
+        "day": date.today().isoformat(),
+        "patterns": list(patterns),
+        "saved_at": time.time(),
+        "tokens": [[token, symbol_dict[token]] for token in symbol_list],
+    }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Write then rename, a crash mid-write leaves the previous snapshot intact
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(snapshot, f, separators=(",", ":"))
+    os.replace(temporary, path)
+
+
+def load_snapshot(path, patterns):
+    """(symbol_list, symbol_dict) from today's snapshot for these patterns, or None."""
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if snapshot.get("day") != date.today().isoformat() or snapshot.get("patterns") != list(patterns):
+        return None
+    symbol_list = [token for token, _ in snapshot["tokens"]]
+    symbol_dict = {token: key for token, key in snapshot["tokens"]}
+    return symbol_list, symbol_dict
+
+
+def diff_instruments(old, new):
+    """(added, removed, changed) broker tokens between two broker token -> CT key mappings."""
+    added = [token for token in new if token not in old]
+    removed = [token for token in old if token not in new]
+    changed = [token for token in new if token in old and old[token] != new[token]]
+    return added, removed, changed
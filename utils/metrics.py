@@ -0,0 +1,220 @@
+"""
+Minimal in-process metrics with a Prometheus text endpoint.
+
+Metrics are plain dicts keyed by label values, so an update on the hot path is a dict lookup and an
+add; no locks are taken (a rare lost increment from the writer thread is acceptable for monitoring).
+"""
+import asyncio
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+PIPELINE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(names, values, extra=""):
+    parts = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in list(self.values.items()):
+            yield self.name, _format_labels(self.labels, labels), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, labels=()):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for labels, (counts, total, count) in list(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket", _format_labels(self.labels, labels, f'le="{le}"'), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labels, labels), total
+            yield f"{self.name}_count", _format_labels(self.labels, labels), count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+FRAMES = REGISTRY.counter("tick_frames_total", "WebSocket frames received", ("account", "connection", "kind"))
+FRAME_BYTES = REGISTRY.counter("tick_frame_bytes_total", "Bytes of binary frames received", ("account", "connection"))
+TICKS = REGISTRY.counter("ticks_total", "Decoded ticks", ("account", "connection"))
+STAGE_SECONDS = REGISTRY.histogram("ingest_stage_seconds", "Per-frame processing time by stage",
+                                   ("stage", "connection"))
+RECEIVE_LAG = REGISTRY.histogram("tick_receive_lag_seconds", "Receive time minus newest exchange timestamp in a frame",
+                                 ("connection",), LAG_BUCKETS)
+FRAME_QUEUE_DEPTH = REGISTRY.gauge("frame_queue_depth", "Frames waiting for a frame worker, spilled ones included",
+                                   ("worker",))
+FRAME_QUEUE_OVERFLOW = REGISTRY.counter("frame_queue_overflow_total", "Frames that found the frame queue full",
+                                        ("action",))
+FRAME_PROCESS_DELAY = REGISTRY.histogram("frame_process_delay_seconds",
+                                         "Frame receive time to its ticks being aggregated", ("connection",),
+                                         LAG_BUCKETS)
+LOOP_LAG = REGISTRY.histogram("event_loop_lag_seconds", "How late the event loop woke a periodic probe", (),
+                              LAG_BUCKETS)
+LOOP_LAG_LAST = REGISTRY.gauge("event_loop_lag_last_seconds", "Most recent event loop lag probe")
+FLUSH_SECONDS = REGISTRY.histogram("candle_flush_seconds", "Time to write a flush's candles",
+                                   ("store", "timeframe"), LAG_BUCKETS)
+CANDLES_WRITTEN = REGISTRY.counter("candles_written_total", "Candles written", ("store", "timeframe"))
+EXCHANGE_TO_WRITE = REGISTRY.histogram("candle_exchange_to_write_seconds",
+                                       "Write completion time minus the candle's exchange period close",
+                                       ("store", "timeframe"), LAG_BUCKETS)
+FINALIZE_LAG = REGISTRY.histogram("candle_finalize_lag_seconds", "Minute finalization time minus the minute's end",
+                                  (), LAG_BUCKETS)
+WATERMARK_LAG = REGISTRY.gauge("candle_watermark_lag_seconds", "Wall time minus the exchange-time watermark")
+LATE_TICKS = REGISTRY.counter("candle_late_ticks_total", "Ticks for an already finalized minute", ("action",))
+CHECKPOINT_SECONDS = REGISTRY.histogram("candle_checkpoint_seconds", "Time to write dirty slots to the checkpoint")
+CHECKPOINT_SLOTS = REGISTRY.counter("candle_checkpoint_slots_total", "Candle slots written to the checkpoint")
+AMENDED_CANDLES = REGISTRY.counter("candle_amendments_total", "Finalized 1m candles rewritten with late ticks")
+
+COALESCED_CHANGES = REGISTRY.counter("tick_changes_total", "Per-symbol tick changes handed to the coalescing publisher")
+PUBLISHED_UPDATES = REGISTRY.counter("tick_published_updates_total",
+                                     "Per-symbol updates published after coalescing")
+PUBLISHED_MESSAGES = REGISTRY.counter("tick_published_messages_total", "Batch messages published on TICK:CHANGES")
+PUBLISH_LATENCY = REGISTRY.histogram("tick_publish_latency_seconds",
+                                     "First change in a window to its batch message being published")
+
+REDIS_PIPELINE_SECONDS = REGISTRY.histogram("redis_pipeline_seconds",
+                                            "Round trip of one pipeline chunk to a Redis shard",
+                                            ("shard", "lane"))
+REDIS_PIPELINE_COMMANDS = REGISTRY.histogram("redis_pipeline_commands", "Commands in one pipeline chunk",
+                                             ("shard", "lane"), PIPELINE_BUCKETS)
+REDIS_WRITE_ERRORS = REGISTRY.counter("redis_write_errors_total", "Pipeline chunks that failed on a Redis shard",
+                                      ("shard", "lane"))
+REDIS_PENDING_BATCHES = REGISTRY.gauge("redis_pending_batches", "Write batches submitted and not yet applied",
+                                       ("lane",))
+REDIS_COALESCED_BATCHES = REGISTRY.counter("redis_coalesced_batches_total",
+                                           "Write batches merged into their lane's overflow batch because the lane "
+                                           "had too many pending", ("lane",))
+
+CLICKHOUSE_QUEUE_ROWS = REGISTRY.gauge("clickhouse_queue_rows", "Candle rows queued for a ClickHouse insert",
+                                       ("table",))
+CLICKHOUSE_ROWS = REGISTRY.counter("clickhouse_rows_total",
+                                   "Candle rows by what the ClickHouse sink did with them", ("table", "outcome"))
+CLICKHOUSE_RETRIES = REGISTRY.counter("clickhouse_insert_retries_total", "Failed ClickHouse inserts retried",
+                                      ("table",))
+
+CONNECTION_UP = REGISTRY.gauge("connection_up", "1 while a broker connection is receiving frames",
+                               ("account", "connection"))
+CONNECTION_RECONNECTS = REGISTRY.counter("connection_reconnects_total", "Broker connection sessions that ended",
+                                         ("account", "connection"))
+CONNECTION_GAP = REGISTRY.histogram("connection_gap_seconds",
+                                    "Session end to the first frame of the next session", ("connection",),
+                                    LAG_BUCKETS)
+CONNECTION_TICK_RATE = REGISTRY.gauge("connection_tick_rate",
+                                      "Ticks per second on a connection over the last rebalance window",
+                                      ("connection",))
+TOKENS_MOVED = REGISTRY.counter("tokens_rebalanced_total", "Tokens moved between connections by live rebalancing")
+UNSUBSCRIBED_TOKENS = REGISTRY.gauge("tokens_unsubscribed",
+                                     "Tokens waiting for an account to log in before they are subscribed")
+DUPLICATE_TICKS = REGISTRY.counter("tick_duplicates_total", "Ticks dropped as already received on a standby connection")
+
+STARTUP_SECONDS = REGISTRY.gauge("startup_seconds", "Time from process start to a startup milestone", ("stage",))
+INSTRUMENT_CHANGES = REGISTRY.counter("instrument_changes_total",
+                                      "Instrument universe differences found by the background refresh", ("kind",))
+
+
+async def monitor_event_loop_lag(interval=0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        LOOP_LAG.observe(lag)
+        LOOP_LAG_LAST.set(lag)
+
+
+async def _handle_request(reader, writer, registry):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            body = registry.render().encode()
+            status = "200 OK"
+        else:
+            body = b"not found\n"
+            status = "404 Not Found"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception as e:
+        print(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port, host="127.0.0.1", registry=REGISTRY):
+    server = await asyncio.start_server(lambda r, w: _handle_request(r, w, registry), host, port)
+    print(f"Metrics on http://{host}:{port}/metrics")
+    return server
@@ -1,83 +1,236 @@
 from redis import Redis
+import asyncio
 import json
-from hashlib import blake2b
-from collections import defaultdict
+import time
+import zlib
+from contextlib import nullcontext
+
+from utils.metrics import COALESCED_CHANGES, PUBLISH_LATENCY, PUBLISHED_MESSAGES, PUBLISHED_UPDATES
+
+_MISSING = object()
+
+# Fields carried by each packet type, see helpers.zerodha_helpers._PACKET_FIELDS
+_BATCH_FIELDS = {
+    8: ("ltp",),
+    28: ("ltp",),
+    32: ("ltp", "timestamp"),
+    44: ("ltp", "atp", "volume"),
+    184: ("ltp", "atp", "volume", "oi", "timestamp"),
+}
+
 
 class MarketDataUpdater:
     """
     All fields (including depth) stored in a Redis HASH.
     Depth is serialized as a JSON string.
     Publishes actual changed values (except depth) to avoid redis fetch on readers.
+    Change detection compares against the last value written per symbol and field; scalars are
+    compared directly and depth structurally, nothing is serialized unless it changed.
     """
     def __init__(
             self,
             redis_client: Redis,
             threshold_ratio: float = 0.66,
-            publish_channel: str = "TICK:CHANGES"
+            publish_channel: str = "TICK:CHANGES",
+            coalescer=None
     ):
         self.redis = redis_client
         self.threshold = int(15 * threshold_ratio)
-        self.hash_cache = defaultdict(dict)
-        self.initialized = set()
+        self.last_values = {}
         self.publish_channel = publish_channel
+        # With a CoalescingPublisher, changes are handed to it instead of one PUBLISH per symbol
+        self.coalescer = coalescer
 
     @staticmethod
-    def hash_field(value) -> str:
-        if isinstance(value, (dict, list)):
-            s = json.dumps(value, separators=(",", ":"), sort_keys=True)
-        else:
-            s = str(value)
-        return blake2b(s.encode(), digest_size=4).hexdigest()
+    def _serialize(field, value):
+        return json.dumps(value, separators=(",", ":"), sort_keys=True) if field == "depth" else value
+
     def update_commands(self, pipe: Redis.pipeline, symbol: str, new_data: dict):
         key = f"TICKS:{symbol}"
-        prev = self.hash_cache[symbol]
-        new_hashes = {}
-        changed = {}
+        prev = self.last_values.get(symbol)
+        is_new = prev is None
+        if is_new:
+            prev = self.last_values[symbol] = {}
 
         # 1) Detect changed fields
+        changed = {}
         for field, raw_val in new_data.items():
-            h = self.hash_field(raw_val)
-            new_hashes[field] = h
-            if prev.get(field) != h:
-                val = raw_val if field != "depth" else json.dumps(raw_val, separators=(",", ":"), sort_keys=True)
-                changed[field] = val
+            if prev.get(field, _MISSING) != raw_val:
+                changed[field] = raw_val
 
         cnt = len(changed)
-        is_new = symbol not in self.initialized
-        update_type = None
 
         # 2) FULL replace
         if is_new or cnt >= self.threshold:
-            mapping = {}
-            for field, raw_val in new_data.items():
-                mapping[field] = raw_val if field != "depth" else json.dumps(raw_val, separators=(",", ":"), sort_keys=True)
+            mapping = {field: self._serialize(field, raw_val) for field, raw_val in new_data.items()}
             pipe.hset(key, mapping=mapping)
-
-            self.hash_cache[symbol] = new_hashes.copy()
-            self.initialized.add(symbol)
-            update_type = "full"
+            prev.clear()
+            prev.update(new_data)
+            changed = {field: mapping[field] for field in changed}
+            msg = {"symbol": symbol, "full_replace": True}
 
         # 3) PARTIAL patch
         elif cnt > 0:
+            prev.update(changed)
+            changed = {field: self._serialize(field, raw_val) for field, raw_val in changed.items()}
             pipe.hset(key, mapping=changed)
-            for f in changed:
-                prev[f] = new_hashes[f]
-            update_type = "partial"
+            msg = {"symbol": symbol, "full_replace": False}
+            msg["changes"] = {k: v for k, v in changed.items() if k != "depth"}
+            if not msg["changes"]:
+                msg = {}
         else:
             return {}, None
 
-        msg = {
-            "symbol": symbol,
-            "full_replace": (update_type == "full")
-        }
-
-        if update_type == "partial":
-            msg["changes"] = {
-                k: v for k, v in changed.items()
-                if k != "depth"
-            }
-            if not msg['changes']:
-                msg = {}
         if msg:
-            pipe.publish(self.publish_channel, json.dumps(msg))
+            if self.coalescer is not None:
+                self.coalescer.add(symbol, msg.get("changes"), msg["full_replace"])
+            else:
+                pipe.publish(self.publish_channel, json.dumps(msg))
         return changed, msg
+
+    def update_batch(self, batch, symbols, pipe=None):
+        """
+        Queue the changes of a whole decoded TickBatch on one pipeline and return it, unexecuted.
+        symbols maps broker tokens to symbols; tokens without a symbol are skipped.
+        """
+        if pipe is None:
+            pipe = self.redis.pipeline(transaction=False)
+        columns = {
+            "ltp": batch.ltp, "atp": batch.atp, "volume": batch.volume, "oi": batch.oi,
+            "timestamp": batch.timestamp,
+        }
+        tokens, lengths = batch.token, batch.length
+        last_values = self.last_values
+        threshold = self.threshold
+        channel = self.publish_channel
+        dumps = json.dumps
+        coalescer = self.coalescer
+        for i in range(len(tokens)):
+            symbol = symbols.get(tokens[i])
+            if symbol is None:
+                continue
+            fields = _BATCH_FIELDS.get(lengths[i])
+            if fields is None:
+                continue
+            prev = last_values.get(symbol)
+            if prev is None:
+                self.update_commands(pipe, symbol, {field: columns[field][i] for field in fields})
+                continue
+
+            changed = None
+            for field in fields:
+                value = columns[field][i]
+                if prev.get(field, _MISSING) != value:
+                    if changed is None:
+                        changed = {}
+                    changed[field] = value
+            if changed is None:
+                continue
+            if len(changed) >= threshold:
+                self.update_commands(pipe, symbol, {field: columns[field][i] for field in fields})
+                continue
+            # Batch fields are all scalars, so the partial patch needs no serialization
+            prev.update(changed)
+            pipe.hset(f"TICKS:{symbol}", mapping=changed)
+            if coalescer is not None:
+                coalescer.add(symbol, changed)
+            else:
+                pipe.publish(channel, dumps({"symbol": symbol, "full_replace": False, "changes": changed}))
+        return pipe
+
+
+class CoalescingPublisher:
+    """
+    Collects tick changes for a window and publishes them as batch messages, keeping only the latest
+    value per symbol and field. With shards > 1 symbols are spread over "{channel}:{n}" by crc32.
+    Message format:
+        {"ts": publish time, "changes": {symbol: {field: value}}, "full_replace": [symbol, ...]}
+    full_replace lists symbols whose TICKS:{symbol} hash was rewritten and should be re-read.
+    add() must be called from the event loop thread that runs run(), or from other threads holding lock.
+    """
+
+    def __init__(self, redis_client: Redis, window: float = 0.1, channel: str = "TICK:CHANGES", shards: int = 1,
+                 executor=None, lock=None):
+        self.redis = redis_client
+        self.window = window
+        self.channel = channel
+        self.shards = shards
+        # Executor shared with the TICKS:* pipelines keeps hash writes ahead of the messages announcing them
+        self.executor = executor
+        self.lock = lock or nullcontext()
+        self.pending = {}
+        self.full_replace = set()
+        self.window_started = None
+        self.changes_added = 0
+        self.flushed_changes = 0
+        self.updates_published = 0
+        self.messages_published = 0
+
+    def channel_for(self, symbol):
+        if self.shards <= 1:
+            return self.channel
+        return f"{self.channel}:{zlib.crc32(symbol.encode()) % self.shards}"
+
+    def add(self, symbol, changes=None, full_replace=False):
+        if self.window_started is None:
+            self.window_started = time.perf_counter()
+        self.changes_added += 1
+        if full_replace:
+            self.full_replace.add(symbol)
+        if changes:
+            pending = self.pending.get(symbol)
+            if pending is None:
+                self.pending[symbol] = dict(changes)
+            else:
+                pending.update(changes)
+
+    def coalescing_ratio(self):
+        return self.changes_added / self.updates_published if self.updates_published else 0.0
+
+    def build_messages(self):
+        pending, self.pending = self.pending, {}
+        full_replace, self.full_replace = self.full_replace, set()
+        by_channel = {}
+        for symbol, changes in pending.items():
+            by_channel.setdefault(self.channel_for(symbol), ({}, []))[0][symbol] = changes
+        for symbol in full_replace:
+            by_channel.setdefault(self.channel_for(symbol), ({}, []))[1].append(symbol)
+        now = time.time()
+        messages = [
+            (channel, json.dumps({"ts": now, "changes": changes, "full_replace": full}, separators=(",", ":")))
+            for channel, (changes, full) in by_channel.items()
+        ]
+        return messages, len(pending.keys() | full_replace)
+
+    def _publish(self, messages, started, added):
+        pipe = self.redis.pipeline(transaction=False)
+        for channel, message in messages:
+            pipe.publish(channel, message)
+        pipe.execute()
+        PUBLISH_LATENCY.observe(time.perf_counter() - started)
+        PUBLISHED_MESSAGES.inc(len(messages))
+        COALESCED_CHANGES.inc(added)
+
+    async def flush(self):
+        with self.lock:
+            if self.window_started is None:
+                return
+            started, self.window_started = self.window_started, None
+            added = self.changes_added - self.flushed_changes
+            self.flushed_changes = self.changes_added
+            messages, updates = self.build_messages()
+        if not messages:
+            return
+        self.updates_published += updates
+        self.messages_published += len(messages)
+        PUBLISHED_UPDATES.inc(updates)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, self._publish, messages, started, added)
+        except Exception as e:
+            print(f"Error publishing tick changes: {e}")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.window)
+            await self.flush()
@@ -0,0 +1,160 @@
+"""
+Last-N ticks per instrument in shared memory, for consumers on the same host.
+
+Region layout (little-endian):
+    header    magic "TKRG" | version u16 | ring size u16 | slot count u32 | created at f64 | 44 pad bytes
+    directory slot count x (broker token u32, Cirrus token 48 bytes, NUL padded)
+    slots     slot count x (sequence u64 | ticks written u64 | ring size x record)
+    record    exchange timestamp u32 | packet length u32 | ltp f64 | atp f64 | volume i64 | oi i64
+
+Each slot is guarded by a sequence lock. The single writer makes the sequence odd, writes the record
+at ticks written % ring size, then stores an even sequence together with the new count. A reader
+copies what it needs and retries if the sequence was odd or changed in between. That relies on
+stores becoming visible in program order, which holds on x86-64.
+"""
+import mmap
+import os
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+MAGIC = b"TKRG"
+VERSION = 1
+HEADER = struct.Struct("<4sHHId44x")
+DIRECTORY_ENTRY = struct.Struct("<I48s")
+SLOT_HEADER = struct.Struct("<QQ")
+RECORD = struct.Struct("<IIddqq")
+RECORD_FIELDS = ("timestamp", "length", "ltp", "atp", "volume", "oi")
+
+
+def region_size(slot_count, ring_size):
+    return HEADER.size + slot_count * (DIRECTORY_ENTRY.size + SLOT_HEADER.size + ring_size * RECORD.size)
+
+
+class TickRingWriter:
+    def __init__(self, name, broker_to_cirrus_mapping, ring_size=16):
+        self.ring_size = ring_size
+        self.slot_count = len(broker_to_cirrus_mapping)
+        self.slot_size = SLOT_HEADER.size + ring_size * RECORD.size
+        try:
+            # A region left behind by a crashed ingester is replaced
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        self.memory = shared_memory.SharedMemory(name, create=True,
+                                                 size=region_size(self.slot_count, ring_size))
+        self.buffer = self.memory.buf
+        self.slots = {}
+        self.offsets = []
+        directory = HEADER.size
+        slots_start = directory + self.slot_count * DIRECTORY_ENTRY.size
+        for slot, (broker_token, cirrus_token) in enumerate(broker_to_cirrus_mapping.items()):
+            DIRECTORY_ENTRY.pack_into(self.buffer, directory + slot * DIRECTORY_ENTRY.size, broker_token,
+                                      cirrus_token.encode()[:48])
+            self.slots[broker_token] = slot
+            self.offsets.append(slots_start + slot * self.slot_size)
+        self.sequences = [0] * self.slot_count
+        self.written = [0] * self.slot_count
+        # The header goes last, readers refuse a region without the magic
+        HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, ring_size, self.slot_count, time.time())
+
+    def write(self, batch):
+        slots, offsets, sequences, written = self.slots, self.offsets, self.sequences, self.written
+        buffer, ring_size = self.buffer, self.ring_size
+        pack_slot, pack_record = SLOT_HEADER.pack_into, RECORD.pack_into
+        record_size, slot_header_size = RECORD.size, SLOT_HEADER.size
+        tokens, timestamps, lengths = batch.token, batch.timestamp, batch.length
+        ltps, atps, volumes, ois = batch.ltp, batch.atp, batch.volume, batch.oi
+        for i in range(len(tokens)):
+            slot = slots.get(tokens[i])
+            if slot is None:
+                continue
+            offset = offsets[slot]
+            sequence = sequences[slot] + 1
+            count = written[slot]
+            pack_slot(buffer, offset, sequence, count)
+            pack_record(buffer, offset + slot_header_size + (count % ring_size) * record_size,
+                        timestamps[i], lengths[i], ltps[i], atps[i], volumes[i], ois[i])
+            sequences[slot] = sequence + 1
+            written[slot] = count + 1
+            pack_slot(buffer, offset, sequence + 1, count + 1)
+
+    def close(self, unlink=True):
+        self.buffer = None
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+class TickRingReader:
+    """
+    Attach to one or more regions (one per ingest worker) by name. Lookups take a Cirrus token or a
+    broker token. Records are returned as tuples in RECORD_FIELDS order.
+    """
+
+    def __init__(self, *names, retries=100):
+        self.retries = retries
+        self.memories = []
+        self.slots = {}
+        for name in names:
+            memory, buffer = self._attach(name)
+            magic, version, ring_size, slot_count, _ = HEADER.unpack_from(buffer, 0)
+            if magic != MAGIC or version != VERSION:
+                buffer.release()
+                memory.close()
+                raise ValueError(f"{name} is not a version {VERSION} tick ring")
+            self.memories.append((memory, buffer))
+            slots_start = HEADER.size + slot_count * DIRECTORY_ENTRY.size
+            slot_size = SLOT_HEADER.size + ring_size * RECORD.size
+            for slot in range(slot_count):
+                broker_token, cirrus_token = DIRECTORY_ENTRY.unpack_from(
+                    buffer, HEADER.size + slot * DIRECTORY_ENTRY.size)
+                location = (buffer, slots_start + slot * slot_size, ring_size)
+                self.slots[broker_token] = location
+                self.slots[cirrus_token.rstrip(b"\0").decode()] = location
+
+    @staticmethod
+    def _attach(name):
+        path = f"/dev/shm/{name.lstrip('/')}"
+        if os.path.exists(path):
+            # Mapped read-only and outside multiprocessing's resource tracker, which would otherwise
+            # unlink the writer's region when this process exits (bpo-39959)
+            with open(path, "rb") as f:
+                memory = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return memory, memoryview(memory)
+        memory = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(memory._name, "shared_memory")
+        return memory, memory.buf
+
+    def last(self, token, n=1):
+        """Up to n most recent ticks of a token, oldest first."""
+        location = self.slots.get(token)
+        if location is None:
+            return []
+        buffer, offset, ring_size = location
+        n = min(n, ring_size)
+        unpack_slot, unpack_record = SLOT_HEADER.unpack_from, RECORD.unpack_from
+        records_start = offset + SLOT_HEADER.size
+        for _ in range(self.retries):
+            sequence, count = unpack_slot(buffer, offset)
+            if sequence & 1:
+                continue
+            records = [unpack_record(buffer, records_start + (i % ring_size) * RECORD.size)
+                       for i in range(max(0, count - n), count)]
+            if unpack_slot(buffer, offset)[0] == sequence:
+                return records
+        raise TimeoutError(f"Tick ring slot for {token} kept changing")
+
+    def latest(self, token):
+        """Most recent tick of a token, or None if it has not ticked."""
+        records = self.last(token, 1)
+        return records[0] if records else None
+
+    def close(self):
+        self.slots = {}
+        for memory, buffer in self.memories:
+            buffer.release()
+            memory.close()
+        self.memories = []